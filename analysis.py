@@ -0,0 +1,132 @@
+import multiprocessing
+
+import board
+import pgn
+import search
+
+"""
+Annotate every position of a game with a search result.  The game is replayed with movePGN() and the positions are
+handed to a pool of worker processes, each searching one position within its own time budget.  Results come back in
+game order, each as soon as it and every position before it are done, so a caller can show them while the rest of the
+game is still being searched.
+"""
+
+# Return what a worker needs to rebuild a board with _board(): the packed position, and what packing leaves out, the
+# move clocks, the check, the castling squares of Chess960 positions, and the history the search finds repetitions in.
+def _state(b):
+   return (b.pack(), b.halfmove_clock, b.fullmove_number, b.check, b._castle_squares, b._castle_masks,
+           list(b.history))
+
+def _board(state):
+   packed, halfmove_clock, fullmove_number, check, castle_squares, castle_masks, history = state
+   b = board.Board.unpack(packed)
+   b._castle_squares = castle_squares
+   b._castle_masks = castle_masks
+   b.halfmove_clock = halfmove_clock
+   b.fullmove_number = fullmove_number
+   b.check = check
+   b.history = history
+
+   return b
+
+"""
+Search one position.  The task is a tuple of (ply, move, board state, depth, time limit), where the board state is
+made by _state(), and the result is a tuple of (ply, move, score, best move, depth) with the score from white's point
+of view.
+"""
+def _analyze(task):
+   ply, move, state, depth, time_limit = task
+   b = _board(state)
+   score, best, reached = search.search(b, depth, time_limit)
+
+   if b.to_play != board.Board.WHITE:
+      score = -score
+
+   return (ply, move, score, best, reached)
+
+"""
+An Analyzer searches the positions of games with a pool of worker processes, by default one per CPU.  Each position
+is searched to the given depth or for time_limit seconds, whichever comes first.
+"""
+class Analyzer(object):
+   def __init__(self, workers=None, time_limit=1.0, depth=None):
+      self.time_limit = time_limit
+      self.depth = depth
+      self.pool = multiprocessing.Pool(workers)
+
+   """
+   Search every position of a game given as a list of SAN moves, starting with the initial position, or with the
+   position of the given FEN.  Yield a tuple of (ply, move, score, best move, depth) for each position in order, where
+   move is the move that led to the position, or None for the initial one.  A game with an unplayable move is analyzed
+   up to that move.
+   """
+   def analyze(self, moves, fen=None):
+      b = pgn.initial_board(fen)
+      tasks = [self._task(b, 0, None)]
+
+      for ply, move in enumerate(moves):
+         try:
+            b.movePGN(move)
+         except ValueError:
+            break
+
+         tasks.append(self._task(b, ply + 1, move))
+
+      for result in self.pool.imap(_analyze, tasks):
+         yield result
+
+   def close(self):
+      self.pool.close()
+      self.pool.join()
+
+   def _task(self, b, ply, move):
+      return (ply, move, _state(b), self.depth, self.time_limit)
+
+"""
+Search every position of one game with a new Analyzer, yielding the results as Analyzer.analyze() does.
+"""
+def analyze_game(moves, workers=None, time_limit=1.0, depth=None, fen=None):
+   analyzer = Analyzer(workers, time_limit, depth)
+
+   try:
+      for result in analyzer.analyze(moves, fen):
+         yield result
+   finally:
+      analyzer.close()
+
+def test_analyze():
+   results = list(analyze_game(['e4', 'e5', 'Qh5', 'Nc6', 'Bc4', 'Nf6'], workers=2, depth=1))
+
+   if [r[0] for r in results] != range(7) or results[0][1] != None or results[-1][1] != 'Nf6':
+      raise Exception('FAIL')
+
+   # After 3...Nf6 white mates with Qxf7
+   if results[-1][3] != 'Qxf7+' or results[-1][2] != search.MATE - 1:
+      raise Exception('FAIL')
+
+def test_state():
+   # A Chess960 position keeps its castling, and a game keeps the history its repetitions are found in.
+   b = pgn.initial_board('bqnbrkrn/pppppppp/8/8/8/8/PPPPPPPP/BQNBRKRN w GEge - 0 1')
+
+   for move in ['Ng3', 'Ng6', 'Nh1', 'Nh8']:
+      b.movePGN(move)
+
+   restored = _board(_state(b))
+
+   if restored.castling_rights() != 15 or restored.legal_moves() != b.legal_moves() or 'O-O' not in b.legal_moves():
+      raise Exception('FAIL')
+
+   for move in ['Ng3', 'Ng6', 'Nh1', 'Nh8']:
+      b.movePGN(move)
+
+   restored = _board(_state(b))
+
+   if restored.to_fen() != b.to_fen() or not restored.is_draw_claimable():
+      raise Exception('FAIL')
+
+def main():
+   test_analyze()
+   test_state()
+
+if __name__ == '__main__':
+   main()
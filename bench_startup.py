@@ -0,0 +1,62 @@
+import os
+import py_compile
+import subprocess
+import sys
+
+"""
+Benchmark the cost of starting to use board in a new interpreter: importing the module, setting up the initial
+position with Board().initialize(), and playing the first move with movePGN().  Each sample runs in a fresh process
+so that nothing is already loaded, and the script exits with an error if the median sample is over budget.
+
+Run it as:
+
+    python bench_startup.py [samples]
+"""
+
+# Milliseconds allowed for import, initialize(), and the first movePGN(), not counting interpreter startup
+BUDGET_MS = 8.0
+
+_sample = '''
+import time
+start = time.time()
+import board
+b = board.Board()
+b.initialize()
+b.movePGN('e4')
+print (time.time() - start) * 1000
+'''
+
+"""
+Run the given number of samples and return the sorted list of their times in milliseconds.
+"""
+def measure(samples=21):
+   here = os.path.dirname(os.path.abspath(__file__))
+
+   # Make sure the samples don't pay for compiling the source, as they wouldn't in a deployed install.
+   py_compile.compile(os.path.join(here, 'board.py'))
+
+   times = []
+
+   for i in range(samples):
+      out = subprocess.check_output([sys.executable, '-c', _sample], cwd=here)
+      times.append(float(out))
+
+   return sorted(times)
+
+def main():
+   samples = 21
+
+   if len(sys.argv) > 1:
+      samples = int(sys.argv[1])
+
+   times = measure(samples)
+   median = times[len(times) / 2]
+
+   print 'import + initialize + first move: median %.2f ms, min %.2f ms, max %.2f ms (budget %.2f ms)' % \
+      (median, times[0], times[-1], BUDGET_MS)
+
+   if median > BUDGET_MS:
+      sys.exit(1)
+
+if __name__ == '__main__':
+   main()
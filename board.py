@@ -1,4 +1,144 @@
-import re
+import os
+import struct
+
+"""
+Load the table of 781 64-bit Zobrist keys.  If the PIDGIN_ZOBRIST_KEYS environment variable names a file, the keys are
+read from it, as written by save_zobrist_keys().  Otherwise they're generated from a seeded generator so that the keys,
+and so any hashes written to disk, are the same in every process.
+"""
+def _zobrist_table(seed=0x5EED):
+   path = os.environ.get('PIDGIN_ZOBRIST_KEYS')
+   
+   if path:
+      with open(path, 'rb') as f:
+         return list(struct.unpack('>781Q', f.read(781 * 8)))
+   
+   # Importing random costs more than the rest of this module, so only do it when the keys are needed.
+   import random
+   rng = random.Random(seed)
+
+   return [rng.getrandbits(64) for i in range(781)]
+
+"""
+Write the Zobrist keys to a file that can be named by the PIDGIN_ZOBRIST_KEYS environment variable.  Loading the keys
+from the file is faster than generating them, and it also allows a specific key table to be used.
+"""
+def save_zobrist_keys(path):
+   if Board._zobrist_keys == None:
+      Board._zobrist_keys = _zobrist_table()
+   
+   with open(path, 'wb') as f:
+      f.write(struct.pack('>781Q', *Board._zobrist_keys))
+
+"""
+Build the square tables.  Squares are numbered the same way as the Board.pieces array, file by file.  Return the
+tuple of square names, the tuple of (rank, file) tuples, and a dict that maps a square name, a (rank, file) tuple, or a
+square number to the square number.
+"""
+def _square_tables():
+   names = []
+   rfs = []
+   index = {}
+   
+   for i in range(64):
+      rank, file = (i % 8, i / 8)
+      names.append(chr(file + 97) + str(rank + 1))
+      rfs.append((rank, file))
+      index[names[i]] = i
+      index[rfs[i]] = i
+      index[i] = i
+   
+   return (tuple(names), tuple(rfs), index)
+
+# Return the rays from the given square in each of the given directions, running to the edge of the board.
+def _rays(rank, file, steps):
+   ret = []
+   
+   # Each step moves a fixed distance through the squares, so a ray is a range cut off at the edge of the board.
+   for r, f in steps:
+      n = 7
+      
+      if r:
+         n = 7 - rank if r > 0 else rank
+      
+      if f:
+         n = min(n, 7 - file if f > 0 else file)
+      
+      step = f * 8 + r
+      start = file * 8 + rank + step
+      ret.append(tuple(range(start, start + step * n, step)))
+   
+   return tuple(ret)
+
+_rook_steps = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+_bishop_steps = [(1, 1), (-1, 1), (-1, -1), (1, -1)]
+
+"""
+Build the tables of the squares attacked from each square on an empty board.  Return the knight targets, the king
+targets, the rook, bishop, and queen rays, and the pawn targets by color.  Each entry of the ray tables holds a tuple
+of squares for each direction, running outward from the square, in the order that covers() has always listed them.
+"""
+def _attack_tables(white, black):
+   # Return the squares one step from the given square in each of the given directions that are on the board.
+   def hops(rank, file, steps):
+      return tuple((file + f) * 8 + rank + r for r, f in steps if 0 <= rank + r <= 7 and 0 <= file + f <= 7)
+   
+   knight_steps = [(r, f) for r in [-2, -1, 1, 2] for f in [-2, -1, 1, 2] if abs(r) != abs(f)]
+   king_steps = [(r, f) for r in [-1, 0, 1] for f in [-1, 0, 1] if r != 0 or f != 0]
+   knights = []
+   kings = []
+   rooks = []
+   bishops = []
+   queens = []
+   pawns = {white: [], black: []}
+   
+   for i in range(64):
+      rank, file = (i % 8, i / 8)
+      knights.append(hops(rank, file, knight_steps))
+      kings.append(hops(rank, file, king_steps))
+      rooks.append(_rays(rank, file, _rook_steps))
+      bishops.append(_rays(rank, file, _bishop_steps))
+      queens.append(rooks[i] + bishops[i])
+      pawns[white].append(hops(rank, file, [(1, -1), (1, 1)]) if rank < 7 else ())
+      pawns[black].append(hops(rank, file, [(-1, -1), (-1, 1)]) if rank > 0 else ())
+   
+   pawns[white] = tuple(pawns[white])
+   pawns[black] = tuple(pawns[black])
+   
+   return (tuple(knights), tuple(kings), tuple(rooks), tuple(bishops), tuple(queens), pawns)
+
+"""
+Build the entry of Board._lines for square i, store it there, and return it.  The entry is a dict from every square on
+a ray from square i to a tuple of the ray and the letter of the piece, 'R' or 'B', that attacks along it.  Most games
+only ever look up the few squares the kings stand on, so entries are built the first time they're needed.
+"""
+def _build_line(i):
+   line = {}
+   
+   # The rays are worked out here rather than taken from the attack tables, so that a game's first moves don't have to
+   # wait for the tables to be built.
+   for rays, kind in ((_rays(i % 8, i / 8, _rook_steps), 'R'), (_rays(i % 8, i / 8, _bishop_steps), 'B')):
+      for ray in rays:
+         for j in ray:
+            line[j] = (ray, kind)
+   
+   Board._lines[i] = line
+   
+   return line
+
+"""
+A stand-in for one of the Board's attack tables.  Indexing it replaces all of the stand-ins with the real tables, so
+that later lookups go straight to the tables.
+"""
+class _LazyTable(object):
+   def __init__(self, name):
+      self.name = name
+   
+   def __getitem__(self, i):
+      Board._knight_targets, Board._king_targets, Board._rook_rays, Board._bishop_rays, Board._queen_rays, \
+         Board._pawn_targets = _attack_tables(Board.WHITE, Board.BLACK)
+      
+      return getattr(Board, self.name)[i]
 
 """
 The Board class contains the state of a game, which is constituted by the positions of all pieces.
@@ -6,7 +146,65 @@ The Board class contains the state of a game, which is constituted by the positi
 class Board(object):
    WHITE = 'white'
    BLACK = 'black'
-   _move_pattern = re.compile('([RNBQK]?)([1-h1-8]?)(x?)([a-h][1-8])(=[NBRQ])?(\+)?')
+   # Castling rights are kept as a mask of these bits, in the order of Polyglot's castling keys.
+   WHITE_KINGSIDE = 1
+   WHITE_QUEENSIDE = 2
+   BLACK_KINGSIDE = 4
+   BLACK_QUEENSIDE = 8
+   # Parsed moves from parse_move() by their SAN text.  Games use few distinct SAN strings, so the cache is bounded by
+   # simply not adding to it once it's full.
+   _move_cache = {}
+   _move_cache_size = 8192
+   
+   # The Zobrist keys are loaded on first use to keep importing this module cheap.  They're laid out like Polyglot's
+   # table: 64 squares for each of the 12 colored piece types, then 4 castling keys, 8 en passant file keys, and the
+   # side-to-move key.
+   _zobrist_kinds = {'P': 0, 'N': 1, 'B': 2, 'R': 3, 'Q': 4, 'K': 5}
+   _zobrist_keys = None
+   _promotion_codes = {None: 0, 'N': 1, 'B': 2, 'R': 3, 'Q': 4}
+   _pack_codes = {'P': 1, 'N': 2, 'B': 3, 'R': 4, 'Q': 5, 'K': 6}
+   STARTING_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+   PACKED_SIZE = 34
+   
+   # For each castling right, the color, the king's square, and the rook's square.  The masks clear the rights that
+   # are lost when a piece moves from or to each square.  Boards set up from a FEN with other king or rook files, as in
+   # Chess960, have their own copies of both.
+   _castle_squares = ((WHITE_KINGSIDE, WHITE, 32, 56), (WHITE_QUEENSIDE, WHITE, 32, 0),
+                      (BLACK_KINGSIDE, BLACK, 39, 63), (BLACK_QUEENSIDE, BLACK, 39, 7))
+   _castle_masks = [15] * 64
+   
+   for bit, color, king_square, rook_square in _castle_squares:
+      _castle_masks[king_square] &= ~bit
+      _castle_masks[rook_square] &= ~bit
+   
+   del bit, color, king_square, rook_square
+   
+   # Every position argument is looked up in _square_index, which accepts a square name like "d4", a (rank, file)
+   # tuple, or a square number, i.e. an index into Board.pieces.  The (rank, file) tuples handed out by the board
+   # are the ones in _square_rf, so they're never rebuilt.
+   SQUARE_NAMES, _square_rf, _square_index = _square_tables()
+   # The attack tables take longer to build than the rest of the module takes to load, and most short jobs never need
+   # them, so each starts out as a stand-in that builds the real tables the first time it's indexed.
+   _knight_targets = _LazyTable('_knight_targets')
+   _king_targets = _LazyTable('_king_targets')
+   _rook_rays = _LazyTable('_rook_rays')
+   _bishop_rays = _LazyTable('_bishop_rays')
+   _queen_rays = _LazyTable('_queen_rays')
+   _pawn_targets = _LazyTable('_pawn_targets')
+   # The lines through each square, as built by _build_line(), or None for those not built yet
+   _lines = [None] * 64
+   # A tablebase.Tablebase to score the positions it covers in evaluate(), or None
+   tablebase = None
+   # An evalcache.EvalCache that evaluate() looks up features() in, or None
+   eval_cache = None
+   # Score of a won tablebase position, less one for each ply to mate
+   TABLEBASE_WIN = 1000
+   # Material value of each piece, as weighed by see()
+   PIECE_VALUES = {'P': 1, 'N': 3, 'B': 3, 'R': 5, 'Q': 9, 'K': 200}
+   # The names of the terms of features(), and the weight evaluate() gives each.  The weights can be replaced with
+   # tuned ones, as with tune.load_weights().
+   EVAL_FEATURES = ('K', 'Q', 'R', 'B', 'N', 'P', 'doubled', 'backward', 'isolated', 'mobility')
+   EVAL_WEIGHTS = dict(PIECE_VALUES, doubled=-0.5, backward=-0.5, isolated=-0.5, mobility=0.1)
    
    """
    Create a new Board instance with no pieces.  See Board.initialize() to set up the initial position.
@@ -27,6 +225,22 @@ class Board(object):
          'K': {Board.WHITE: None, Board.BLACK: None},
       }
       self.callback = None
+      # The Zobrist hash of the piece placement, kept up to date by put(), take(), and move()
+      self.zobrist = 0
+      # The attack maps of the current position by color, dropped by put(), take(), and move()
+      self._attacks = {}
+      # Castling rights are lost as kings and rooks leave or are taken from their home squares.  A right only counts
+      # while its king and rook are actually at home, so boards that are set up by hand can start with all of them.
+      self.castling = Board.WHITE_KINGSIDE | Board.WHITE_QUEENSIDE | Board.BLACK_KINGSIDE | Board.BLACK_QUEENSIDE
+      self._castling_checked = False
+      # Plies since the last capture or pawn move, and the number of the move being played, as in FEN
+      self.halfmove_clock = 0
+      self.fullmove_number = 1
+      # The hash_key() of every position before the current one, oldest first
+      self.history = []
+      
+      if Board._zobrist_keys == None:
+         Board._zobrist_keys = _zobrist_table()
    
    """
    Populate a board with the initial position.  There is no check to make sure the board in empty, so it
@@ -61,12 +275,11 @@ class Board(object):
        self.callback = callback
    
    """
-   Get the piece at a given position.  The position can either be a tuple of (rank, file) or text, e.g. "d4".
+   Get the piece at a given position.  The position can either be a tuple of (rank, file) or text, e.g. "d4", or a
+   square number, i.e. an index into Board.pieces.
    """
    def get(self, position):
-      rank, file = self._arg_to_rf(position)
-      
-      return self.pieces[self._rf_to_index(rank, file)]
+      return self.pieces[Board._arg_to_index(position)]
    
    """
    Get the king of the given color.
@@ -75,13 +288,18 @@ class Board(object):
       return self.by_piece['K'][color]
       
    """
-   Place a piece at the given position.  The position can either be a tuple of (rank, file) or text, e.g. "d4".
+   Place a piece at the given position.  The position can either be a tuple of (rank, file) or text, e.g. "d4", or a
+   square number, i.e. an index into Board.pieces.
    """
    def put(self, piece, position):
-      rank, file = self._arg_to_rf(position)
+      i = Board._arg_to_index(position)
+      rank, file = Board._square_rf[i]
       
-      self.pieces[self._rf_to_index(rank, file)] = piece
+      self.pieces[i] = piece
+      self._attacks = {}
+      self._castling_checked = False
       piece.move(rank, file)
+      self.zobrist ^= self._zobrist_piece(piece, rank, file)
       
       if isinstance(piece, King):
          if self.by_piece[piece.name][piece.color] != None:
@@ -92,15 +310,18 @@ class Board(object):
          self.by_piece[piece.name][piece.color].append(piece)
       
    """
-   Remove the pieces at a given position.  The position can either be a tuple of (rank, file) or text, e.g. "d4".
+   Remove the pieces at a given position.  The position can either be a tuple of (rank, file) or text, e.g. "d4", or a
+   square number, i.e. an index into Board.pieces.
    The removed piece is returned.
    """
    def take(self, position):
-      rank, file = self._arg_to_rf(position)
-      
-      i = self._rf_to_index(rank, file)
+      i = Board._arg_to_index(position)
+      rank, file = Board._square_rf[i]
       piece = self.pieces[i]
       self.pieces[i] = None
+      self._attacks = {}
+      self.castling &= self._castle_masks[i]
+      self.zobrist ^= self._zobrist_piece(piece, rank, file)
       piece.take()
       
       if isinstance(piece, King):
@@ -112,21 +333,29 @@ class Board(object):
    
    """
    Move the piece at a given position to a given position.   The positions can each be either a tuple of
-   (rank, file) or text, e.g. "d4".
+   (rank, file), text, e.g. "d4", or a square number.
    """
    def move(self, src, dest):
-      rank1, file1 = self._arg_to_rf(src)
-      i1 = self._rf_to_index(rank1, file1)
+      i1 = Board._arg_to_index(src)
+      rank1, file1 = Board._square_rf[i1]
 
       if self.pieces[i1] == None:
          raise ValueError('Source square is empty')
 
-      rank2, file2 = self._arg_to_rf(dest)
-      i2 = self._rf_to_index(rank2, file2)
+      i2 = Board._arg_to_index(dest)
+      rank2, file2 = Board._square_rf[i2]
 
       piece = self.pieces[i2]
+      self.zobrist ^= self._zobrist_piece(self.pieces[i1], rank1, file1) ^ \
+         self._zobrist_piece(self.pieces[i1], rank2, file2)
+      
+      if piece != None:
+         self.zobrist ^= self._zobrist_piece(piece, rank2, file2)
+      
       self.pieces[i2] = self.pieces[i1]
       self.pieces[i1] = None
+      self._attacks = {}
+      self.castling &= self._castle_masks[i1] & self._castle_masks[i2]
       self.pieces[i2].move(rank2, file2)
       
       if self.callback:
@@ -134,45 +363,117 @@ class Board(object):
       
       return piece
    
+   """
+   Parse a PGN code into a tuple of (piece, disambiguation, capture, destination square number, promotion, check).
+   The piece is the letter of the piece moved, with 'P' for pawns, or 'O-O' or 'O-O-O' for castling, in which case
+   the destination is None.  The disambiguation is the file, rank, or square given to tell pieces apart, or '', and
+   the promotion is the letter of the piece promoted to, or None.  Check is true if the move is marked with + or #.
+   Trailing !s and ?s are ignored.  A ValueError is raised if the code isn't a move.  Parsed codes are cached.
+   """
+   @staticmethod
+   def parse_move(move):
+      parsed = Board._move_cache.get(move)
+      
+      if parsed == None:
+         parsed = Board._tokenize(move)
+         
+         if len(Board._move_cache) < Board._move_cache_size:
+            Board._move_cache[move] = parsed
+      
+      return parsed
+   
+   @staticmethod
+   def _tokenize(move):
+      end = len(move)
+      
+      while end > 0 and move[end - 1] in '!?':
+         end -= 1
+      
+      check = end > 0 and move[end - 1] in '+#'
+      
+      if check:
+         end -= 1
+      
+      if move[:end] == 'O-O' or move[:end] == 'O-O-O':
+         return (move[:end], '', False, None, None, check)
+      
+      promotion = None
+      
+      if end > 2 and move[end - 1] in 'NBRQ' and move[end - 2] in '=12345678':
+         promotion = move[end - 1]
+         end -= 2 if move[end - 2] == '=' else 1
+      
+      if end < 2 or move[end - 2] not in 'abcdefgh' or move[end - 1] not in '12345678':
+         raise ValueError('Bad move definition: %s' % move)
+      
+      dest = (ord(move[end - 2]) - 97) * 8 + ord(move[end - 1]) - 49
+      start = 0
+      piece = 'P'
+      
+      if move[0] in 'NBRQK':
+         piece = move[0]
+         start = 1
+      
+      capture = end - 2 > start and move[end - 3] == 'x'
+      modifier = move[start:end - 3 if capture else end - 2]
+      
+      # The disambiguation is a file, a rank, or both, and pawns are only told apart by file.
+      if len(modifier) > 2 or (modifier and modifier[0] not in 'abcdefgh12345678') or \
+         (len(modifier) == 2 and (modifier[0] not in 'abcdefgh' or modifier[1] not in '12345678')) or \
+         (piece == 'P' and (len(modifier) > 1 or modifier.isdigit())) or \
+         (promotion != None and (piece != 'P' or dest & 7 not in (0, 7))):
+         raise ValueError('Bad move definition: %s' % move)
+      
+      return (piece, modifier, capture, dest, promotion, check)
+   
    """
    Move a piece by a PGN code, e.g. "d4" or "Nxf6+".
    """
    def movePGN(self, move):
-      m = self._move_pattern.match(move)
+      src, rf, capture, i, promotion, check = Board.parse_move(move)
+      key = self.hash_key()
       
-      if m:
-         src = m.group(1)
-         rf = m.group(2)
-         capture = m.group(3)
-         dest = m.group(4)
-         promotion = m.group(5)
-         check = m.group(6)
-         
-         # DF: Pawns expect their names to be 'P'
-         if not src:
-            src = 'P'
-         
-         rank, file = self._position_to_rf(dest)
+      if i != None:
+         rank, file = Board._square_rf[i]
          
          # Track the capture rank separately in case of en passant
          capture_rank = rank
          
          # Check to see if this is an en passant #DF: changed ' ' for 'P'
-         if capture != '' and self.pieces[self._rf_to_index(rank, file)] == None and src == 'P' and \
+         if capture and self.pieces[i] == None and src == 'P' and \
             self.en_passant_target != None and rank == self.en_passant_target[0] and \
             file == self.en_passant_target[1]:
             capture_rank = self.en_passant_target[2]
-         elif capture != '' and self.pieces[self._rf_to_index(rank, file)] == None:
+         elif capture and self.pieces[i] == None:
             raise ValueError('Capture is not possible: %s' % move)
             
          # Find the piece of the given type that can make the given move.
-         piece = self._find_piece(src, (rank, file), rf, capture != '')
+         piece = self._find_piece(src, Board._square_rf[i], rf, capture)
          
          if not piece:
             raise ValueError('Move is not possible: %s' % move)
          
+         # The squares the move empties, which may open lines onto either king
+         vacated = [piece.file * 8 + piece.rank]
+         
+         if capture_rank != rank:
+            vacated.append(file * 8 + capture_rank)
+         
+         # What's needed to take the move back if it turns out to leave the mover's king attacked: the state the move
+         # changes, where the piece came from, and the pieces it removes with their places in by_piece.
+         saved = self._saved_state()
+         origin = (piece.rank, piece.file)
+         removed = []
+         
+         if capture:
+            taken = self.pieces[file * 8 + capture_rank]
+            removed.append((taken, (capture_rank, file), self.by_piece[taken.name][taken.color].index(taken)))
+         
+         if promotion:
+            removed.append((piece, origin, self.by_piece['P'][piece.color].index(piece)))
+         
          # If it's a capture, remove the captured piece
-         if capture != '':
+         if capture:
             self.take((capture_rank, file))
             
          if type(piece) == Pawn and piece.file == file and abs(piece.rank - rank) == 2:
@@ -191,105 +492,750 @@ class Board(object):
             # Swap out the pawn for the promoted piece
             self.take((piece.rank, piece.file))
             
-            if promotion == '=N':
+            if promotion == 'N':
                Knight(self, rank, file, self.to_play, len(self.by_piece['N'][piece.color])) #DF: added ids
-            elif promotion == '=B':
+            elif promotion == 'B':
                Bishop(self, rank, file, self.to_play, len(self.by_piece['B'][piece.color]))
-            elif promotion == '=R':
+            elif promotion == 'R':
                Rook(self, rank, file, self.to_play, len(self.by_piece['R'][piece.color]))
-            elif promotion == '=Q':
+            elif promotion == 'Q':
                Queen(self, rank, file, self.to_play, len(self.by_piece['Q'][piece.color]))
             else:
                raise ValueError("Promotion is not valid: %s" % move)
          # Toggle who's turn it is
-         if self.to_play == Board.WHITE:
-            self.to_play = Board.BLACK
-         else:
-            self.to_play = Board.WHITE
-
-         # If the player was in check, make sure he isn't still
-         if self.check:
-            king = self.by_piece['K'][self.check]
-            
-            for piece_type in self.by_piece.keys():
-               if piece_type != 'K':
-                  for piece in self.by_piece[piece_type][self.to_play]:
-                     if piece.reach((king.rank, king.file), True):
-                        print piece
-                        raise ValueError('Check not resolved by %s' % move)
-                     
-         # Record who's in check, even though we don't do anything with it yet
-         if check != '':
-            self.check = self.to_play
-         else:
-            self.check = None
-         
-      # Queen-side castle
-      elif move.startswith('O-O-O'):
-         if self.to_play == Board.WHITE and type(self.pieces[self._rf_to_index(0, 4)]) == King and \
-            type(self.pieces[self._rf_to_index(0, 0)]) == Rook and \
-            self.pieces[self._rf_to_index(0, 1)] == None and \
-            self.pieces[self._rf_to_index(0, 2)] == None and \
-            self.pieces[self._rf_to_index(0, 3)] == None:
-            self.move((0, 0), (0, 3))
-            self.move((0, 4), (0, 2))
-         elif self.to_play == Board.BLACK and type(self.pieces[self._rf_to_index(7, 4)]) == King and \
-            type(self.pieces[self._rf_to_index(7, 0)]) == Rook and \
-            self.pieces[self._rf_to_index(7, 1)] == None and \
-            self.pieces[self._rf_to_index(7, 2)] == None and \
-            self.pieces[self._rf_to_index(7, 3)] == None:
-            self.move((7, 0), (7, 3))
-            self.move((7, 4), (7, 2))
-         else:
+         self._end_move(key, src == 'P' or capture)
+         
+         # Only a king move, a promotion, or a move out of check needs the kings' squares searched in full.
+         try:
+            if promotion or src == 'K' or self.check != None:
+               self._verify_check(move)
+            else:
+               self._verify_lines(move, piece, vacated)
+         except ValueError:
+            self._take_back(saved, lambda: self._unmove(piece, origin, (rank, file), removed))
+            raise
+         
+      # Castling, on either side
+      else:
+         castle = self._castle_plan(src == 'O-O-O')
+         
+         if castle == None:
             raise ValueError('Castle is not possible')
          
+         saved = self._saved_state()
+         self._castle_move(*castle)
+         
          # Toggle who's turn it is
-         if self.to_play == Board.WHITE:
-            self.to_play = Board.BLACK
-         else:
-            self.to_play = Board.WHITE
-         pass
+         self.en_passant_target = None
+         self._end_move(key, False)
+         
+         try:
+            self._verify_check(move)
+         except ValueError:
+            king_square, rook_square, king_dest, rook_dest = castle
+            self._take_back(saved, lambda: self._castle_move(king_dest, rook_dest, king_square, rook_square))
+            raise
+   
+   # Return the state a move changes apart from the pieces, for _take_back() to restore.
+   def _saved_state(self):
+      return (self.en_passant_target, self.castling, self.check, self.halfmove_clock, self.fullmove_number,
+              self.to_play)
+   
+   # Take back an illegal move that movePGN() made, by calling unmove to put the pieces back and then restoring the
+   # state saved before the move and the history.  The move listener doesn't hear about the pieces going back.
+   def _take_back(self, saved, unmove):
+      callback = self.callback
+      self.callback = None
       
-         if move[-1] == '+':
-            self.check = self.to_play
-         else:
-            self.check = None
-      # King-side castle
-      elif move.startswith('O-O'):
-         if self.to_play == Board.WHITE and type(self.pieces[self._rf_to_index(0, 4)]) == King and \
-            type(self.pieces[self._rf_to_index(0, 7)]) == Rook and \
-            self.pieces[self._rf_to_index(0, 5)] == None and \
-            self.pieces[self._rf_to_index(0, 6)] == None:
-            self.move((0, 7), (0, 5))
-            self.move((0, 4), (0, 6))
-         elif self.to_play == Board.BLACK and type(self.pieces[self._rf_to_index(7, 4)]) == King and \
-            type(self.pieces[self._rf_to_index(7, 7)]) == Rook and \
-            self.pieces[self._rf_to_index(7, 5)] == None and \
-            self.pieces[self._rf_to_index(7, 6)] == None:
-            self.move((7, 7), (7, 5))
-            self.move((7, 4), (7, 6))
+      try:
+         unmove()
+      finally:
+         self.callback = callback
+      
+      (self.en_passant_target, self.castling, self.check, self.halfmove_clock, self.fullmove_number,
+       self.to_play) = saved
+      self.history.pop()
+   
+   # Put a piece that moved from src to dest back, along with the pieces the move removed, given as (piece, square,
+   # index in by_piece) tuples.  A promoted pawn is among the removed pieces, and the piece it became is taken away.
+   def _unmove(self, piece, src, dest, removed):
+      if self.pieces[Board._arg_to_index(dest)] is piece:
+         self.move(dest, src)
+      else:
+         self.take(dest)
+      
+      for taken, square, index in removed:
+         self.put(taken, square)
+         pieces = self.by_piece[taken.name][taken.color]
+         pieces.remove(taken)
+         pieces.insert(index, taken)
+      
+   # Make sure the side that just moved didn't leave its king attacked, whether it was in check or not, and record
+   # whether the side to play is in check.  The + and # of the move text aren't trusted either way.
+   def _verify_check(self, move):
+      mover = Board.BLACK if self.to_play == Board.WHITE else Board.WHITE
+      
+      if self._in_check(mover):
+         if self.check == mover:
+            raise ValueError('Check not resolved by %s' % move)
+         
+         raise ValueError('King left in check by %s' % move)
+      
+      self.check = self.to_play if self._in_check(self.to_play) else None
+   
+   # Do what _verify_check() does for a move by a piece other than the king, that isn't a promotion, by a side that
+   # wasn't in check.  The mover's king can then only be attacked along a line the move opened, and the other king
+   # only by the piece that moved or along a line the move opened.
+   def _verify_lines(self, move, piece, vacated):
+      mover = piece.color
+      king = self.by_piece['K'][mover]
+      enemy = self.by_piece['K'][self.to_play]
+      self.check = None
+      
+      if king != None:
+         king_square = king.file * 8 + king.rank
+         
+         for i in vacated:
+            attacker, kind = self._first_on_line(king_square, i)
+            
+            if attacker != None and attacker.color != mover and attacker.name in (kind, 'Q'):
+               raise ValueError('King left in check by %s' % move)
+      
+      if enemy == None:
+         return
+      
+      enemy_square = enemy.file * 8 + enemy.rank
+      dest = piece.file * 8 + piece.rank
+      
+      ranks = enemy.rank - piece.rank
+      files = abs(enemy.file - piece.file)
+      
+      if piece.name == 'P':
+         check = files == 1 and ranks == (1 if mover == Board.WHITE else -1)
+      elif piece.name == 'N':
+         check = (abs(ranks), files) in ((1, 2), (2, 1))
+      else:
+         attacker, kind = self._first_on_line(enemy_square, dest)
+         check = attacker is piece and piece.name in (kind, 'Q')
+      
+      for i in vacated:
+         if not check:
+            attacker, kind = self._first_on_line(enemy_square, i)
+            check = attacker != None and attacker.color == mover and attacker.name in (kind, 'Q')
+      
+      if check:
+         self.check = self.to_play
+   
+   # Return the first piece on the line from square k through square i, looking outward from k, and the letter of the
+   # piece that attacks along the line, 'R' or 'B'.  Return (None, None) if i isn't on a line from k.
+   def _first_on_line(self, k, i):
+      line = (Board._lines[k] or _build_line(k)).get(i)
+      
+      if line == None:
+         return (None, None)
+      
+      ray, kind = line
+      
+      for j in ray:
+         if self.pieces[j] != None:
+            return (self.pieces[j], kind)
+      
+      return (None, kind)
+   
+   # Return whether the king of the given color is attacked, looking outward from its square.
+   def _in_check(self, color):
+      king = self.by_piece['K'][color]
+      
+      return king != None and self._attacked_by(king.file * 8 + king.rank,
+                                                Board.BLACK if color == Board.WHITE else Board.WHITE)
+   
+   """
+   Return whether the side to play is in check.  This is worked out from the board, not from how moves were written.
+   """
+   def is_check(self):
+      return self._in_check(self.to_play)
+   
+   """
+   Return whether the side to play is checkmated.
+   """
+   def is_checkmate(self):
+      return self._in_check(self.to_play) and not self._has_legal_move()
+   
+   """
+   Return whether the side to play is stalemated.
+   """
+   def is_stalemate(self):
+      return not self._in_check(self.to_play) and not self._has_legal_move()
+   
+   # Return whether the side to play has any legal move, stopping at the first one found.
+   def _has_legal_move(self):
+      color = self.to_play
+      other = Board.BLACK if color == Board.WHITE else Board.WHITE
+      
+      for move in self._safe_moves(color, other, None):
+         return True
+      
+      return bool(self._legal_castles(color, other, None))
+   
+   """
+   Finish a move by handing the turn to the other side and updating the move counters and the position history.  The
+   key is the hash_key() of the position before the move, and irreversible is whether the move was a capture or a
+   pawn move, which resets the halfmove clock.
+   """
+   def _end_move(self, key, irreversible):
+      self.history.append(key)
+      
+      if irreversible:
+         self.halfmove_clock = 0
+      else:
+         self.halfmove_clock += 1
+      
+      if self.to_play == Board.WHITE:
+         self.to_play = Board.BLACK
+      else:
+         self.to_play = Board.WHITE
+         self.fullmove_number += 1
+   
+   """
+   Work out how the side to play would castle on the given side.  Return a tuple of the king's square, the rook's
+   square, and their destinations, or None if the castle isn't possible.  The king always ends up on the c or g file
+   and the rook next to it on the d or f file, wherever they start, so every square between either piece and its
+   destination must be empty but for the two of them, and none of the squares the king crosses may be attacked.
+   """
+   def _castle_plan(self, queenside):
+      rights = self.castling_rights()
+      
+      for bit, color, king_square, rook_square in self._castle_squares:
+         if color != self.to_play or not rights & bit or (rook_square < king_square) != queenside:
+            continue
+         
+         rank = king_square & 7
+         king_dest = (2 if queenside else 6) * 8 + rank
+         rook_dest = (3 if queenside else 5) * 8 + rank
+         files = (king_square >> 3, rook_square >> 3, king_dest >> 3, rook_dest >> 3)
+         
+         for f in range(min(files), max(files) + 1):
+            i = f * 8 + rank
+            
+            if i != king_square and i != rook_square and self.pieces[i] != None:
+               return None
+         
+         # Lift both pieces so that neither hides an attack on the squares the king crosses.
+         other = Board.BLACK if color == Board.WHITE else Board.WHITE
+         king = self.pieces[king_square]
+         rook = self.pieces[rook_square]
+         self.pieces[king_square] = self.pieces[rook_square] = None
+         step = 8 if king_dest >= king_square else -8
+         safe = True
+         
+         for i in range(king_square, king_dest + step, step):
+            if self._attacked_by(i, other):
+               safe = False
+               break
+         
+         self.pieces[king_square] = king
+         self.pieces[rook_square] = rook
+         
+         if safe:
+            return (king_square, rook_square, king_dest, rook_dest)
+      
+      return None
+   
+   """
+   Castle by moving the king and rook between the given squares.  The move listener hears about the rook first and the
+   king last.
+   """
+   def _castle_move(self, king_square, rook_square, king_dest, rook_dest):
+      king = self.pieces[king_square]
+      rook = self.pieces[rook_square]
+      self.pieces[king_square] = self.pieces[rook_square] = None
+      self.pieces[rook_dest] = rook
+      self.pieces[king_dest] = king
+      self.zobrist ^= self._zobrist_piece(king, king.rank, king.file) ^ self._zobrist_piece(rook, rook.rank, rook.file)
+      king.move(*Board._square_rf[king_dest])
+      rook.move(*Board._square_rf[rook_dest])
+      self.zobrist ^= self._zobrist_piece(king, king.rank, king.file) ^ self._zobrist_piece(rook, rook.rank, rook.file)
+      self._attacks = {}
+      self.castling &= self._castle_masks[king_square] & self._castle_masks[rook_square]
+      
+      if self.callback:
+         self.callback(rook, Board._square_rf[rook_square], Board._square_rf[rook_dest])
+         self.callback(king, Board._square_rf[king_square], Board._square_rf[king_dest])
+   
+   """
+   Return the castling rights that are still in effect as a mask of Board.WHITE_KINGSIDE, Board.WHITE_QUEENSIDE,
+   Board.BLACK_KINGSIDE, and Board.BLACK_QUEENSIDE.  A right only counts if its king and rook are on their home
+   squares.
+   """
+   def castling_rights(self):
+      # Rights are only ever lost by moving, so once they've been checked against the board they stay correct until
+      # another piece is put on it.
+      if not self._castling_checked:
+         rights = 0
+         
+         for bit, color, king_square, rook_square in self._castle_squares:
+            king = self.pieces[king_square]
+            rook = self.pieces[rook_square]
+            
+            if self.castling & bit and type(king) == King and king.color == color and type(rook) == Rook and \
+               rook.color == color:
+               rights |= bit
+         
+         self.castling = rights
+         self._castling_checked = True
+      
+      return self.castling
+   
+   """
+   Return how many times the current position has occurred in the game, counting this occurrence.  Only the positions
+   since the last capture or pawn move are searched, because nothing before them can repeat.
+   """
+   def repetitions(self):
+      key = self.hash_key()
+      count = 1
+      
+      for i in range(len(self.history) - 2, len(self.history) - self.halfmove_clock - 1, -2):
+         if i < 0:
+            break
+         
+         if self.history[i] == key:
+            count += 1
+      
+      return count
+   
+   """
+   Return whether the game can be claimed drawn by threefold repetition or the fifty-move rule.
+   """
+   def is_draw_claimable(self):
+      return self.halfmove_clock >= 100 or self.repetitions() >= 3
+   
+   """
+   Return the legal moves of the side to play as a list of SAN strings that movePGN() accepts.  Moves that give check
+   are marked with "+".
+   """
+   def legal_moves(self):
+      color = self.to_play
+      other = Board.BLACK if color == Board.WHITE else Board.WHITE
+      enemy = self.by_piece['K'][other]
+      
+      if self.by_piece['K'][color] == None:
+         return []
+      
+      enemy_square = enemy.file * 8 + enemy.rank if enemy != None else None
+      found = list(self._safe_moves(color, other, enemy_square))
+      ret = []
+      
+      for piece, src, dest, capture, check in found:
+         san = ''
+         
+         if piece.name == 'P':
+            if capture:
+               san = Board.SQUARE_NAMES[src][0]
          else:
-            raise ValueError('Castle is not possible')
+            san = piece.name
+            rivals = [f[1] for f in found if f[0].name == piece.name and f[2] == dest and f[0] is not piece]
+            
+            if rivals:
+               if not [r for r in rivals if r >> 3 == src >> 3]:
+                  san += Board.SQUARE_NAMES[src][0]
+               elif not [r for r in rivals if r & 7 == src & 7]:
+                  san += Board.SQUARE_NAMES[src][1]
+               else:
+                  san += Board.SQUARE_NAMES[src]
          
-         # Toggle who's turn it is
-         if self.to_play == Board.WHITE:
-            self.to_play = Board.BLACK
+         if capture:
+            san += 'x'
+         
+         san += Board.SQUARE_NAMES[dest]
+         
+         if piece.name == 'P' and (dest & 7 == 7 or dest & 7 == 0):
+            for promotion in 'QRBN':
+               promoted = san + '=' + promotion
+               
+               if check or self._promotion_checks(src, dest, promotion, enemy_square):
+                  promoted += '+'
+               
+               ret.append(promoted)
          else:
-            self.to_play = Board.WHITE
+            ret.append(san + '+' if check else san)
       
-         if move[-1] == '+':
-            self.check = self.to_play
-         else:
-            self.check = None
-      else:
-         raise ValueError('Bad move definition: %s' % move)
+      ret.extend(self._legal_castles(color, other, enemy_square))
       
+      return ret
+   
+   # Yield the moves of the given color, other than castling, that don't leave its king attacked, each as a tuple of
+   # (piece, src, dest, whether it captures, whether it gives check), with squares as indexes into Board.pieces.  Checks
+   # are only looked for if the square of the enemy king is given.
+   def _safe_moves(self, color, other, enemy_square):
+      pieces = self.pieces
+      king = self.by_piece['K'][color]
+      
+      if king == None:
+         return
+      
+      king_square = king.file * 8 + king.rank
+      enemy = self.by_piece['K'][other]
+      
+      for name in 'PNBRQK':
+         group = self.by_piece[name][color]
+         
+         if name == 'K':
+            group = [group]
+         
+         for piece in group:
+            src = piece.file * 8 + piece.rank
+            
+            if name == 'P':
+               targets = [r + f * 8 for r, f in piece.reaches()]
+               
+               if self.en_passant_target != None:
+                  rank, file, pawn_rank = self.en_passant_target
+                  
+                  if file * 8 + rank in Board._pawn_targets[color][src]:
+                     targets.append(file * 8 + rank)
+            else:
+               targets = [j for j in piece.cover_indices() if pieces[j] == None or pieces[j].color != color]
+            
+            for dest in targets:
+               captured = dest
+               
+               if name == 'P' and pieces[dest] == None and dest >> 3 != src >> 3:
+                  captured = (dest & ~7) | self.en_passant_target[2]
+               
+               if pieces[captured] != None and pieces[captured] is enemy:
+                  continue
+               
+               # Make the move on the squares alone to see whether it leaves the king attacked.
+               taken = pieces[captured]
+               pieces[captured] = None
+               pieces[dest] = piece
+               pieces[src] = None
+               safe = not self._attacked_by(dest if name == 'K' else king_square, other)
+               check = safe and enemy_square != None and self._attacked_by(enemy_square, color)
+               pieces[src] = piece
+               pieces[dest] = None
+               pieces[captured] = taken
+               
+               if safe:
+                  yield (piece, src, dest, taken != None, check)
+   
+   """
+   Return whether a pawn promoting to the given piece by moving from src to dest attacks the square of the enemy king.
+   """
+   def _promotion_checks(self, src, dest, promotion, enemy_square):
+      if enemy_square == None:
+         return False
+      
+      if promotion == 'N':
+         return enemy_square in Board._knight_targets[dest]
+      
+      rays = {'Q': Board._queen_rays, 'R': Board._rook_rays, 'B': Board._bishop_rays}[promotion][dest]
+      
+      for ray in rays:
+         for j in ray:
+            if j == enemy_square:
+               return True
+            elif self.pieces[j] != None and j != src:
+               break
+      
+      return False
+   
+   """
+   Return the castling moves open to the given color as SAN strings.
+   """
+   def _legal_castles(self, color, other, enemy_square):
+      ret = []
+      
+      for queenside, san in ((False, 'O-O'), (True, 'O-O-O')):
+         castle = self._castle_plan(queenside)
+         
+         if castle == None:
+            continue
+         
+         # The rook is the only piece that can give check after castling.
+         king_square, rook_square, king_dest, rook_dest = castle
+         king = self.pieces[king_square]
+         rook = self.pieces[rook_square]
+         self.pieces[king_square] = self.pieces[rook_square] = None
+         self.pieces[rook_dest] = rook
+         self.pieces[king_dest] = king
+         check = enemy_square != None and self._attacked_by(enemy_square, color)
+         self.pieces[rook_dest] = self.pieces[king_dest] = None
+         self.pieces[king_square] = king
+         self.pieces[rook_square] = rook
+         
+         ret.append(san + '+' if check else san)
+      
+      return ret
+   
+   """
+   Return whether any piece of the given color attacks square i of Board.pieces.  The answer comes from the pieces
+   array alone, by looking outward from the square, so it stays correct while squares are changed temporarily.
+   """
+   def _attacked_by(self, i, color):
+      pieces = self.pieces
+      other = Board.BLACK if color == Board.WHITE else Board.WHITE
+      
+      # A pawn attacks this square from the squares a pawn of the other color standing here would attack.
+      for j in Board._pawn_targets[other][i]:
+         p = pieces[j]
+         
+         if p != None and p.color == color and p.name == 'P':
+            return True
+      
+      for j in Board._knight_targets[i]:
+         p = pieces[j]
+         
+         if p != None and p.color == color and p.name == 'N':
+            return True
+      
+      for j in Board._king_targets[i]:
+         p = pieces[j]
+         
+         if p != None and p.color == color and p.name == 'K':
+            return True
+      
+      for rays, slider in ((Board._rook_rays[i], 'R'), (Board._bishop_rays[i], 'B')):
+         for ray in rays:
+            for j in ray:
+               p = pieces[j]
+               
+               if p != None:
+                  if p.color == color and (p.name == slider or p.name == 'Q'):
+                     return True
+                  
+                  break
+      
+      return False
+   
+   """
+   Return the material the given color, by default the side to play, can win by capturing on the given position and
+   trading off there for as long as it pays, or 0 if nothing can be won.  The position can be a tuple of (rank, file),
+   text, e.g. "d4", or a square number.  Attackers lined up behind others, such as doubled rooks, join in once the
+   pieces in front of them have captured.  Pins and checks are ignored, as is usual for static exchange evaluation.
+   """
+   def see(self, position, color=None):
+      i = Board._arg_to_index(position)
+      target = self.pieces[i]
+      
+      if color == None:
+         color = self.to_play
+      
+      if target == None or target.color == color:
+         return 0
+      
+      return self._swap(i, color, Board.PIECE_VALUES[target.name], set())
+   
+   """
+   Return the material the side to play wins by making the given move, a PGN code, and then trading off on the
+   destination square for as long as it pays either side.  A negative value means the move loses material, as when a
+   queen takes a defended pawn, and a quiet move scores 0 or less by whether the piece is safe where it lands.  A
+   ValueError is raised if the move isn't possible.
+   """
+   def see_move(self, move):
+      src, rf, capture, i, promotion, check = Board.parse_move(move)
+      
+      if i == None:
+         return 0
+      
+      piece = self._find_piece(src, Board._square_rf[i], rf, capture)
+      
+      if not piece:
+         raise ValueError('Move is not possible: %s' % move)
+      
+      gone = set([piece.file * 8 + piece.rank])
+      gain = 0
+      moved = Board.PIECE_VALUES[piece.name]
+      
+      if self.pieces[i] != None:
+         gain = Board.PIECE_VALUES[self.pieces[i].name]
+      elif capture and piece.name == 'P':
+         # En passant, where the captured pawn leaves a square that may open a line onto the destination
+         gain = Board.PIECE_VALUES['P']
+         gone.add(i - 1 if piece.color == Board.WHITE else i + 1)
+      
+      if promotion:
+         moved = Board.PIECE_VALUES[promotion]
+         gain += moved - Board.PIECE_VALUES['P']
+      
+      other = Board.BLACK if piece.color == Board.WHITE else Board.WHITE
+      
+      return gain - self._swap(i, other, moved, gone)
+   
+   """
+   Return the pieces of the given color that the other side can win material by capturing.
+   """
+   def hanging_pieces(self, color):
+      other = Board.BLACK if color == Board.WHITE else Board.WHITE
+      pieces = [self.by_piece['K'][color]] if self.by_piece['K'][color] != None else []
+      
+      for name in 'PNBRQ':
+         pieces += self.by_piece[name][color]
+      
+      return [p for p in pieces if p.name != 'K' and self.see(p.file * 8 + p.rank, other) > 0]
+   
+   # Play out the captures on square i, starting with the given color and alternating, each side capturing with its
+   # least valuable attacker, and return what the starting color gains by stopping at the best point.  The value is
+   # that of the piece standing on the square, and gone holds the squares of pieces that have already moved there.
+   def _swap(self, i, color, value, gone):
+      other = Board.BLACK if color == Board.WHITE else Board.WHITE
+      gains = []
+      j = self._least_attacker(i, color, gone)
+      
+      while j != None:
+         gains.append(value)
+         value = Board.PIECE_VALUES[self.pieces[j].name]
+         gone.add(j)
+         color, other = other, color
+         j = self._least_attacker(i, color, gone)
+      
+      # Each side only captures if it comes out ahead of stopping.
+      score = 0
+      
+      for gain in reversed(gains):
+         score = max(0, gain - score)
+      
+      return score
+   
+   # Return the square of the least valuable piece of the given color that attacks square i, looking through the
+   # squares in gone as if they were empty, or None if there's none.
+   def _least_attacker(self, i, color, gone):
+      pieces = self.pieces
+      other = Board.BLACK if color == Board.WHITE else Board.WHITE
+      
+      for j in Board._pawn_targets[other][i]:
+         p = pieces[j]
+         
+         if p != None and p.color == color and p.name == 'P' and j not in gone:
+            return j
+      
+      for j in Board._knight_targets[i]:
+         p = pieces[j]
+         
+         if p != None and p.color == color and p.name == 'N' and j not in gone:
+            return j
+      
+      best = None
+      
+      for rays, slider in ((Board._bishop_rays[i], 'B'), (Board._rook_rays[i], 'R')):
+         for ray in rays:
+            for j in ray:
+               p = pieces[j]
+               
+               if p != None and j not in gone:
+                  if p.color == color and (p.name == slider or p.name == 'Q') and \
+                     (best == None or Board.PIECE_VALUES[p.name] < Board.PIECE_VALUES[pieces[best].name]):
+                     best = j
+                  
+                  break
+      
+      if best != None:
+         return best
+      
+      for j in Board._king_targets[i]:
+         p = pieces[j]
+         
+         if p != None and p.color == color and p.name == 'K' and j not in gone:
+            return j
+      
+      return None
+   
+   """
+   Return a copy of this board that can be played on independently.  The copy keeps the position, the move clocks,
+   and the history, but not the move listener.  Each piece is copied with its id, in the order of by_piece, so the
+   pieces of the copy have the same nodename() as the pieces they were copied from.
+   """
+   def copy(self):
+      b = Board()
+      
+      for name in 'KQRBNP':
+         for color in (Board.WHITE, Board.BLACK):
+            pieces = self.by_piece[name][color]
+            
+            for piece in ([pieces] if name == 'K' else pieces):
+               if piece != None:
+                  type(piece)(b, piece.rank, piece.file, color, piece.id)
+      
+      b.to_play = self.to_play
+      b.castling = self.castling
+      b._castling_checked = self._castling_checked
+      b.en_passant_target = self.en_passant_target
+      b._castle_squares = self._castle_squares
+      b._castle_masks = self._castle_masks
+      b.check = self.check
+      b.halfmove_clock = self.halfmove_clock
+      b.fullmove_number = self.fullmove_number
+      b.history = list(self.history)
+      
+      return b
+   
    """
    Set which color is to play next.
    """
    def set_to_play(self, color):
       self.to_play = color
    
+   """
+   Return a 64-bit Zobrist hash of this position.  Besides the piece placement, the hash covers the side to play and,
+   following the Polyglot convention, the en passant file when a pawn is actually in place to make the capture.
+   Unlike encode(), equal positions reached by different move orders hash the same without building a string.
+   """
+   def hash_key(self):
+      key = self.zobrist
+      
+      if self.en_passant_target != None:
+         rank, file, pawn_rank = self.en_passant_target
+         
+         for f in (file - 1, file + 1):
+            if f >= 0 and f <= 7:
+               piece = self.pieces[f * 8 + pawn_rank]
+               
+               if type(piece) == Pawn and piece.color == self.to_play:
+                  key ^= Board._zobrist_keys[772 + file]
+                  break
+      
+      if self.castling:
+         rights = self.castling_rights()
+         
+         for i in range(4):
+            if rights & (1 << i):
+               key ^= Board._zobrist_keys[768 + i]
+      
+      if self.to_play == Board.WHITE:
+         key ^= Board._zobrist_keys[780]
+      
+      return key
+   
+   """
+   Return the Zobrist key for the given piece standing on the given rank and file.
+   """
+   @staticmethod
+   def _zobrist_piece(piece, rank, file):
+      kind = 2 * Board._zobrist_kinds[piece.name] + (piece.color == Board.WHITE)
+      
+      return Board._zobrist_keys[64 * kind + 8 * rank + file]
+   
+   """
+   Pack a move into 16 bits the way Polyglot books do.  The src and dest are (rank, file) tuples and the promotion,
+   if any, is the letter of the piece promoted to.  The code 0 never describes a real move.
+   """
+   @staticmethod
+   def move_code(src, dest, promotion=None):
+      return dest[1] | (dest[0] << 3) | (src[1] << 6) | (src[0] << 9) | (Board._promotion_codes[promotion] << 12)
+   
+   """
+   Unpack a move code made by move_code() into a tuple of (src, dest, promotion).
+   """
+   @staticmethod
+   def move_from_code(code):
+      promotion = None
+      
+      for letter, value in Board._promotion_codes.items():
+         if value == (code >> 12) & 7:
+            promotion = letter
+      
+      return (((code >> 9) & 7, (code >> 6) & 7), ((code >> 3) & 7, code & 7), promotion)
+   
    """
    Return a string that uniquely represents this board position.
    """
@@ -329,8 +1275,37 @@ class Board(object):
       return encoding
    
    #DF: SHANNON's evaluation function
+   """
+   Score the position as a dict of the score for each color, which is the sum of features() weighed by
+   Board.EVAL_WEIGHTS for white, and its negation for black.  Positions the tablebase covers get its score instead.
+   The features are looked up in Board.eval_cache when it's set.
+   """
    def evaluate(self):
+      if Board.tablebase != None:
+         probe = Board.tablebase.probe(self)
+         
+         if probe != None:
+            score = probe[0] * (Board.TABLEBASE_WIN - probe[1])
+            
+            if self.to_play != Board.WHITE:
+               score = -score
+            
+            return {Board.WHITE: score, Board.BLACK: -score}
+      
+      weights = Board.EVAL_WEIGHTS
+      features = Board.eval_cache.features(self) if Board.eval_cache != None else self.features()
+      score = 0
+      
+      for name, value in zip(Board.EVAL_FEATURES, features):
+         score += weights[name] * value
       
+      return {Board.WHITE: score, Board.BLACK: -score}
+   
+   """
+   Return the terms evaluate() weighs, in the order of Board.EVAL_FEATURES, as a list of white's count less black's:
+   kings, queens, rooks, bishops, knights, pawns, doubled pawns, backward pawns, isolated pawns, and mobility.
+   """
+   def features(self):
       kings={}
       queens={}
       rooks={}
@@ -368,11 +1343,9 @@ class Board(object):
       
       for r in range(8):
          for f in range(8):
-            piece = self.get((r,f))
+            piece = self.pieces[f * 8 + r]
             
             if piece!=None:
-               mobility[piece.color] += self.mobility(piece)
-               
                if type(piece) == Pawn:
                   is_isolated = True
                   is_doubled = False
@@ -382,19 +1355,19 @@ class Board(object):
                   if piece.file>0:
                      i=0
                      while i<8 and is_isolated:
-                        neighbor = self.get((i, piece.file-1))
+                        neighbor = self.pieces[(piece.file-1) * 8 + i]
                         i+=1
                         if type(neighbor)==Pawn and neighbor.color==piece.color:
                            is_isolated = not is_isolated
                      
                      if piece.rank<6 and piece.color==Board.WHITE:      
-                        piece1 = self.get((piece.rank+1, piece.file-1))
-                        piece2 = self.get((piece.rank+2, piece.file-1))
+                        piece1 = self.pieces[(piece.file-1) * 8 + piece.rank+1]
+                        piece2 = self.pieces[(piece.file-1) * 8 + piece.rank+2]
                         if not is_backward and piece.color==Board.WHITE and type(piece1)==Pawn and piece1.color==Board.WHITE and type(piece2)==Pawn and piece2.color==Board.BLACK:
                            is_backward = not is_backward
                      if piece.rank>1 and piece.color==Board.BLACK:      
-                        piece1 = self.get((piece.rank-1, piece.file-1))
-                        piece2 = self.get((piece.rank-2, piece.file-1))
+                        piece1 = self.pieces[(piece.file-1) * 8 + piece.rank-1]
+                        piece2 = self.pieces[(piece.file-1) * 8 + piece.rank-2]
                         if not is_backward and piece.color==Board.WHITE and type(piece1)==Pawn and piece1.color==Board.WHITE and type(piece2)==Pawn and piece2.color==Board.BLACK:
                            is_backward = not is_backward
                   
@@ -402,25 +1375,25 @@ class Board(object):
                   if piece.file<7:
                      i=0
                      while i<8 and is_isolated:
-                        neighbor = self.get((i, piece.file+1))
+                        neighbor = self.pieces[(piece.file+1) * 8 + i]
                         i+=1
                         if type(neighbor)==Pawn and neighbor.color==piece.color:
                            is_isolated = not is_isolated
                      
                      if piece.rank<6 and piece.color==Board.WHITE:      
-                        piece1 = self.get((piece.rank+1, piece.file+1))
-                        piece2 = self.get((piece.rank+2, piece.file+1))
+                        piece1 = self.pieces[(piece.file+1) * 8 + piece.rank+1]
+                        piece2 = self.pieces[(piece.file+1) * 8 + piece.rank+2]
                         if not is_backward and piece.color==Board.WHITE and type(piece1)==Pawn and piece1.color==Board.WHITE and type(piece2)==Pawn and piece2.color==Board.BLACK:
                            is_backward = not is_backward
                      if piece.rank>1 and piece.color==Board.BLACK:      
-                        piece1 = self.get((piece.rank-1, piece.file+1))
-                        piece2 = self.get((piece.rank-2, piece.file+1))
+                        piece1 = self.pieces[(piece.file+1) * 8 + piece.rank-1]
+                        piece2 = self.pieces[(piece.file+1) * 8 + piece.rank-2]
                         if not is_backward and piece.color==Board.WHITE and type(piece1)==Pawn and piece1.color==Board.WHITE and type(piece2)==Pawn and piece2.color==Board.BLACK:
                            is_backward = not is_backward 
                   #check same file 
                   i=0
                   while i<8 and not is_doubled:
-                     neighbor = self.get(self._rf_to_position(i, piece.file))
+                     neighbor = self.pieces[piece.file * 8 + i]
                      i+=1
                      if type(neighbor)==Pawn and neighbor.color==piece.color and neighbor!=piece:
                         is_doubled = not is_doubled
@@ -429,24 +1402,105 @@ class Board(object):
                   doubled_pawns[piece.color]+=1*is_doubled
                   backward_pawns[piece.color]+=1*is_backward
                
-      eval_f = {}
-      eval_f[Board.WHITE] = 200*(kings[Board.WHITE]-kings[Board.BLACK]) + 9*(queens[Board.WHITE]-queens[Board.BLACK]) + \
-                     5*(rooks[Board.WHITE]-rooks[Board.BLACK]) + 3*(bishops[Board.WHITE]-bishops[Board.BLACK]+ \
-                     knights[Board.WHITE]-knights[Board.BLACK])+ (pawns[Board.WHITE]-pawns[Board.BLACK]) - \
-                     0.5*(doubled_pawns[Board.WHITE]-doubled_pawns[Board.BLACK]+backward_pawns[Board.WHITE]-backward_pawns[Board.BLACK]+isolated_pawns[Board.WHITE]-isolated_pawns[Board.BLACK]) + \
-                     0.1*(mobility[Board.WHITE]-mobility[Board.BLACK])
-      
-      eval_f[Board.BLACK] = -eval_f[Board.WHITE] 
-      return eval_f
+      # Count each attack on a square that isn't held by the attacker's own side
+      for color in (Board.WHITE, Board.BLACK):
+         counts = self.attack_map(color)
+         
+         for i in range(64):
+            if counts[i] and (self.pieces[i] == None or self.pieces[i].color != color):
+               mobility[color] += counts[i]
+               
+      return [kings[Board.WHITE]-kings[Board.BLACK], queens[Board.WHITE]-queens[Board.BLACK],
+              rooks[Board.WHITE]-rooks[Board.BLACK], bishops[Board.WHITE]-bishops[Board.BLACK],
+              knights[Board.WHITE]-knights[Board.BLACK], pawns[Board.WHITE]-pawns[Board.BLACK],
+              doubled_pawns[Board.WHITE]-doubled_pawns[Board.BLACK], backward_pawns[Board.WHITE]-backward_pawns[Board.BLACK],
+              isolated_pawns[Board.WHITE]-isolated_pawns[Board.BLACK], mobility[Board.WHITE]-mobility[Board.BLACK]]
    
+   """
+   Return the number of squares the given piece covers that aren't held by its own side.  Pawns count the squares
+   they attack rather than the squares they can advance to.
+   """
    def mobility(self, piece):
-      #DF: I have to add the special case for pawns
       mobility = 0
-      for r in range(8):
-         for f in range(8):
-            if r!=piece.rank and f!=piece.file:
-               mobility += 1*piece.reach((r, f))
+      for i in piece.cover_indices():
+         if self.pieces[i] == None or self.pieces[i].color != piece.color:
+            mobility += 1
       return mobility
+   
+   """
+   Return a list of 64 counts, indexed like Board.pieces, of how many pieces of the given color attack each square.
+   The map is built once per position and shared by everything that asks for it until a piece is put, taken, or
+   moved.  It must not be modified.
+   """
+   def attack_map(self, color):
+      attacks = self._attacks.get(color)
+      
+      if attacks == None:
+         attacks = self._build_attacks(color)
+      
+      return attacks[0]
+   
+   """
+   Return the squares attacked by the given color as a bitset, with bit i set if square i of Board.pieces is attacked.
+   """
+   def attack_bits(self, color):
+      attacks = self._attacks.get(color)
+      
+      if attacks == None:
+         attacks = self._build_attacks(color)
+      
+      if attacks[1] == None:
+         bits = 0
+         
+         for i in range(64):
+            if attacks[0][i]:
+               bits |= 1 << i
+         
+         attacks[1] = bits
+      
+      return attacks[1]
+   
+   """
+   Return the pieces of the given color that attack the given position.  The position can be a tuple of (rank, file),
+   text, e.g. "d4", or a square number.
+   """
+   def attackers(self, position, color):
+      i = Board._arg_to_index(position)
+      attacks = self._attacks.get(color)
+      
+      if attacks == None:
+         attacks = self._build_attacks(color)
+      
+      if not attacks[0][i]:
+         return []
+      
+      return [piece for piece, squares in attacks[2] if i in squares]
+   
+   """
+   Build and cache the attack map of the given color as a list of the counts by square, the bitset of attacked
+   squares, which is filled in by attack_bits() when it's first needed, and a list of the (piece, squares covered)
+   pairs the counts were built from.
+   """
+   def _build_attacks(self, color):
+      counts = [0] * 64
+      covers = []
+      pieces = self.by_piece['P'][color] + self.by_piece['N'][color] + self.by_piece['B'][color] + \
+         self.by_piece['R'][color] + self.by_piece['Q'][color]
+      
+      if self.by_piece['K'][color] != None:
+         pieces.append(self.by_piece['K'][color])
+      
+      for piece in pieces:
+         squares = piece.cover_indices()
+         covers.append((piece, squares))
+         
+         for i in squares:
+            counts[i] += 1
+      
+      attacks = [counts, None, covers]
+      self._attacks[color] = attacks
+      
+      return attacks
             
    
    """
@@ -460,115 +1514,58 @@ class Board(object):
       rank = None
       file = None
       
-      # If there's a disambiguating modifier, as in Nfxd4, then parse it.
-      if modifier:
-         try:
-            rank = int(modifier) - 1
-         except ValueError:
-            file = ord(modifier) - 97
-            
-      if (rank and (rank < 0 or rank > 7)) or (file and (file < 0 or file > 7)):
-         raise ValueError("Bad piece identifier: %s" % dest)
+      # If there's a disambiguating modifier, as in Nfxd4, N5xd4, or Nf5xd4, then parse it.
+      for c in modifier:
+         if '1' <= c <= '8':
+            rank = ord(c) - 49
+         elif 'a' <= c <= 'h':
+            file = ord(c) - 97
+         else:
+            raise ValueError("Bad piece identifier: %s" % dest)
       
       ret = None
-      pinned = []
       
       # King's work differently, so handle everything else separately.
       if src != 'K':
-         # Get the list of pieces that can't move.
-         pinned = self._get_pinned(dest)
-
-         # If there's a modifier that disambiguates by rank, find a piece on the given rank that's not pinned
-         # that can reach the destination.
-         if rank != None:
-            for piece in list:
-               if piece.rank == rank and piece.reach(dest, capture) and piece not in pinned:
-                  ret = piece
-                  break
-         # If there's a modifier that disambiguates by file, find a piece on the given file that's not pinned
-         # that can reach the destination.
-         elif file != None:
-            for piece in list:
-               if piece.file == file and piece.reach(dest, capture) and piece not in pinned:
-                  ret = piece
-                  break
-         # Otherwise, just find a piece that can reach the destination and isn't pinned.
-         else:
-            for piece in list:
-               if piece.reach(dest, capture) and piece not in pinned:
-                  ret = piece
-                  break
+         # Find a piece that's not pinned that can reach the destination, on the rank and file the modifier gives,
+         # if any.
+         for piece in list:
+            if (rank == None or piece.rank == rank) and (file == None or piece.file == file) and \
+               piece.reach(dest, capture) and not self._is_pinned(piece, Board._arg_to_index(dest)):
+               ret = piece
+               break
       # Kings are easy: if they can reach the destination, they're the piece we want.
       elif self.by_piece[src][self.to_play].reach(self._arg_to_rf(dest), capture):
          ret = self.by_piece[src][self.to_play]
                
       return ret
    
-   """
-   Get the list of pieces that are unable to move because they are pinned.  Most of the time this list will be empty.
-   Rarely will it have more than one entry.  The rf argument is the piece to be excluded from the search, most
-   likely because it's the piece being captured.
-   """
-   def _get_pinned(self, rf=None):
-      pinned = set()
-      rank, file = rf
-      other_color = Board.WHITE
+   # Return whether a piece is pinned to its king, so that it can't move to square i of Board.pieces.  A pinned piece
+   # can still move along the line of the pin.
+   def _is_pinned(self, piece, i):
+      king = self.by_piece['K'][piece.color]
       
-      if self.to_play == Board.WHITE:
-         other_color = Board.BLACK
-         
-      king = self.by_piece['K'][self.to_play]
+      if king == None:
+         return False
       
-      # Look at all of the opponent's rooks, bishops, and queens, and determine if any of them have any
-      # pieces pinned.
-      for piece in self.by_piece['R'][other_color]:
-         pinnee = piece.pinned()
-         
-         # Once we have the pinned piece, we check to see if it's moving along the line of the pin.
-         # If it is, then we don't declare it pinned because for this move, it effectively isn't.
-         if pinnee and ((piece.rank == king.rank and rank != king.rank) or \
-            (piece.file == king.file and file != king.file)):
-            # A piece can only be pin and be pinned once
-            pinned.add(pinnee)
-
-      for piece in self.by_piece['B'][other_color]:
-         pinnee = piece.pinned()
-         
-         # Once we have the pinned piece, we check to see if it's moving along the line of the pin.
-         # If it is, then we don't declare it pinned because for this move, it effectively isn't.
-         # The logic here is pretty complicated.  The idea is that the line of the pin can be represented as the
-         # slope of the line between the pinning piece and the king.  If the slope of the line between the move
-         # destination and the king isn't the same, then it's not along the line of the pin.  The one place where
-         # this fails is if the pinned piece jumps to the other side of the pinning piece or king, which thankfully
-         # is against the rules.  Only the knight can jump other pieces, but a knight couldn't stay on the pin line.
-         #
-         # Let me also explain the logic of how I'm testing that.  To avoid divide by zero errors, we don't calculate
-         # the slope directly.  First, we make sure the destination is on the pin line.  If it is, we can reduce the
-         # slope to either 1 or -1, which let's us arrange the math differently.  The max() in the comparison is to
-         # avoid divide by zero.  When the value in the denominator would otherwise be 0, the value in the
-         # numerator is also zero, which means we don't care what's in the denominator.
-         if pinnee and not (rank == piece.rank and file == piece.file) and (abs(rank - king.rank) != abs(file - king.file) or \
-            ((rank - king.rank) / max(1, abs(rank - king.rank)) != (piece.rank - rank) / max(1, abs(piece.rank - rank))) or \
-            ((file - king.file) / max(1, abs(file - king.file)) != (piece.file - file) / max(1, abs(piece.file - file)))):
-            # A piece can only be pin and be pinned once
-            pinned.add(pinnee)
-
-      for piece in self.by_piece['Q'][other_color]:
-         pinnee = piece.pinned()
-         
-         # Once we have the pinned piece, we check to see if it's moving along the line of the pin.
-         # If it is, then we don't declare it pinned because for this move, it effectively isn't.
-         # See the comment for the bishop above.
-         if pinnee and not (rank == piece.rank and file == piece.file) and ((piece.rank == king.rank and rank != king.rank) or \
-            (piece.file == king.file and file != king.file) or \
-            ((piece.rank != king.rank and piece.file != king.file) and \
-            (abs(rank - king.rank) != abs(file - king.file) or \
-            ((rank - king.rank) / max(1, abs(rank - king.rank)) != (piece.rank - rank) / max(1, abs(piece.rank - rank))) or \
-            ((file - king.file) / max(1, abs(file - king.file)) != (piece.file - file) / max(1, abs(piece.file - file)))))):
-            # A piece can only be pin and be pinned once
-            pinned.add(pinnee)
-
-      return pinned
+      square = piece.file * 8 + piece.rank
+      lines = Board._lines[king.file * 8 + king.rank] or _build_line(king.file * 8 + king.rank)
+      line = lines.get(square)
+      
+      if line == None or i in line[0]:
+         return False
+      
+      ray, kind = line
+      behind = False
+      
+      for j in ray:
+         if j == square:
+            behind = True
+         elif self.pieces[j] != None:
+            # The first piece past this one pins it if it's an enemy that attacks along the line.
+            return behind and self.pieces[j].color != piece.color and self.pieces[j].name in (kind, 'Q')
+      
+      return False
    
    """
    Return the Board and all pieces as a printable string.
@@ -633,6 +1630,241 @@ class Board(object):
             Pawn(b, rank, file, Board.BLACK)
             
       return b
+   
+   """
+   Create a board from a position in Forsyth-Edwards Notation.  The castling field may name the rooks by their files,
+   as in Shredder-FEN and X-FEN, which is how Chess960 positions give rooks that aren't on the a and h files.  K and
+   Q stand for the outermost rook on each side of the king.  The move counters may be left out.
+   """
+   @staticmethod
+   def from_fen(fen):
+      types = {'P': Pawn, 'N': Knight, 'B': Bishop, 'R': Rook, 'Q': Queen, 'K': King}
+      fields = fen.split()
+      
+      if len(fields) < 4 or len(fields) > 6 or len(fields[0].split('/')) != 8 or fields[1] not in ('w', 'b'):
+         raise ValueError('Bad FEN: %s' % fen)
+      
+      b = Board()
+      
+      for r, row in enumerate(fields[0].split('/')):
+         file = 0
+         
+         for c in row:
+            if c in '12345678':
+               file += int(c)
+            elif c.upper() in types and file < 8:
+               types[c.upper()](b, 7 - r, file, Board.WHITE if c.isupper() else Board.BLACK)
+               file += 1
+            else:
+               raise ValueError('Bad FEN: %s' % fen)
+         
+         if file != 8:
+            raise ValueError('Bad FEN: %s' % fen)
+      
+      if b.by_piece['K'][Board.WHITE] == None or b.by_piece['K'][Board.BLACK] == None:
+         raise ValueError('FEN is missing a king: %s' % fen)
+      
+      if fields[1] == 'b':
+         b.to_play = Board.BLACK
+      
+      b._set_castling(fields[2], fen)
+      
+      if fields[3] != '-':
+         rank, file = Board._arg_to_rf(fields[3])
+         
+         if rank != 2 and rank != 5:
+            raise ValueError('Bad en passant square: %s' % fen)
+         
+         b.en_passant_target = (rank, file, 3 if rank == 2 else 4)
+      
+      try:
+         if len(fields) > 4:
+            b.halfmove_clock = int(fields[4])
+         
+         if len(fields) > 5:
+            b.fullmove_number = int(fields[5])
+      except ValueError:
+         raise ValueError('Bad move counters: %s' % fen)
+      
+      king = b.by_piece['K'][b.to_play]
+      
+      if b._attacked_by(king.file * 8 + king.rank, Board.BLACK if b.to_play == Board.WHITE else Board.WHITE):
+         b.check = b.to_play
+      
+      return b
+   
+   """
+   Set the castling rights from the castling field of a FEN.
+   """
+   def _set_castling(self, field, fen):
+      self.castling = 0
+      self._castling_checked = False
+      
+      if field == '-':
+         return
+      
+      squares = []
+      
+      for c in field:
+         color = Board.WHITE if c.isupper() else Board.BLACK
+         rank = 0 if color == Board.WHITE else 7
+         king = self.by_piece['K'][color]
+         rooks = [r.file for r in self.by_piece['R'][color] if r.rank == rank]
+         
+         if king.rank != rank:
+            raise ValueError('Bad castling rights: %s' % fen)
+         
+         if c in 'Kk':
+            rooks = [f for f in rooks if f > king.file]
+            file = max(rooks) if rooks else None
+         elif c in 'Qq':
+            rooks = [f for f in rooks if f < king.file]
+            file = min(rooks) if rooks else None
+         elif c.lower() in 'abcdefgh' and ord(c.lower()) - 97 in rooks:
+            file = ord(c.lower()) - 97
+         else:
+            file = None
+         
+         if file == None or file == king.file:
+            raise ValueError('Bad castling rights: %s' % fen)
+         
+         if color == Board.WHITE:
+            bit = Board.WHITE_KINGSIDE if file > king.file else Board.WHITE_QUEENSIDE
+         else:
+            bit = Board.BLACK_KINGSIDE if file > king.file else Board.BLACK_QUEENSIDE
+         
+         squares.append((bit, color, king.file * 8 + rank, file * 8 + rank))
+         self.castling |= bit
+      
+      squares = tuple(sorted(squares))
+      
+      if [s for s in squares if s not in Board._castle_squares]:
+         self._castle_squares = squares
+         self._castle_masks = [15] * 64
+         
+         for bit, color, king_square, rook_square in squares:
+            self._castle_masks[king_square] &= ~bit
+            self._castle_masks[rook_square] &= ~bit
+   
+   """
+   Return the position in Forsyth-Edwards Notation.  Castling rights are given as KQkq unless the board castles with
+   rooks other than those in the corners, in which case they're given by the rooks' files, as in Shredder-FEN.
+   """
+   def to_fen(self):
+      rows = []
+      
+      for rank in range(7, -1, -1):
+         row = ''
+         empty = 0
+         
+         for file in range(8):
+            piece = self.pieces[file * 8 + rank]
+            
+            if piece == None:
+               empty += 1
+               continue
+            
+            if empty:
+               row += str(empty)
+               empty = 0
+            
+            row += piece.name if piece.color == Board.WHITE else piece.name.lower()
+         
+         if empty:
+            row += str(empty)
+         
+         rows.append(row)
+      
+      rights = self.castling_rights()
+      castling = ''
+      
+      for bit, color, king_square, rook_square in sorted(self._castle_squares):
+         if rights & bit:
+            if self._castle_squares is Board._castle_squares:
+               c = 'KQkq'[{1: 0, 2: 1, 4: 2, 8: 3}[bit]]
+            else:
+               c = Board.SQUARE_NAMES[rook_square][0]
+               
+               if color == Board.WHITE:
+                  c = c.upper()
+            
+            castling += c
+      
+      en_passant = '-'
+      
+      if self.en_passant_target != None:
+         en_passant = Board.SQUARE_NAMES[self.en_passant_target[1] * 8 + self.en_passant_target[0]]
+      
+      return '%s %s %s %s %d %d' % ('/'.join(rows), 'w' if self.to_play == Board.WHITE else 'b', castling or '-',
+         en_passant, self.halfmove_clock, self.fullmove_number)
+   
+   """
+   Return a compact binary string of Board.PACKED_SIZE bytes that represents this position.  The first 32 bytes hold
+   a 4-bit piece code for each square in Board.pieces order, and the last two record the side to play with the
+   castling rights, and the en passant target.
+   """
+   def pack(self):
+      codes = bytearray(Board.PACKED_SIZE)
+      self.pack_into(codes)
+      
+      return str(codes)
+   
+   """
+   Write the position as pack() returns it into a bytearray or other writable buffer at the given offset, so that
+   many positions can be collected in one preallocated buffer.
+   """
+   def pack_into(self, buffer, offset=0):
+      codes = [0] * 32
+      
+      for i, piece in enumerate(self.pieces):
+         if piece != None:
+            code = Board._pack_codes[piece.name]
+            
+            if piece.color == Board.BLACK:
+               code += 6
+            
+            codes[i >> 1] |= code << (4 * (i & 1))
+      
+      for i in range(32):
+         buffer[offset + i] = codes[i]
+      
+      buffer[offset + 32] = (self.to_play == Board.BLACK) | (self.castling_rights() << 1)
+      buffer[offset + 33] = 0xFF
+      
+      if self.en_passant_target != None:
+         buffer[offset + 33] = self.en_passant_target[0] * 8 + self.en_passant_target[1]
+   
+   """
+   Create a board from a string returned by pack().
+   """
+   @staticmethod
+   def unpack(data):
+      types = (None, Pawn, Knight, Bishop, Rook, Queen, King)
+      codes = bytearray(data)
+      b = Board()
+      
+      for i in range(64):
+         code = (codes[i >> 1] >> (4 * (i & 1))) & 15
+         
+         if code:
+            rank, file = Board._index_to_rf(i)
+            
+            if code > 6:
+               types[code - 6](b, rank, file, Board.BLACK)
+            else:
+               types[code](b, rank, file, Board.WHITE)
+      
+      if codes[32] & 1:
+         b.to_play = Board.BLACK
+      
+      b.castling = codes[32] >> 1
+      b._castling_checked = False
+      
+      if codes[33] != 0xFF:
+         rank = codes[33] / 8
+         b.en_passant_target = (rank, codes[33] % 8, 3 if rank == 2 else 4)
+      
+      return b
 
    """
    Test that the rank and file values are valid
@@ -660,19 +1892,25 @@ class Board(object):
    """
    @staticmethod
    def _rf_to_position(rank, file):
-      return chr(file + 97) + str(rank + 1)
+      return Board.SQUARE_NAMES[Board._rf_to_index(rank, file)]
       
    """
-   Translate a position argument (either a (rank, file) tuple or position string) into a (rank, file) tuple.
+   Translate a position argument (a (rank, file) tuple, position string, or square number) into a (rank, file) tuple.
    """
    @staticmethod
    def _arg_to_rf(position):
-      p = position
-      
-      if type(position) == str:
-         p = Board._position_to_rf(position)
-      
-      return p
+      return Board._square_rf[Board._arg_to_index(position)]
+   
+   """
+   Translate a position argument (a (rank, file) tuple, position string, or square number) into an array index for the
+   Board.pieces array.  This is a single dict lookup, which also takes care of validating the position.
+   """
+   @staticmethod
+   def _arg_to_index(position):
+      try:
+         return Board._square_index[position]
+      except (KeyError, TypeError):
+         raise ValueError('Bad position: %s' % (position,))
       
    """
    Translate a rank and file into an array index for the Board.pieces array.
@@ -691,7 +1929,7 @@ class Board(object):
       if index < 0 or index > 63:
          raise ValueError('Bad index: %d', index)
 
-      return (index % 8, index / 8)
+      return Board._square_rf[index]
 
       
 """
@@ -706,6 +1944,11 @@ class Piece(object):
    id = None
    
    def __init__(self, b, r, f, c, n, id): #DF: added id
+      # Without an explicit id, number the piece after the others of its type and color
+      if id == None:
+         same = b.by_piece[n][c]
+         id = len(same) if type(same) == list else 0
+
       self.board = b
       self.rank = r
       self.file = f
@@ -744,20 +1987,45 @@ class Piece(object):
    Return the squares covered by this piece.
    """
    def covers(self):
-      return []
+      return [Board._square_rf[i] for i in self.cover_indices()]
+   
+   """
+   Return the squares covered by this piece as indexes into Board.pieces.  The sequence returned may be one of the
+   board's shared tables, so it must not be modified.
+   """
+   def cover_indices(self):
+      return ()
     
    """
    Return the squares that could be reached by this pieces.
    """
    def reaches(self):
-      return [(r,f) for r,f in self.covers()
-               if self.board.get((r,f)) == None or self.board.get((r,f)).color != self.color]
+      pieces = self.board.pieces
+      
+      return [Board._square_rf[i] for i in self.cover_indices()
+               if pieces[i] == None or pieces[i].color != self.color]
+   
+   """
+   Return the squares along the given rays up to and including the first occupied square on each.
+   """
+   def _slide(self, rays):
+      pieces = self.board.pieces
+      ret = []
+      
+      for ray in rays:
+         for i in ray:
+            ret.append(i)
+            
+            if pieces[i]:
+               break
+      
+      return ret
    
    def __str__(self):
-      return self.name + chr(self.file + 97) + str(self.rank + 1)
+      return self.name + Board.SQUARE_NAMES[self.file * 8 + self.rank]
    
 class Pawn(Piece):
-   def __init__(self, b, r, f, c, id): #DF: added id
+   def __init__(self, b, r, f, c, id=None): #DF: added id
       super(Pawn, self).__init__(b, r, f, c, 'P', id)
    
    def reach(self, rf, capture=False):
@@ -768,65 +2036,43 @@ class Pawn(Piece):
       # previous move.
       return (self.color == Board.WHITE and \
             ((not capture and self.file == f and \
-               (self.rank == r - 1 or (self.rank == 1 and r == 3 and self.board.get((2, f)) == None))) or \
+               (self.rank == r - 1 or (self.rank == 1 and r == 3 and self.board.pieces[f * 8 + 2] == None))) or \
              (capture and abs(self.file - f) == 1 and r - self.rank == 1))) or \
          (self.color == Board.BLACK and \
             ((not capture and self.file == f and \
-               (self.rank == r + 1 or (self.rank == 6 and r == 4 and self.board.get((5, f)) == None))) or \
+               (self.rank == r + 1 or (self.rank == 6 and r == 4 and self.board.pieces[f * 8 + 5] == None))) or \
              (capture and abs(self.file - f) == 1 and self.rank - r == 1)))
    
-   def covers(self):
-      ret = []
-      
-      if self.color == Board.WHITE and self.rank < 7:
-         if self.file > 0:
-            ret.append((self.rank + 1, self.file - 1))
-         if self.file < 7:
-            ret.append((self.rank + 1, self.file + 1))
-      elif self.color == Board.BLACK and self.rank > 0:
-         if self.file > 0:
-            ret.append((self.rank - 1, self.file - 1))
-         if self.file < 7:
-            ret.append((self.rank - 1, self.file + 1))
-            
-      return ret
+   def cover_indices(self):
+      return Board._pawn_targets[self.color][self.file * 8 + self.rank]
    
    def reaches(self):
       ret = []
+      pieces = self.board.pieces
+      i = self.file * 8 + self.rank
       
+      # Moving up a rank is moving up one square in Board.pieces.
       if self.color == Board.WHITE and self.rank < 7:
-         if self.board.get((self.rank + 1, self.file)) == None:
-            ret.append((self.rank + 1, self.file))
+         if pieces[i + 1] == None:
+            ret.append(Board._square_rf[i + 1])
 
-            if self.rank == 1 and self.board.get((3, self.file)) == None:
-               ret.append((3, self.file))
-               
-         if self.file > 0 and self.board.get((self.rank + 1, self.file - 1)) != None and \
-               self.board.get((self.rank + 1, self.file - 1)).color != self.color:
-            ret.append((self.rank + 1, self.file - 1))
-            
-         if self.file < 7 and self.board.get((self.rank + 1, self.file + 1)) != None and \
-               self.board.get((self.rank + 1, self.file + 1)).color != self.color:
-            ret.append((self.rank + 1, self.file + 1))
+            if self.rank == 1 and pieces[i + 2] == None:
+               ret.append(Board._square_rf[i + 2])
       elif self.color == Board.BLACK and self.rank > 0:
-         if self.board.get((self.rank - 1, self.file)) == None:
-            ret.append((self.rank - 1, self.file))
+         if pieces[i - 1] == None:
+            ret.append(Board._square_rf[i - 1])
 
-            if self.rank == 6 and self.board.get((4, self.file)) == None:
-               ret.append((4, self.file))
-         
-         if self.file > 0 and self.board.get((self.rank - 1, self.file - 1)) != None and \
-               self.board.get((self.rank - 1, self.file - 1)).color != self.color:
-            ret.append((self.rank - 1, self.file - 1))
-         
-         if self.file < 7 and self.board.get((self.rank - 1, self.file + 1)) != None and \
-               self.board.get((self.rank - 1, self.file + 1)).color != self.color:
-            ret.append((self.rank - 1, self.file + 1))
+            if self.rank == 6 and pieces[i - 2] == None:
+               ret.append(Board._square_rf[i - 2])
+      
+      for j in Board._pawn_targets[self.color][i]:
+         if pieces[j] != None and pieces[j].color != self.color:
+            ret.append(Board._square_rf[j])
             
       return ret
    
 class Rook(Piece):
-   def __init__(self, b, r, f, c, id): #DF: added id
+   def __init__(self, b, r, f, c, id=None): #DF: added id
       super(Rook, self).__init__(b, r, f, c, 'R', id)
    
    def reach(self, rf, capture=False):
@@ -839,7 +2085,7 @@ class Rook(Piece):
          ret = True
          
          for i in range(self.rank + step, r, step):
-            if self.board.get((i, f)) != None:
+            if self.board.pieces[f * 8 + i] != None:
                ret = False
                break
       # If we're on the same rank, check if the file is blocked
@@ -848,7 +2094,7 @@ class Rook(Piece):
          ret = True
                
          for i in range(self.file + step, f, step):
-            if self.board.get((r, i)) != None:
+            if self.board.pieces[i * 8 + r] != None:
                ret = False
                break
       
@@ -868,7 +2114,7 @@ class Rook(Piece):
          step = (king.rank - self.rank) / abs(king.rank - self.rank)
          
          for i in range(self.rank + step, king.rank, step):
-            blocker = self.board.get((i, king.file))
+            blocker = self.board.pieces[king.file * 8 + i]
 
             # Found the first piece between us and the king
             if blocker != None and not pinned:
@@ -882,7 +2128,7 @@ class Rook(Piece):
          step = (king.file - self.file) / abs(king.file - self.file)
                
          for i in range(self.file + step, king.file, step):
-            blocker = self.board.get((king.rank, i))
+            blocker = self.board.pieces[i * 8 + king.rank]
 
             # Found the first piece between us and the king
             if blocker != None and not pinned:
@@ -894,37 +2140,11 @@ class Rook(Piece):
       
       return pinned
 
-   def covers(self):
-      ret = []
-      
-      for r in range(self.rank - 1, -1, -1):
-         ret.append((r, self.file))
-         
-         if self.board.pieces[Board._rf_to_index(r, self.file)]:
-            break
-      
-      for r in range(self.rank + 1, 8):
-         ret.append((r, self.file))
-         
-         if self.board.pieces[Board._rf_to_index(r, self.file)]:
-            break
-      
-      for f in range(self.file - 1, -1, -1):
-         ret.append((self.rank, f))
-         
-         if self.board.pieces[Board._rf_to_index(self.rank, f)]:
-            break
-      
-      for f in range(self.file + 1, 8):
-         ret.append((self.rank, f))
-         
-         if self.board.pieces[Board._rf_to_index(self.rank, f)]:
-            break
-      
-      return ret
+   def cover_indices(self):
+      return self._slide(Board._rook_rays[self.file * 8 + self.rank])
 
 class Bishop(Piece):
-   def __init__(self, b, r, f, c, id): #DF: added id
+   def __init__(self, b, r, f, c, id=None): #DF: added id
       super(Bishop, self).__init__(b, r, f, c, 'B', id)
    
    def reach(self, rf, capture=False):
@@ -940,7 +2160,7 @@ class Bishop(Piece):
          f_fact = (f - self.file) / max(1, abs(f - self.file))
          
          for i in range(1, abs(r - self.rank)):
-            if self.board.get((self.rank + i * r_fact, self.file + i * f_fact)) != None:
+            if self.board.pieces[(self.file + i * f_fact) * 8 + self.rank + i * r_fact] != None:
                ret = False
                break
                
@@ -962,7 +2182,7 @@ class Bishop(Piece):
          f_fact = (king.file - self.file) / max(1, abs(king.file - self.file))
          
          for i in range(1, abs(king.rank - self.rank)):
-            blocker = self.board.get((self.rank + i * r_fact, self.file + i * f_fact))
+            blocker = self.board.pieces[(self.file + i * f_fact) * 8 + self.rank + i * r_fact]
             
             # We found the first piece between us and the king.
             if blocker != None and not pinned:
@@ -974,37 +2194,11 @@ class Bishop(Piece):
          
       return pinned
    
-   def covers(self):
-      ret = []
-      
-      for m in range(1, min(7 - self.rank, 7 - self.file) + 1):
-         ret.append((self.rank + m, self.file + m))
-         
-         if self.board.pieces[Board._rf_to_index(self.rank + m, self.file + m)]:
-            break
-      
-      for m in range(1, min(self.rank, 7 - self.file) + 1):
-         ret.append((self.rank - m, self.file + m))
-         
-         if self.board.pieces[Board._rf_to_index(self.rank - m, self.file + m)]:
-            break
-      
-      for m in range(1, min(self.rank, self.file) + 1):
-         ret.append((self.rank - m, self.file - m))
-         
-         if self.board.pieces[Board._rf_to_index(self.rank - m, self.file - m)]:
-            break
-      
-      for m in range(1, min(7 - self.rank, self.file) + 1):
-         ret.append((self.rank + m, self.file - m))
-         
-         if self.board.pieces[Board._rf_to_index(self.rank + m, self.file - m)]:
-            break
-      
-      return ret
+   def cover_indices(self):
+      return self._slide(Board._bishop_rays[self.file * 8 + self.rank])
    
 class Knight(Piece):
-   def __init__(self, b, r, f, c, id): #DF: added id
+   def __init__(self, b, r, f, c, id=None): #DF: added id
       super(Knight, self).__init__(b, r, f, c, 'N', id)
       
    def reach(self, rf, capture=False):
@@ -1017,15 +2211,11 @@ class Knight(Piece):
       
       return ret
    
-   def covers(self):
-      return [(r,f) for r,f in
-                  [(self.rank + r, self.file + f) for r in [-2, -1, 1, 2]
-                  for f in [-2, -1, 1, 2]
-                  if abs(r) != abs(f)]
-               if r >= 0 and r <= 7 and f >= 0 and f <= 7]
+   def cover_indices(self):
+      return Board._knight_targets[self.file * 8 + self.rank]
    
 class King(Piece):
-   def __init__(self, b, r, f, c, id): #DF: added id
+   def __init__(self, b, r, f, c, id=None): #DF: added id
       super(King, self).__init__(b, r, f, c, 'K', id)
       
    def reach(self, rf, capture=False):
@@ -1037,13 +2227,11 @@ class King(Piece):
       
       return ret
    
-   def covers(self):
-      return [(r, f) for r in range(max(0, self.rank - 1), min(8, self.rank + 2))
-                     for f in range(max(0, self.file - 1), min(8, self.file + 2))
-                     if r != self.rank or f != self.file]
+   def cover_indices(self):
+      return Board._king_targets[self.file * 8 + self.rank]
    
 class Queen(Piece):
-   def __init__(self, b, r, f, c, id): #DF: added id
+   def __init__(self, b, r, f, c, id=None): #DF: added id
       super(Queen, self).__init__(b, r, f, c, 'Q', id)
    
    def reach(self, rf, capture=False):
@@ -1056,7 +2244,7 @@ class Queen(Piece):
          ret = True
          
          for i in range(self.rank + step, r, step):
-            if self.board.get((i, f)) != None:
+            if self.board.pieces[f * 8 + i] != None:
                ret = False
                break
       # If we're on the same rank, check if the file is blocked
@@ -1065,7 +2253,7 @@ class Queen(Piece):
          ret = True
                
          for i in range(self.file + step, f, step):
-            if self.board.get((r, i)) != None:
+            if self.board.pieces[i * 8 + r] != None:
                ret = False
                break
       # If we're on the same diagonal, check if there's a piece between us
@@ -1077,7 +2265,7 @@ class Queen(Piece):
          f_fact = (f - self.file) / max(1, abs(f - self.file))
          
          for i in range(1, abs(r - self.rank)):
-            if self.board.get((self.rank + i * r_fact, self.file + i * f_fact)) != None:
+            if self.board.pieces[(self.file + i * f_fact) * 8 + self.rank + i * r_fact] != None:
                ret = False
                break
       
@@ -1097,7 +2285,7 @@ class Queen(Piece):
          step = (king.rank - self.rank) / abs(king.rank - self.rank)
          
          for i in range(self.rank + step, king.rank, step):
-            blocker = self.board.get((i, king.file))
+            blocker = self.board.pieces[king.file * 8 + i]
             
             # We found the first piece between us and the king.
             if blocker != None and not pinned:
@@ -1111,7 +2299,7 @@ class Queen(Piece):
          step = (king.file - self.file) / abs(king.file - self.file)
                
          for i in range(self.file + step, king.file, step):
-            blocker = self.board.get((king.rank, i))
+            blocker = self.board.pieces[i * 8 + king.rank]
             
             # We found the first piece between us and the king.
             if blocker != None and not pinned:
@@ -1127,7 +2315,7 @@ class Queen(Piece):
          f_fact = (king.file - self.file) / max(1, abs(king.file - self.file))
          
          for i in range(1, abs(king.rank - self.rank)):
-            blocker = self.board.get((self.rank + i * r_fact, self.file + i * f_fact))
+            blocker = self.board.pieces[(self.file + i * f_fact) * 8 + self.rank + i * r_fact]
 
             # We found the first piece between us and the king.
             if blocker != None and not pinned:
@@ -1139,58 +2327,8 @@ class Queen(Piece):
       
       return pinned
 
-   def covers(self):
-      ret = []
-      
-      for r in range(self.rank - 1, -1, -1):
-         ret.append((r, self.file))
-         
-         if self.board.pieces[Board._rf_to_index(r, self.file)]:
-            break
-      
-      for r in range(self.rank + 1, 8):
-         ret.append((r, self.file))
-         
-         if self.board.pieces[Board._rf_to_index(r, self.file)]:
-            break
-      
-      for f in range(self.file - 1, -1, -1):
-         ret.append((self.rank, f))
-         
-         if self.board.pieces[Board._rf_to_index(self.rank, f)]:
-            break
-      
-      for f in range(self.file + 1, 8):
-         ret.append((self.rank, f))
-         
-         if self.board.pieces[Board._rf_to_index(self.rank, f)]:
-            break
-      
-      for m in range(1, min(7 - self.rank, 7 - self.file) + 1):
-         ret.append((self.rank + m, self.file + m))
-         
-         if self.board.pieces[Board._rf_to_index(self.rank + m, self.file + m)]:
-            break
-      
-      for m in range(1, min(self.rank, 7 - self.file) + 1):
-         ret.append((self.rank - m, self.file + m))
-         
-         if self.board.pieces[Board._rf_to_index(self.rank - m, self.file + m)]:
-            break
-      
-      for m in range(1, min(self.rank, self.file) + 1):
-         ret.append((self.rank - m, self.file - m))
-         
-         if self.board.pieces[Board._rf_to_index(self.rank - m, self.file - m)]:
-            break
-      
-      for m in range(1, min(7 - self.rank, self.file) + 1):
-         ret.append((self.rank + m, self.file - m))
-         
-         if self.board.pieces[Board._rf_to_index(self.rank + m, self.file - m)]:
-            break
-
-      return ret
+   def cover_indices(self):
+      return self._slide(Board._queen_rays[self.file * 8 + self.rank])
 
 def test_init_and_move():
    b = Board()
@@ -1255,7 +2393,8 @@ def test_queen_capture():
    Queen(b, 0, 0, Board.BLACK)
    Queen(b, 3, 7, Board.WHITE)
    Pawn(b, 3, 3, Board.WHITE)
-   King(b, 7, 0, Board.WHITE)
+   # Off the a-file, where the black queen would have it in check
+   King(b, 7, 1, Board.WHITE)
    King(b, 7, 7, Board.BLACK)
    b.movePGN('Qxd4')
    
@@ -1302,7 +2441,8 @@ def test_king_capture():
    b = Board()
    Pawn(b, 4, 1, Board.BLACK)
    King(b, 4, 0, Board.WHITE)
-   King(b, 4, 2, Board.BLACK)
+   # Not on c5, where the kings would end up next to each other
+   King(b, 4, 3, Board.BLACK)
    b.movePGN('Kxb5')
    
 def test_castle():
@@ -1314,6 +2454,385 @@ def test_castle():
    b.movePGN('O-O')
    b.movePGN('O-O-O')
    
+def test_hash_key():
+   b = Board()
+   b.initialize()
+   start = b.hash_key()
+   b.movePGN('Nf3')
+   b.movePGN('Nf6')
+   b.movePGN('Ng1')
+   b.movePGN('Ng8')
+   
+   if b.hash_key() != start:
+      raise Exception('FAIL')
+   
+   b1 = Board()
+   b1.initialize()
+   b2 = Board()
+   b2.initialize()
+   
+   for move in ['d4', 'd5', 'c4']:
+      b1.movePGN(move)
+   
+   for move in ['c4', 'd5', 'd4']:
+      b2.movePGN(move)
+   
+   if b1.hash_key() != b2.hash_key() or b1.zobrist != Board.decode(b1.encode()).zobrist:
+      raise Exception('FAIL')
+   
+def test_pack():
+   b = Board()
+   b.initialize()
+   b.movePGN('e4')
+   b2 = Board.unpack(b.pack())
+   
+   if len(b.pack()) != Board.PACKED_SIZE or b2.encode() != b.encode() or b2.hash_key() != b.hash_key() or \
+      b2.en_passant_target != b.en_passant_target:
+      raise Exception('FAIL')
+   
+   # Packing into a buffer that already holds something overwrites it
+   buffer = bytearray('\xff' * (2 * Board.PACKED_SIZE))
+   b.pack_into(buffer, Board.PACKED_SIZE)
+   
+   if str(buffer[Board.PACKED_SIZE:]) != b.pack() or buffer[0] != 0xFF:
+      raise Exception('FAIL')
+   
+def test_zobrist_cache():
+   import tempfile
+   
+   fd, path = tempfile.mkstemp()
+   os.close(fd)
+   
+   try:
+      save_zobrist_keys(path)
+      os.environ['PIDGIN_ZOBRIST_KEYS'] = path
+      
+      if _zobrist_table() != Board._zobrist_keys:
+         raise Exception('FAIL')
+   finally:
+      del os.environ['PIDGIN_ZOBRIST_KEYS']
+      os.remove(path)
+   
+def test_square_arguments():
+   b = Board()
+   b.initialize()
+   
+   if b.get('d1') is not b.get((0, 3)) or b.get(24) is not b.get('d1') or b.get('d1').name != 'Q':
+      raise Exception('FAIL')
+   
+   if b.get('g1').covers() != [(1, 4), (2, 5), (2, 7)] or b.get('g1').reaches() != [(2, 5), (2, 7)]:
+      raise Exception('FAIL')
+   
+   for bad in ['i1', (8, 0), 64, None]:
+      try:
+         b.get(bad)
+         raise Exception('FAIL')
+      except ValueError:
+         pass
+   
+def test_attack_map():
+   b = Board()
+   b.initialize()
+   counts = b.attack_map(Board.WHITE)
+   
+   # f3 is covered by the g-pawn, the e-pawn, and the knight on g1
+   if counts[5 * 8 + 2] != 3 or counts[4 * 8 + 3] != 0 or b.attack_map(Board.WHITE) is not counts:
+      raise Exception('FAIL')
+   
+   if sorted(str(p) for p in b.attackers('f3', Board.WHITE)) != ['Ng1', 'Pe2', 'Pg2']:
+      raise Exception('FAIL')
+   
+   b.movePGN('e4')
+   
+   if b.attack_map(Board.WHITE) is counts or not b.attack_bits(Board.WHITE) & (1 << (3 * 8 + 4)) or \
+      b.attack_map(Board.WHITE)[4 * 8 + 3] != 0 or b.attack_map(Board.WHITE)[3 * 8 + 4] != 1:
+      raise Exception('FAIL')
+   
+def test_castling_rights():
+   b = Board()
+   King(b, 0, 4, Board.WHITE)
+   Rook(b, 0, 7, Board.WHITE)
+   Rook(b, 0, 0, Board.WHITE)
+   King(b, 7, 4, Board.BLACK)
+   Rook(b, 7, 5, Board.BLACK)
+   
+   # The black rook covers f1, so white can't castle king-side through it.
+   try:
+      b.movePGN('O-O')
+      raise Exception('FAIL')
+   except ValueError:
+      pass
+   
+   b.movePGN('Rh2')
+   b.movePGN('Kd8')
+   b.movePGN('Rh1')
+   b.movePGN('Ke8')
+   
+   if b.castling_rights() != Board.WHITE_QUEENSIDE:
+      raise Exception('FAIL')
+   
+   b.movePGN('O-O-O')
+   
+   if b.castling_rights() != 0 or b.fullmove_number != 3 or b.halfmove_clock != 5:
+      raise Exception('FAIL')
+   
+def test_repetition():
+   b = Board()
+   b.initialize()
+   
+   for move in ['Nf3', 'Nf6', 'Ng1', 'Ng8', 'Nf3', 'Nf6', 'Ng1']:
+      b.movePGN(move)
+   
+   if b.repetitions() != 2 or b.is_draw_claimable():
+      raise Exception('FAIL')
+   
+   b.movePGN('Ng8')
+   
+   if b.repetitions() != 3 or not b.is_draw_claimable():
+      raise Exception('FAIL')
+   
+   b.movePGN('e4')
+   
+   if b.repetitions() != 1 or b.halfmove_clock != 0:
+      raise Exception('FAIL')
+
+def test_legal_moves():
+   def perft(b, depth):
+      moves = b.legal_moves()
+      
+      if depth == 1:
+         return len(moves)
+      
+      total = 0
+      
+      for move in moves:
+         child = b.copy()
+         child.movePGN(move)
+         total += perft(child, depth - 1)
+      
+      return total
+   
+   b = Board()
+   b.initialize()
+   
+   if perft(b, 3) != 8902:
+      raise Exception('FAIL')
+   
+   # Castling, en passant, promotion, and disambiguation
+   b = Board()
+   King(b, 0, 4, Board.WHITE)
+   Rook(b, 0, 7, Board.WHITE)
+   Knight(b, 2, 1, Board.WHITE)
+   Knight(b, 2, 5, Board.WHITE)
+   Pawn(b, 6, 0, Board.WHITE)
+   Pawn(b, 4, 3, Board.WHITE)
+   King(b, 7, 6, Board.BLACK)
+   Pawn(b, 6, 4, Board.BLACK)
+   b.set_to_play(Board.BLACK)
+   b.movePGN('e5')
+   moves = b.legal_moves()
+   
+   for move in ['O-O', 'dxe6', 'a8=Q+', 'a8=N', 'Nbd4', 'Nfd4', 'Rh8+']:
+      if move not in moves:
+         raise Exception('FAIL')
+   
+   c = b.copy()
+   c.movePGN('dxe6')
+   
+   if b.get('e5') == None or c.get('e5') != None or c.history[:-1] != b.history:
+      raise Exception('FAIL')
+   
+def test_fen():
+   b = Board()
+   b.initialize()
+   f = Board.from_fen(Board.STARTING_FEN)
+   
+   if f.to_fen() != Board.STARTING_FEN or f.hash_key() != b.hash_key() or f.legal_moves() != b.legal_moves():
+      raise Exception('FAIL')
+   
+   fen = 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R b KQkq e3 5 12'
+   
+   if Board.from_fen(fen).to_fen() != fen or Board.from_fen(fen).legal_moves().count('bxe3') != 0:
+      raise Exception('FAIL')
+   
+   # Chess960 queenside castling with the king on b1 and the rook on a1, in Shredder-FEN
+   b = Board.from_fen('4k3/8/8/8/8/8/8/RK5R w AH - 0 1')
+   
+   if 'O-O-O' not in b.legal_moves() or 'O-O' not in b.legal_moves() or b.to_fen().split()[2] != 'HA':
+      raise Exception('FAIL')
+   
+   b.movePGN('O-O-O')
+   
+   if b.to_fen() != '4k3/8/8/8/8/8/8/2KR3R b - - 1 1':
+      raise Exception('FAIL')
+   
+   for bad in ['', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP w KQkq - 0 1', '8/8/8/8/8/8/8/4K3 w - - 0 1',
+               Board.STARTING_FEN.replace(' w ', ' x '), Board.STARTING_FEN.replace('KQkq', 'KQkz')]:
+      try:
+         Board.from_fen(bad)
+      except ValueError:
+         pass
+      else:
+         raise Exception('FAIL')
+   
+def test_see():
+   # The rook takes the pawn and the rook behind it takes back, so the pawn is won.
+   b = Board()
+   King(b, 0, 6, Board.WHITE)
+   Rook(b, 0, 4, Board.WHITE)
+   Rook(b, 1, 4, Board.WHITE)
+   King(b, 7, 0, Board.BLACK)
+   Rook(b, 7, 4, Board.BLACK)
+   Pawn(b, 4, 4, Board.BLACK)
+   
+   if b.see('e5') != 1 or b.see_move('Rxe5') != 1 or b.see('e5', Board.BLACK) != 0:
+      raise Exception('FAIL')
+   
+   if [p.name for p in b.hanging_pieces(Board.BLACK)] != ['P'] or b.hanging_pieces(Board.WHITE):
+      raise Exception('FAIL')
+   
+   # Without the second rook, the pawn is defended well enough.
+   b.take('e2')
+   
+   if b.see('e5') != 0 or b.see_move('Rxe5') != -4 or b.hanging_pieces(Board.BLACK):
+      raise Exception('FAIL')
+   
+   # Safe queen moves score 0, and a queen that takes a defended pawn loses itself for it.
+   b = Board()
+   b.initialize()
+   
+   for move in ['e4', 'd5', 'Nc3', 'e6']:
+      b.movePGN(move)
+   
+   if b.see_move('exd5') != 0 or b.see_move('Qh5') != 0 or b.see_move('Qg4') != 0 or b.see_move('Qf3') != 0:
+      raise Exception('FAIL')
+   
+   b.movePGN('Qh5')
+   b.movePGN('Nf6')
+   
+   if b.see_move('Qxf7+') != -8 or b.see_move('Qxh7') != -8 or b.see('h5', Board.BLACK) != 9:
+      raise Exception('FAIL')
+   
+   if [p.name for p in b.hanging_pieces(Board.WHITE)] != ['P', 'Q']:
+      raise Exception('FAIL')
+   
+def test_parse_move():
+   if Board.parse_move('Nbxd7+!?') != ('N', 'b', True, 3 * 8 + 6, None, True) or \
+      Board.parse_move('exd8=Q#') != ('P', 'e', True, 3 * 8 + 7, 'Q', True) or \
+      Board.parse_move('e8N') != ('P', '', False, 4 * 8 + 7, 'N', False) or \
+      Board.parse_move('O-O-O+') != ('O-O-O', '', False, None, None, True):
+      raise Exception('FAIL')
+   
+   if Board._move_cache.get('e8N') != Board.parse_move('e8N'):
+      raise Exception('FAIL')
+   
+   for move in ['', 'e9', 'Pe4', 'Nxx4', 'Ni3d4', 'Qe8=Q', 'e5=Q', 'O-O-O-O', 'e4xd5']:
+      try:
+         Board.parse_move(move)
+      except ValueError:
+         pass
+      else:
+         raise Exception('FAIL')
+   
+   # Three queens reach b2, and only the square tells which one moves.
+   b = Board.from_fen('7k/8/8/8/8/Q7/8/Q1Q4K w - - 0 1')
+   b.movePGN('Qa1b2')
+   
+   if b.to_fen() != '7k/8/8/8/8/Q7/1Q6/2Q4K b - - 1 1':
+      raise Exception('FAIL')
+   
+def test_check_detection():
+   # Checks are found without the + and #, and a + on a quiet move is ignored.
+   b = Board()
+   b.initialize()
+   
+   for move in ['f3+', 'e5', 'g4', 'Qh4']:
+      b.movePGN(move)
+      
+      if move == 'f3+' and (b.check != None or b.is_check()):
+         raise Exception('FAIL')
+   
+   if b.check != Board.WHITE or not b.is_check() or not b.is_checkmate() or b.is_stalemate():
+      raise Exception('FAIL')
+   
+   # An unannotated check still has to be answered.
+   b = Board()
+   b.initialize()
+   
+   for move in ['e4', 'f6', 'Qh5']:
+      b.movePGN(move)
+   
+   if b.check != Board.BLACK or b.is_checkmate():
+      raise Exception('FAIL')
+   
+   try:
+      b.movePGN('a6')
+   except ValueError, e:
+      if str(e) != 'Check not resolved by a6':
+         raise Exception('FAIL')
+   else:
+      raise Exception('FAIL')
+   
+   # Kings can't step into check, whether or not they were in check before.
+   b = Board.from_fen('4k3/8/8/8/8/8/3r4/4K3 w - - 0 1')
+   
+   try:
+      b.movePGN('Ke2')
+   except ValueError, e:
+      if str(e) != 'King left in check by Ke2':
+         raise Exception('FAIL')
+   else:
+      raise Exception('FAIL')
+   
+   b = Board.from_fen('4k3/8/8/8/8/8/3r4/4K3 w - - 0 1')
+   b.movePGN('Kxd2')
+   
+   if b.check != None or b.is_check() or b.is_checkmate() or b.is_stalemate():
+      raise Exception('FAIL')
+   
+   b = Board.from_fen('7k/5Q2/6K1/8/8/8/8/8 b - - 0 1')
+   
+   if not b.is_stalemate() or b.is_checkmate() or b.is_check():
+      raise Exception('FAIL')
+   
+def test_rejected_move():
+   # A king stepping into check, a pinned piece taking, a move that doesn't answer check, a pinned pawn taking and
+   # promoting, and an en passant capture that opens the rank onto the king are each taken back.
+   cases = [('4k3/8/8/8/8/8/3r4/4K3 w - - 0 1', [], 'Ke2'),
+            ('4k3/4r3/8/8/2n5/8/4B3/4K3 w - - 0 1', [], 'Bxc4'),
+            (None, ['e4', 'f6', 'Qh5'], 'a6'),
+            ('k4nr1/6P1/8/8/8/8/8/6K1 w - - 0 1', [], 'gxf8=Q'),
+            ('8/8/8/KPp4r/8/8/8/4k3 w - c6 0 1', [], 'bxc6')]
+   
+   def state(b):
+      return (b.to_fen(), list(b.history), b.hash_key(), b.zobrist, b.pack(), b.check,
+              [(p.nodename(), p.rank, p.file) for p in b.pieces if p != None],
+              [[p.nodename() for p in b.by_piece[name][color]] for name in 'NBRQP'
+               for color in (Board.WHITE, Board.BLACK)])
+   
+   for fen, moves, move in cases:
+      if fen == None:
+         b = Board()
+         b.initialize()
+      else:
+         b = Board.from_fen(fen)
+      
+      for m in moves:
+         b.movePGN(m)
+      
+      before = state(b)
+      legal = b.legal_moves()
+      
+      try:
+         b.movePGN(move)
+      except ValueError:
+         pass
+      else:
+         raise Exception('FAIL')
+      
+      if state(b) != before or b.legal_moves() != legal or move in legal:
+         raise Exception('FAIL')
+   
 def main():
    test_init_and_move()
    test_rook_capture()
@@ -1327,6 +2846,19 @@ def main():
    test_queen_pin()
    test_en_passant()
    test_castle()
+   test_hash_key()
+   test_pack()
+   test_zobrist_cache()
+   test_square_arguments()
+   test_attack_map()
+   test_castling_rights()
+   test_repetition()
+   test_legal_moves()
+   test_fen()
+   test_see()
+   test_parse_move()
+   test_check_detection()
+   test_rejected_move()
 
 if __name__ == '__main__':
    main()
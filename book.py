@@ -0,0 +1,339 @@
+import mmap
+import os
+import random
+import struct
+
+import board
+import pgn
+
+"""
+Opening books in the Polyglot format.  A BookBuilder replays games and weighs every move played from every position by
+how the games went, and writes the weighted moves to a book file.  A Book probes a book file through a memory map and
+gives its moves in SAN, ready for Board.movePGN().
+
+A book file is a sequence of 16-byte big-endian records, each a 64-bit position key, a 16-bit move code as made by
+Board.move_code(), a 16-bit weight, and 32 bits of learning data, sorted by key.  Castling is written as the king
+taking its own rook, as Polyglot does.  The position keys are Board.hash_key(), which follows Polyglot's layout, so
+books made by other Polyglot tools can be read when the board uses Polyglot's own Zobrist keys, loaded through the
+PIDGIN_ZOBRIST_KEYS environment variable.
+"""
+
+_record = struct.Struct('>QHHI')
+
+# Weight of a move for the side that made it, by the index of the game's outcome in pgn.outcomes
+_scores = {board.Board.WHITE: {1: 2, 2: 1, 3: 0}, board.Board.BLACK: {1: 0, 2: 1, 3: 2}}
+
+"""
+Return the move code a book uses for a move, given the (piece, src, dest) events the board reported while making it
+and the SAN text of the move.
+"""
+def _book_code(events, move):
+   if move.startswith('O-O'):
+      # The rook moves first and the king last, and the book has the king moving to the rook's square.
+      rook, king = events[-2], events[-1]
+      return board.Board.move_code(king[1], rook[1])
+
+   promotion = board.Board.parse_move(move)[4]
+   piece, src, dest = events[-1]
+
+   return board.Board.move_code(board.Board._arg_to_rf(src), board.Board._arg_to_rf(dest), promotion)
+
+"""
+A BookBuilder collects weighted moves from games.  Only the first max_ply moves of each game are used, and moves played
+in fewer than min_games games are left out of the book.  A move gets 2 points for each game its side won and 1 for
+each game drawn.
+"""
+class BookBuilder(object):
+   def __init__(self, max_ply=40, min_games=1):
+      self.max_ply = max_ply
+      self.min_games = min_games
+      # (key, code) to [games, weight]
+      self.entries = {}
+      self.games = 0
+      self.errors = 0
+
+   """
+   Add the games in a file-like object of PGN text, batch_size at a time.
+   """
+   def add_pgn(self, f, batch_size=10000):
+      batch = []
+
+      for game in pgn.read_games(f):
+         batch.append(game)
+
+         if len(batch) == batch_size:
+            self.add_games(batch)
+            batch = []
+
+      self.add_games(batch)
+
+   """
+   Add games given as (tags, moves) tuples.  The games are replayed together with replay_games() in the pgn module.
+   """
+   def add_games(self, games):
+      games = [(tags, moves[:self.max_ply] if self.max_ply != None else moves) for tags, moves in games]
+      outcomes = [pgn.outcomes.get(tags.get('Result')) for tags, moves in games]
+      events = []
+      edge = [None]
+
+      def listener(number, b, ply, move):
+         # The listener is called once for each game through a move, and the events of the move are only there for
+         # the first call.
+         if events:
+            edge[0] = _book_code(events, move)
+            del events[:]
+
+         # The side that made the move is the one not to play now.
+         color = board.Board.BLACK if b.to_play == board.Board.WHITE else board.Board.WHITE
+         entry = self.entries.setdefault((b.history[-1], edge[0]), [0, 0])
+         entry[0] += 1
+         entry[1] += _scores[color].get(outcomes[number], 0)
+
+      def callback(piece, src, dest):
+         events.append((piece, src, dest))
+
+      for number, b, error in pgn.replay_games(games, listener, callback):
+         self.games += 1
+
+         if error != None:
+            self.errors += 1
+
+   """
+   Write the book to a file at the given path, and return a Book for it.  Weights over 65535 are scaled down with the
+   other weights of their position.
+   """
+   def finish(self, path):
+      positions = {}
+
+      for (key, code), (games, weight) in self.entries.iteritems():
+         if games >= self.min_games:
+            positions.setdefault(key, []).append((code, weight))
+
+      with open(path, 'wb') as f:
+         for key in sorted(positions):
+            moves = positions[key]
+            top = max(weight for code, weight in moves)
+
+            for code, weight in sorted(moves, key=lambda m: (-m[1], m[0])):
+               if top > 0xFFFF:
+                  weight = weight * 0xFFFF / top
+
+               f.write(_record.pack(key, code, weight, 0))
+
+      return Book(path)
+
+"""
+A Book answers queries against a Polyglot book file.  Positions are given as Boards.
+"""
+class Book(object):
+   def __init__(self, path):
+      self.file = open(path, 'rb')
+      size = os.fstat(self.file.fileno()).st_size
+      self.size = size / _record.size
+      self.data = ''
+
+      if size:
+         self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+   """
+   Return the book's entries for a position, given as a Board or a key from Board.hash_key(), as a list of (move code,
+   weight, learn) tuples in the order of the file.
+   """
+   def entries(self, position):
+      key = position.hash_key() if isinstance(position, board.Board) else position
+      ret = []
+      i = self._find(key)
+
+      while i < self.size:
+         r = _record.unpack_from(self.data, i * _record.size)
+
+         if r[0] != key:
+            break
+
+         ret.append(r[1:])
+         i += 1
+
+      return ret
+
+   """
+   Return the book moves for a board as a list of (SAN, weight) tuples, heaviest first.  Moves that aren't legal on the
+   board, as when two positions share a key, are left out.
+   """
+   def moves(self, b):
+      entries = self.entries(b)
+
+      if not entries:
+         return []
+
+      legal = b.legal_moves()
+      ret = []
+
+      for code, weight, learn in entries:
+         san = _san(b, code, legal)
+
+         if san != None:
+            ret.append((san, weight))
+
+      ret.sort(key=lambda m: -m[1])
+
+      return ret
+
+   """
+   Return a book move for a board in SAN, picked at random in proportion to the weights, or None if the book has no
+   move for it.  The choice can be made with a given random.Random.
+   """
+   def choose(self, b, rng=random):
+      moves = [m for m in self.moves(b) if m[1] > 0]
+
+      if not moves:
+         return None
+
+      pick = rng.uniform(0, sum(weight for san, weight in moves))
+
+      for san, weight in moves:
+         pick -= weight
+
+         if pick <= 0:
+            return san
+
+      return moves[-1][0]
+
+   def close(self):
+      if self.data:
+         self.data.close()
+
+      self.file.close()
+
+   # Binary search for the first record at or after the given key.
+   def _find(self, key):
+      target = struct.pack('>Q', key)
+      lo = 0
+      hi = self.size
+
+      while lo < hi:
+         mid = (lo + hi) / 2
+         start = mid * _record.size
+
+         if self.data[start:start + 8] < target:
+            lo = mid + 1
+         else:
+            hi = mid
+
+      return lo
+
+"""
+Return the SAN of the legal move on a board with the given book move code, or None if there's none.  Castling is
+recognized both as the king taking its own rook and as the king moving two files.
+"""
+def _san(b, code, legal):
+   src, dest, promotion = board.Board.move_from_code(code)
+   piece = b.pieces[board.Board._rf_to_index(*src)]
+   target = b.pieces[board.Board._rf_to_index(*dest)]
+
+   if piece == None or piece.color != b.to_play:
+      return None
+
+   if piece.name == 'K' and ((target != None and target.name == 'R' and target.color == piece.color) or \
+      abs(dest[1] - src[1]) == 2):
+      castle = 'O-O' if dest[1] > src[1] else 'O-O-O'
+      found = [m for m in legal if m.rstrip('+') == castle]
+
+      return found[0] if found else None
+
+   square = board.Board.SQUARE_NAMES[board.Board._rf_to_index(*src)]
+
+   for move in legal:
+      core = move.rstrip('+')
+
+      if promotion != None:
+         if not core.endswith('=' + promotion):
+            continue
+
+         core = core[:-2]
+      elif '=' in core:
+         continue
+
+      if not core.endswith(board.Board.SQUARE_NAMES[board.Board._rf_to_index(*dest)]) or move.startswith('O-O'):
+         continue
+
+      name = core[0] if core[0].isupper() else 'P'
+      hint = core[1 if name != 'P' else 0:-2].replace('x', '')
+
+      if name == piece.name and not [c for c in hint if c not in square]:
+         return move
+
+   return None
+
+def test_book():
+   import tempfile
+
+   games = [({'Result': '1-0'}, ['e4', 'e5', 'Nf3', 'Nc6', 'Bc4', 'Bc5', 'O-O']),
+            ({'Result': '1-0'}, ['e4', 'e5', 'Nf3', 'Nc6', 'Bb5']),
+            ({'Result': '0-1'}, ['e4', 'c5']),
+            ({'Result': '1/2-1/2'}, ['d4', 'd5'])]
+   builder = BookBuilder(max_ply=7)
+   builder.add_games(games)
+   fd, path = tempfile.mkstemp(suffix='.bin')
+   os.close(fd)
+
+   try:
+      book = builder.finish(path)
+      b = board.Board()
+      b.initialize()
+
+      # 1. e4 scores 2 + 2 + 0, and 1. d4 scores 1
+      if book.moves(b) != [('e4', 4), ('d4', 1)] or book.choose(b, random.Random(1)) not in ('e4', 'd4'):
+         raise Exception('FAIL')
+
+      if book.entries(b)[0] != (board.Board.move_code((1, 4), (3, 4)), 4, 0):
+         raise Exception('FAIL')
+
+      for move in ['e4', 'e5', 'Nf3', 'Nc6']:
+         b.movePGN(move)
+
+      if book.moves(b) != [('Bc4', 2), ('Bb5', 2)] and book.moves(b) != [('Bb5', 2), ('Bc4', 2)]:
+         raise Exception('FAIL')
+
+      b.movePGN('Bc4')
+      b.movePGN('Bc5')
+
+      # Castling is stored as the king taking the rook.
+      if book.entries(b) != [(board.Board.move_code((0, 4), (0, 7)), 2, 0)] or book.moves(b) != [('O-O', 2)]:
+         raise Exception('FAIL')
+
+      b.movePGN('O-O')
+
+      if book.moves(b) != [] or book.choose(b) != None:
+         raise Exception('FAIL')
+
+      with open(path, 'rb') as f:
+         data = f.read()
+
+      keys = [_record.unpack_from(data, i)[0] for i in range(0, len(data), _record.size)]
+
+      if len(data) != 11 * _record.size or keys != sorted(keys):
+         raise Exception('FAIL')
+
+      book.close()
+   finally:
+      os.remove(path)
+
+def test_san():
+   # A promotion, a capture, and knight moves that do and don't need their file to tell them apart
+   b = board.Board.from_fen('4k3/1P6/8/8/8/3p4/8/N1N1K3 w - - 0 1')
+   legal = b.legal_moves()
+
+   if _san(b, board.Board.move_code((6, 1), (7, 1), 'N'), legal) != 'b8=N' or \
+      _san(b, board.Board.move_code((0, 2), (1, 4)), legal) != 'Ne2' or \
+      _san(b, board.Board.move_code((0, 0), (2, 1)), legal) != 'Nab3' or \
+      _san(b, board.Board.move_code((0, 2), (2, 3)), legal) != 'Nxd3' or \
+      _san(b, board.Board.move_code((0, 4), (1, 3)), legal) != 'Kd2' or \
+      _san(b, board.Board.move_code((0, 4), (2, 4)), legal) != None:
+      raise Exception('FAIL')
+
+def main():
+   test_book()
+   test_san()
+
+if __name__ == '__main__':
+   main()
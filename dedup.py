@@ -0,0 +1,630 @@
+import Queue
+import array
+import multiprocessing
+import os
+import struct
+
+import board
+import pgn
+
+"""
+Parallel extraction of unique positions from game archives.  The games are handed out to replay worker processes,
+which hash every position they reach and route it to the shard worker that owns that part of the hash space.  Each
+shard worker deduplicates its positions with a compact hash set, or, when exact results aren't needed, with a Bloom
+filter of a fixed size, and writes the unique ones to its own binary shard file.  No process ever holds all of the
+positions.
+
+A shard file is a sequence of fixed-size records, each a big-endian 64-bit position key followed by the position as
+returned by Board.pack().
+
+Duplicate games are found the same way, without comparing games to each other.  find_duplicates() gives every game a
+rolling hash of the positions its moves reach, which is the same for two games that play the same moves however
+their headers and move text differ, and the key of its final position.  The hashes are written to partition files by
+their high bits, and each partition is then sorted on its own, so games with equal hashes end up next to each other.
+"""
+
+_key = struct.Struct('>Q')
+RECORD_SIZE = _key.size + board.Board.PACKED_SIZE
+
+# A record in a duplicate partition file: a hash, the hash of the game's moves, the index of the game's file, and the
+# number of the game in its file
+_game_record = struct.Struct('>QQHI')
+
+# Multiplier of the rolling hash of a game's positions, an odd constant with well mixed bits
+_roll = 0x9E3779B97F4A7C15
+
+# Number of positions a replay worker collects for a shard before sending them
+_batch_size = 512
+
+# Seconds to wait on a queue or a worker process at a time before checking that no worker has died
+_poll = 1.0
+
+# Return the typecode of arrays of 64-bit words, or None if there's none, as on Windows and 32-bit builds, where 'L' is
+# 32 bits wide, and Python 2 has no 'Q'.
+def _wide_typecode():
+   for code in ('L', 'Q'):
+      try:
+         if array.array(code).itemsize == 8:
+            return code
+      except ValueError:
+         pass
+
+   return None
+
+_wide = _wide_typecode()
+
+"""
+A set of 64-bit keys stored in an open-addressing table of machine words, which takes a fraction of the memory of a
+Python set of ints.  The table doubles whenever it becomes half full.  On platforms without arrays of 64-bit words,
+the keys are kept as pairs of 32-bit words instead.
+"""
+class HashSet(object):
+   def __init__(self, capacity=1024):
+      size = 16
+
+      while size < capacity * 2:
+         size *= 2
+
+      self.table = self._new_table(size)
+      self.mask = size - 1
+      self.count = 0
+      # 0 marks an empty slot, so the key 0 is tracked on its own.
+      self.has_zero = False
+
+   def __len__(self):
+      return self.count + self.has_zero
+
+   def __contains__(self, key):
+      if key == 0:
+         return self.has_zero
+
+      i = key & self.mask
+
+      while True:
+         slot = self.table[i]
+
+         if slot == key:
+            return True
+         elif slot == 0:
+            return False
+
+         i = (i + 1) & self.mask
+
+   """
+   Add a key to the set.  Return True if the key was new and False if it was already present.
+   """
+   def add(self, key):
+      if key == 0:
+         new = not self.has_zero
+         self.has_zero = True
+         return new
+
+      i = key & self.mask
+
+      while True:
+         slot = self.table[i]
+
+         if slot == key:
+            return False
+         elif slot == 0:
+            break
+
+         i = (i + 1) & self.mask
+
+      self.table[i] = key
+      self.count += 1
+
+      if self.count * 2 > len(self.table):
+         self._grow()
+
+      return True
+
+   # Return an empty table of the given number of slots.
+   def _new_table(self, size):
+      return array.array(_wide, [0]) * size
+
+   def _grow(self):
+      old = self.table
+      self.table = self._new_table(len(old) * 2)
+      self.mask = len(self.table) - 1
+
+      for key in old:
+         if key:
+            i = key & self.mask
+
+            while self.table[i]:
+               i = (i + 1) & self.mask
+
+            self.table[i] = key
+
+# A HashSet that keeps each key as its high and low 32-bit words in neighboring items of the table, for platforms
+# without arrays of 64-bit words.  A slot is empty when both of its words are 0.
+class _SplitHashSet(HashSet):
+   def __contains__(self, key):
+      if key == 0:
+         return self.has_zero
+
+      high = key >> 32
+      low = key & 0xFFFFFFFF
+      table = self.table
+      i = key & self.mask
+
+      while True:
+         h = table[2 * i]
+         l = table[2 * i + 1]
+
+         if h == high and l == low:
+            return True
+         elif h == 0 and l == 0:
+            return False
+
+         i = (i + 1) & self.mask
+
+   def add(self, key):
+      if key == 0:
+         new = not self.has_zero
+         self.has_zero = True
+         return new
+
+      high = key >> 32
+      low = key & 0xFFFFFFFF
+      table = self.table
+      i = key & self.mask
+
+      while True:
+         h = table[2 * i]
+         l = table[2 * i + 1]
+
+         if h == high and l == low:
+            return False
+         elif h == 0 and l == 0:
+            break
+
+         i = (i + 1) & self.mask
+
+      table[2 * i] = high
+      table[2 * i + 1] = low
+      self.count += 1
+
+      if self.count * 2 > self.mask + 1:
+         self._grow()
+
+      return True
+
+   def _new_table(self, size):
+      return array.array('I', [0]) * (size * 2)
+
+   def _grow(self):
+      old = self.table
+      size = (self.mask + 1) * 2
+      self.table = self._new_table(size)
+      self.mask = size - 1
+
+      for j in range(0, len(old), 2):
+         if old[j] or old[j + 1]:
+            i = ((old[j] << 32) | old[j + 1]) & self.mask
+
+            while self.table[2 * i] or self.table[2 * i + 1]:
+               i = (i + 1) & self.mask
+
+            self.table[2 * i] = old[j]
+            self.table[2 * i + 1] = old[j + 1]
+
+if _wide == None:
+   HashSet = _SplitHashSet
+
+"""
+A Bloom filter over 64-bit keys with the given number of bits and hash functions.  The hash functions are derived
+from the two halves of the key, which is already uniformly distributed.
+"""
+class BloomFilter(object):
+   def __init__(self, bits, hashes=4):
+      self.bits = bits
+      self.hashes = hashes
+      self.data = bytearray((bits + 7) / 8)
+
+   def __contains__(self, key):
+      h1 = key & 0xFFFFFFFF
+      h2 = (key >> 32) | 1
+
+      for i in range(self.hashes):
+         bit = (h1 + i * h2) % self.bits
+
+         if not self.data[bit >> 3] & (1 << (bit & 7)):
+            return False
+
+      return True
+
+   def add(self, key):
+      h1 = key & 0xFFFFFFFF
+      h2 = (key >> 32) | 1
+
+      for i in range(self.hashes):
+         bit = (h1 + i * h2) % self.bits
+         self.data[bit >> 3] |= 1 << (bit & 7)
+
+"""
+Return the shard that owns the given position key.  The high bits are used so that the shard choice is independent of
+the slot a key lands in within a HashSet.
+"""
+def shard_of(key, shards):
+   return (key >> 40) % shards
+
+"""
+Replay the games in the chunks of PGN text that arrive on the chunks queue and send each position to the queue of the
+shard that owns it.
+"""
+def _replay_worker(chunks, shard_queues):
+   batches = [[] for q in shard_queues]
+
+   while True:
+      chunk = chunks.get()
+
+      if chunk == None:
+         break
+
+      for tags, moves in pgn.read_games(chunk.splitlines()):
+         try:
+            b = pgn.initial_board(tags.get('FEN'))
+         except ValueError:
+            continue
+
+         positions = [(b.hash_key(), b.pack())]
+
+         try:
+            for move in moves:
+               b.movePGN(move)
+               positions.append((b.hash_key(), b.pack()))
+         except ValueError:
+            # Keep the positions reached before the bad move
+            pass
+
+         for key, packed in positions:
+            shard = shard_of(key, len(shard_queues))
+            batches[shard].append((key, packed))
+
+            if len(batches[shard]) >= _batch_size:
+               shard_queues[shard].put(batches[shard])
+               batches[shard] = []
+
+   for shard, batch in enumerate(batches):
+      if batch:
+         shard_queues[shard].put(batch)
+
+"""
+Deduplicate the positions that arrive on the queue and write the unique ones to the shard file at the given path.
+The positions are deduplicated exactly with a HashSet, unless bloom_bits is given, in which case a BloomFilter of that
+many bits takes its place.  The filter's memory doesn't grow with the number of positions, but a position it wrongly
+takes for one already seen is left out.  The worker stops after receiving one None from each replay worker, and then
+reports a tuple of (path, positions seen, positions written) on the results queue.
+"""
+def _shard_worker(queue, path, producers, bloom_bits, results):
+   seen = BloomFilter(bloom_bits) if bloom_bits else HashSet()
+   total = 0
+   written = 0
+
+   with open(path, 'wb') as f:
+      while producers:
+         batch = queue.get()
+
+         if batch == None:
+            producers -= 1
+            continue
+
+         for key, packed in batch:
+            total += 1
+
+            if bloom_bits:
+               if key in seen:
+                  continue
+
+               seen.add(key)
+            elif not seen.add(key):
+               continue
+
+            f.write(_key.pack(key))
+            f.write(packed)
+            written += 1
+
+   results.put((path, total, written))
+
+# Raise a RuntimeError, after stopping the rest of the worker processes, if any of them has died with an error.
+def _check_workers(procs):
+   dead = [p for p in procs if p.exitcode not in (None, 0)]
+
+   if dead:
+      for p in procs:
+         if p.is_alive():
+            p.terminate()
+
+      raise RuntimeError('Worker process %s exited with code %d' % (dead[0].name, dead[0].exitcode))
+
+# Call a queue's put or get with the given arguments until it succeeds, checking between tries that none of the worker
+# processes has died, and return what it returns.
+def _wait_on(procs, call, *args):
+   while True:
+      try:
+         return call(*args, timeout=_poll)
+      except (Queue.Full, Queue.Empty):
+         _check_workers(procs)
+
+# Join the given processes, checking that none of the worker processes has died with an error.
+def _join(procs, waiting):
+   for p in waiting:
+      while p.is_alive():
+         p.join(_poll)
+         _check_workers(procs)
+
+   _check_workers(procs)
+
+"""
+Write the unique positions of all games in the given PGN files to shard files in out_dir, using the given number of
+replay workers and shard workers.  The files may be compressed, as read_chunks() in the pgn module allows, and they're
+handed to the replay workers in chunks of about chunk_size characters.  If bloom_bits is given, each shard worker
+deduplicates with a Bloom filter of that many bits instead of an exact hash set, which bounds its memory at the cost of
+leaving out the occasional unique position.  Return a list of (path, positions seen, positions written) tuples, one per
+shard.  A RuntimeError is raised if a worker process dies.
+"""
+def deduplicate(paths, out_dir, workers=None, shards=None, bloom_bits=0, chunk_size=1 << 18):
+   if workers == None:
+      workers = multiprocessing.cpu_count()
+
+   if shards == None:
+      shards = workers
+
+   chunks = multiprocessing.Queue(maxsize=workers * 2)
+   shard_queues = [multiprocessing.Queue(maxsize=64) for i in range(shards)]
+   results = multiprocessing.Queue()
+   shard_paths = [os.path.join(out_dir, 'positions-%03d.bin' % i) for i in range(shards)]
+
+   shard_procs = [multiprocessing.Process(target=_shard_worker,
+                     args=(shard_queues[i], shard_paths[i], workers, bloom_bits, results)) for i in range(shards)]
+   replay_procs = [multiprocessing.Process(target=_replay_worker, args=(chunks, shard_queues))
+                     for i in range(workers)]
+   procs = shard_procs + replay_procs
+
+   for p in procs:
+      p.start()
+
+   try:
+      for path in paths:
+         for chunk in pgn.read_chunks(path, chunk_size):
+            _wait_on(procs, chunks.put, chunk)
+
+      for p in replay_procs:
+         _wait_on(procs, chunks.put, None)
+
+      _join(procs, replay_procs)
+
+      for q in shard_queues:
+         for p in replay_procs:
+            _wait_on(procs, q.put, None)
+
+      ret = sorted(_wait_on(procs, results.get) for p in shard_procs)
+      _join(procs, shard_procs)
+   finally:
+      for p in procs:
+         if p.is_alive():
+            p.terminate()
+
+   return ret
+
+"""
+Return the rolling hash of the positions of a game given as a list of SAN moves, starting with the initial position or
+the position of the given FEN, and the key of its final position, as a tuple.  The hash rolls up the hash_key() of
+each position in turn and nothing of the move text, so two games that pass through the same positions in the same
+order hash alike, however their moves are written, as with "Nbd2" and "N1d2".  A ValueError is raised for a bad FEN or
+an unplayable move.
+"""
+def game_hash(moves, fen=None):
+   b = pgn.initial_board(fen)
+   key = b.hash_key()
+   h = key
+
+   for move in moves:
+      b.movePGN(move)
+      key = b.hash_key()
+      h = (h * _roll + key) & 0xFFFFFFFFFFFFFFFF
+
+   return (h, key)
+
+# Return the game_hash() of every game in a chunk of PGN text, in order, with None for a game that can't be replayed.
+def _hash_chunk(chunk):
+   ret = []
+
+   for tags, moves in pgn.read_games(chunk.splitlines()):
+      try:
+         ret.append(game_hash(moves, tags.get('FEN')))
+      except ValueError:
+         ret.append(None)
+
+   return ret
+
+# Return the records of a partition file as a list of tuples, sorted in memory.
+def _sorted_partition(path):
+   with open(path, 'rb') as f:
+      data = f.read()
+
+   records = [_game_record.unpack_from(data, i) for i in range(0, len(data), _game_record.size)]
+   records.sort()
+
+   return records
+
+"""
+Find the duplicate games in the given PGN files, which may be compressed, using work_dir for partition files.  The
+games are handed in chunks of about chunk_size characters to the given number of worker processes, by default one per
+CPU, to be hashed, and the hashes are spread over the given number of partitions, each of which must fit in memory.
+Yield a tuple of (kind, hash, games) for each cluster of games, where games is a list of (path, game number) tuples
+numbering the games of each file from 0.  The kind is 'moves' for games that play the same moves from the same start.
+If final_positions is true, the kind is 'final' for games that play different moves to the same final position, as
+transposed games and games whose moves differ only in passing do, and each of its games stands for all of the games
+with the same moves.  Games that can't be replayed are left out.
+"""
+def find_duplicates(paths, work_dir, workers=None, partitions=16, final_positions=False, chunk_size=1 << 18):
+   kinds = ['moves', 'final'] if final_positions else ['moves']
+   files = dict((kind, [open(os.path.join(work_dir, '%s-%03d.bin' % (kind, i)), 'wb') for i in range(partitions)])
+                for kind in kinds)
+   pool = multiprocessing.Pool(workers)
+
+   try:
+      for index, path in enumerate(paths):
+         number = 0
+
+         for hashes in pool.imap(_hash_chunk, pgn.read_chunks(path, chunk_size)):
+            for game in hashes:
+               if game != None:
+                  moves, final = game
+                  files['moves'][shard_of(moves, partitions)].write(_game_record.pack(moves, moves, index, number))
+
+                  if final_positions:
+                     files['final'][shard_of(final, partitions)].write(_game_record.pack(final, moves, index, number))
+
+               number += 1
+   finally:
+      pool.close()
+      pool.join()
+
+      for kind in kinds:
+         for f in files[kind]:
+            f.close()
+
+   for kind in kinds:
+      for f in files[kind]:
+         records = _sorted_partition(f.name)
+         os.remove(f.name)
+         start = 0
+
+         while start < len(records):
+            end = start + 1
+
+            while end < len(records) and records[end][0] == records[start][0]:
+               end += 1
+
+            cluster = records[start:end]
+            start = end
+
+            if kind == 'final':
+               # Keep one game for each distinct sequence of moves that reached the position.
+               cluster = [r for i, r in enumerate(cluster) if i == 0 or r[1] != cluster[i - 1][1]]
+
+            if len(cluster) > 1:
+               yield (kind, cluster[0][0], [(paths[r[2]], r[3]) for r in cluster])
+
+"""
+Read the records in a shard file as tuples of (key, packed position).  Use Board.unpack() to turn a packed position
+back into a Board.
+"""
+def read_shard(path):
+   with open(path, 'rb') as f:
+      while True:
+         record = f.read(RECORD_SIZE)
+
+         if len(record) < RECORD_SIZE:
+            break
+
+         yield (_key.unpack_from(record)[0], record[_key.size:])
+
+def test_hash_set():
+   # Both layouts, whichever one HashSet has on this platform, with keys that only differ in their high words
+   for cls in (HashSet, _SplitHashSet):
+      s = cls(4)
+
+      for key in [0, 1, 17, 33, 2 ** 63 + 1, 2 ** 32 + 17] * 2 + range(100, 200):
+         s.add(key)
+
+      if len(s) != 106 or 17 not in s or 18 in s or 0 not in s or 2 ** 63 + 1 not in s or 2 ** 32 + 17 not in s or \
+         2 ** 32 + 18 in s or 2 ** 63 + 17 in s:
+         raise Exception('FAIL')
+
+def test_deduplicate():
+   import gzip
+   import shutil
+   import tempfile
+
+   tmp = tempfile.mkdtemp()
+
+   try:
+      path = os.path.join(tmp, 'games.pgn.gz')
+
+      with gzip.open(path, 'wb') as f:
+         f.write('1. e4 e5 2. Nf3 Nc6 *\n\n[Event "?"]\n\n1. Nf3 Nc6 2. e4 e5 *\n\n[Event "?"]\n\n1. d4 *\n')
+
+      # Exactly, and with a Bloom filter big enough not to mistake any of these positions for another
+      for bloom_bits in (0, 1024):
+         results = deduplicate([path], tmp, workers=2, shards=3, bloom_bits=bloom_bits, chunk_size=16)
+         keys = set()
+
+         for shard, seen, written in results:
+            for key, packed in read_shard(shard):
+               keys.add(key)
+
+               if board.Board.unpack(packed).hash_key() != key:
+                  raise Exception('FAIL')
+
+         # 12 positions were reached, of which the start is repeated twice and the final one once.
+         if sum(r[1] for r in results) != 12 or len(keys) != 9 or sum(r[2] for r in results) != 9:
+            raise Exception('FAIL')
+   finally:
+      shutil.rmtree(tmp)
+
+def test_dead_worker():
+   # Waiting on a queue nothing will ever arrive on gives up once a worker is found dead.
+   p = multiprocessing.Process(target=os._exit, args=(3,))
+   p.start()
+   queue = multiprocessing.Queue()
+
+   try:
+      _wait_on([p], queue.get)
+   except RuntimeError, e:
+      if 'exited with code 3' not in str(e):
+         raise Exception('FAIL')
+   else:
+      raise Exception('FAIL')
+
+def test_find_duplicates():
+   import gzip
+   import shutil
+   import tempfile
+
+   tmp = tempfile.mkdtemp()
+
+   try:
+      first = os.path.join(tmp, 'first.pgn')
+      second = os.path.join(tmp, 'second.pgn.gz')
+
+      # The same game with other headers and move text, a transposition of it, a game that's only a prefix of it,
+      # an illegal game, and an unrelated game
+      with open(first, 'w') as f:
+         f.write('[Event "A"]\n\n1. e4 e5 2. Nf3 Nc6 3. Nc3 Nf6 *\n\n[Event "B"]\n\n1. e4 e5 2. Nf3 *\n\n'
+                 '[Event "C"]\n\n1. e5 *\n\n[Event "D"]\n\n1. d4 d5 *\n')
+
+      with gzip.open(second, 'wb') as f:
+         f.write('[Event "A again"]\n[Site "?"]\n\n1.e4 e5 2.Ngf3 Nbc6 3.Nbc3 Ngf6 1-0\n\n'
+                 '[Event "E"]\n\n1. Nc3 Nf6 2. Nf3 Nc6 3. e4 e5 *\n')
+
+      clusters = list(find_duplicates([first, second], tmp, workers=2, partitions=3, chunk_size=16))
+
+      if [(kind, games) for kind, h, games in clusters] != [('moves', [(first, 0), (second, 0)])] or \
+         clusters[0][1] != game_hash(['e4', 'e5', 'Nf3', 'Nc6', 'Nc3', 'Nf6'])[0]:
+         raise Exception('FAIL')
+
+      clusters = list(find_duplicates([first, second], tmp, workers=1, partitions=2, final_positions=True))
+
+      if sorted((kind, sorted(games)) for kind, h, games in clusters) != \
+         [('final', [(first, 0), (second, 1)]), ('moves', [(first, 0), (second, 0)])]:
+         raise Exception('FAIL')
+
+      # The partition files are removed.
+      if sorted(os.listdir(tmp)) != ['first.pgn', 'second.pgn.gz']:
+         raise Exception('FAIL')
+   finally:
+      shutil.rmtree(tmp)
+
+def main():
+   test_hash_set()
+   test_deduplicate()
+   test_dead_worker()
+   test_find_duplicates()
+
+if __name__ == '__main__':
+   main()
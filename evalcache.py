@@ -0,0 +1,279 @@
+import mmap
+import os
+import struct
+
+import board
+
+"""
+A bounded cache of evaluations, for replays and queries that evaluate the same positions over and over.  Once
+Board.eval_cache is set to an EvalCache, evaluate() looks up the features of a position by its Zobrist hash before
+working them out.  The features are cached rather than the scores, since they depend only on where the pieces stand,
+so positions that differ only in the side to play, castling rights, or en passant target share an entry, and weights
+loaded with tune.load_weights() apply to cached positions as well.
+
+The cache is a table of capacity entries in buckets of ways entries each.  A position goes in the bucket its hash
+picks, in front of the entries already there, and the last entry of a full bucket is evicted.  With the 'lru' eviction
+policy an entry found in the cache is moved back to the front of its bucket, and with 'fifo' entries stay in the order
+they came in.
+
+Given a path, the table is kept in a file through a memory map, so that it survives the process and the next run
+starts warm.  The file starts with a header that records the table's layout, the number of features, and a
+fingerprint of the Zobrist keys, and a file that doesn't match the cache being opened is cleared.  Only one process
+should have a file open at a time.
+"""
+
+EVICTIONS = ('lru', 'fifo')
+
+_magic = 'PGNEVAL1'
+_header = struct.Struct('>8sIIIQ')
+_key = struct.Struct('>Q')
+# A slot is a 64-bit hash and a 16-bit count for each feature.  A hash of 0 marks an empty slot.
+_slot = struct.Struct('>Q%dh' % len(board.Board.EVAL_FEATURES))
+
+# Return a number that changes with the Zobrist keys, which the hashes in a file are only good for.
+def _fingerprint():
+   b = board.Board()
+   b.initialize()
+
+   return b.zobrist
+
+"""
+An EvalCache holds the features of up to capacity positions, in memory or in a file at the given path.  The hits and
+misses of features() are counted in hits and misses, and the entries pushed out of full buckets in evictions.
+"""
+class EvalCache(object):
+   def __init__(self, capacity=1 << 16, ways=4, eviction='lru', path=None):
+      if eviction not in EVICTIONS:
+         raise ValueError('Unknown eviction policy: %s' % eviction)
+
+      if capacity < 1 or ways < 1:
+         raise ValueError('Capacity and ways must be positive: %d, %d' % (capacity, ways))
+
+      self.ways = min(ways, capacity)
+      self.buckets = (capacity + self.ways - 1) / self.ways
+      self.capacity = self.buckets * self.ways
+      self.eviction = eviction
+      self.path = path
+      self.hits = 0
+      self.misses = 0
+      self.evictions = 0
+      self.file = None
+      header = _header.pack(_magic, self.buckets, self.ways, len(board.Board.EVAL_FEATURES), _fingerprint())
+      size = _header.size + self.capacity * _slot.size
+
+      if path == None:
+         self.data = bytearray(size)
+      else:
+         self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+
+         if os.fstat(self.file.fileno()).st_size != size or self.file.read(_header.size) != header:
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.write(header)
+            self.file.truncate(size)
+
+         self.data = mmap.mmap(self.file.fileno(), size)
+
+      self.data[:_header.size] = header
+
+   """
+   Return the features of a board, as Board.features() does, from the cache if they're there and otherwise worked out
+   and added to it.
+   """
+   def features(self, b):
+      key = b.zobrist
+
+      # The empty board hashes to the marker of an empty slot, and isn't worth caching.
+      if key == 0:
+         return b.features()
+
+      start = _header.size + (key % self.buckets) * self.ways * _slot.size
+      data = self.data
+
+      for way in range(self.ways):
+         offset = start + way * _slot.size
+         found = _key.unpack_from(data, offset)[0]
+
+         if found == 0:
+            break
+
+         if found == key:
+            self.hits += 1
+            entry = _slot.unpack_from(data, offset)
+
+            if way and self.eviction == 'lru':
+               data[start + _slot.size:offset + _slot.size] = data[start:offset]
+               data[start:start + _slot.size] = _slot.pack(*entry)
+
+            return list(entry[1:])
+
+      self.misses += 1
+      features = b.features()
+
+      # Counts too big for a slot are left out, which can't happen with real positions.
+      if [value for value in features if not -0x8000 <= value < 0x8000]:
+         return features
+
+      end = start + self.ways * _slot.size
+
+      if _key.unpack_from(data, end - _slot.size)[0] != 0:
+         self.evictions += 1
+
+      data[start + _slot.size:end] = data[start:end - _slot.size]
+      _slot.pack_into(data, start, key, *features)
+
+      return features
+
+   """
+   Return the fraction of features() calls that were answered from the cache, or 0 before any calls.
+   """
+   def hit_ratio(self):
+      calls = self.hits + self.misses
+
+      return float(self.hits) / calls if calls else 0.0
+
+   """
+   Empty the cache.  The counters are left alone.
+   """
+   def clear(self):
+      self.data[_header.size:] = '\0' * (self.capacity * _slot.size)
+
+   """
+   Write the table to its file, if it has one.
+   """
+   def flush(self):
+      if self.file != None:
+         self.data.flush()
+
+   def close(self):
+      if self.file != None:
+         self.data.close()
+         self.file.close()
+         self.file = None
+
+def test_cache():
+   b = board.Board()
+   b.initialize()
+   cache = EvalCache(capacity=8, ways=2)
+   expected = b.features()
+
+   if cache.features(b) != expected or cache.features(b) != expected or (cache.hits, cache.misses) != (1, 1):
+      raise Exception('FAIL')
+
+   # The side to play doesn't matter to the features, so 1. Nf3 Nf6 2. Ng1 Ng8 finds the entry again.
+   for move in ['Nf3', 'Nf6', 'Ng1', 'Ng8']:
+      b.movePGN(move)
+      cache.features(b)
+
+   if cache.hits != 2 or cache.misses != 4 or cache.hit_ratio() != 2 / 6.0:
+      raise Exception('FAIL')
+
+   saved = board.Board.eval_cache
+   board.Board.eval_cache = cache
+
+   try:
+      b.movePGN('e4')
+
+      if b.evaluate() != dict(zip((board.Board.WHITE, board.Board.BLACK), _scores(b))) or cache.misses != 5:
+         raise Exception('FAIL')
+   finally:
+      board.Board.eval_cache = saved
+
+   # A pawn up in a corrupted slot shows the entry came from the cache.
+   cache.clear()
+   cache.features(b)
+   start = _header.size + (b.zobrist % cache.buckets) * cache.ways * _slot.size
+   entry = list(_slot.unpack_from(cache.data, start))
+   entry[1 + board.Board.EVAL_FEATURES.index('P')] = 1
+   _slot.pack_into(cache.data, start, *entry)
+
+   if cache.features(b)[board.Board.EVAL_FEATURES.index('P')] != 1:
+      raise Exception('FAIL')
+
+   try:
+      EvalCache(eviction='random')
+   except ValueError:
+      pass
+   else:
+      raise Exception('FAIL')
+
+# Return evaluate()'s scores for white and black worked out without a cache.
+def _scores(b):
+   score = sum(board.Board.EVAL_WEIGHTS[name] * value for name, value in zip(board.Board.EVAL_FEATURES, b.features()))
+
+   return (score, -score)
+
+# Make boards with the given numbers of extra white knights, which differ in their features, all hashing to one bucket
+# of a cache with a single bucket.
+def _knight_boards(count):
+   boards = []
+
+   for n in range(count):
+      b = board.Board.from_fen('4k3/8/8/8/8/8/8/4K3 w - - 0 1')
+
+      for i in range(n):
+         board.Knight(b, 2 + i / 8, i % 8, board.Board.WHITE)
+
+      boards.append(b)
+
+   return boards
+
+def test_eviction():
+   for eviction, survivor in (('lru', 0), ('fifo', 1)):
+      cache = EvalCache(capacity=2, ways=2, eviction=eviction)
+      boards = _knight_boards(3)
+      cache.features(boards[0])
+      cache.features(boards[1])
+      # With 'lru' this moves the first board back to the front, so the second is the one evicted.
+      cache.features(boards[0])
+      cache.features(boards[2])
+
+      if cache.evictions != 1 or (cache.hits, cache.misses) != (1, 3):
+         raise Exception('FAIL')
+
+      cache.features(boards[survivor])
+
+      if cache.hits != 2:
+         raise Exception('FAIL')
+
+def test_persist():
+   import tempfile
+
+   fd, path = tempfile.mkstemp(suffix='.evc')
+   os.close(fd)
+   boards = _knight_boards(4)
+
+   try:
+      cache = EvalCache(capacity=16, path=path)
+
+      for b in boards:
+         cache.features(b)
+
+      cache.close()
+
+      # A second run finds the positions already there.
+      cache = EvalCache(capacity=16, path=path)
+
+      if [cache.features(b) for b in boards] != [b.features() for b in boards] or cache.hits != 4:
+         raise Exception('FAIL')
+
+      cache.close()
+
+      # A file laid out for another capacity is cleared.
+      cache = EvalCache(capacity=32, path=path)
+      cache.features(boards[0])
+
+      if cache.misses != 1 or os.path.getsize(path) != _header.size + 32 * _slot.size:
+         raise Exception('FAIL')
+
+      cache.close()
+   finally:
+      os.remove(path)
+
+def main():
+   test_cache()
+   test_eviction()
+   test_persist()
+
+if __name__ == '__main__':
+   main()
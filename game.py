@@ -0,0 +1,148 @@
+import collections
+
+import board
+import pgn
+
+"""
+Random access to the positions of a game.  A Game keeps a packed snapshot of every interval-th position it passes
+while replaying, and the boards it most recently handed out.  Asking for the board at some ply replays only from the
+nearest earlier snapshot or cached board, rather than from the initial position.
+"""
+
+"""
+A Game holds the SAN moves of one game and its tags.  The game starts from the position in its FEN tag, if it has one.
+Snapshots are taken every interval plies, and the last cache_size boards materialized are kept.
+"""
+class Game(object):
+   def __init__(self, moves, tags=None, interval=16, cache_size=8):
+      if interval < 1:
+         raise ValueError('Bad snapshot interval: %d' % interval)
+
+      self.moves = list(moves)
+      self.tags = tags if tags != None else {}
+      self.interval = interval
+      self.cache_size = cache_size
+      self.snapshots = {}
+      self.boards = collections.OrderedDict()
+      # The hash_key() of each position reached so far, by ply, which restored boards take their history from
+      self.keys = []
+      self.hits = 0
+      self.misses = 0
+      self.replayed = 0
+
+      b = pgn.initial_board(self.tags.get('FEN'))
+      self.keys.append(b.hash_key())
+      self._snapshot(0, b)
+
+   """
+   Return the number of moves in the game.
+   """
+   def __len__(self):
+      return len(self.moves)
+
+   """
+   Return the board after the given number of plies, where 0 is the initial position.  The board is shared with the
+   cache, so it must not be modified; use Board.copy() to play on from it.  A ValueError is raised if the ply is out of
+   range or a move before it can't be played.
+   """
+   def board(self, ply):
+      if ply < 0 or ply > len(self.moves):
+         raise ValueError('Bad ply: %d' % ply)
+
+      b = self.boards.pop(ply, None)
+
+      if b != None:
+         self.hits += 1
+         self.boards[ply] = b
+         return b
+
+      self.misses += 1
+      start = max(p for p in self.snapshots if p <= ply)
+      cached = [p for p in self.boards if p > start and p < ply]
+
+      if cached:
+         start = max(cached)
+         b = self.boards[start].copy()
+      else:
+         b = self._restore(start)
+
+      for p in range(start, ply):
+         b.movePGN(self.moves[p])
+         self.replayed += 1
+
+         if len(self.keys) == p + 1:
+            self.keys.append(b.hash_key())
+
+         if (p + 1) % self.interval == 0 and p + 1 not in self.snapshots:
+            self._snapshot(p + 1, b)
+
+      self.boards[ply] = b
+
+      if len(self.boards) > self.cache_size:
+         self.boards.popitem(last=False)
+
+      return b
+
+   """
+   Return the board after the last move.
+   """
+   def final(self):
+      return self.board(len(self.moves))
+
+   def _snapshot(self, ply, b):
+      self.snapshots[ply] = (b.pack(), b.halfmove_clock, b.fullmove_number, b.check, b._castle_squares,
+         b._castle_masks)
+
+   def _restore(self, ply):
+      packed, halfmove_clock, fullmove_number, check, castle_squares, castle_masks = self.snapshots[ply]
+      b = board.Board.unpack(packed)
+      b._castle_squares = castle_squares
+      b._castle_masks = castle_masks
+      b.halfmove_clock = halfmove_clock
+      b.fullmove_number = fullmove_number
+      b.check = check
+      b.history = self.keys[:ply]
+
+      return b
+
+"""
+Read the games in a file-like object of PGN text as Game objects, passing any keyword arguments on to Game.
+"""
+def read_games(f, **kwargs):
+   for tags, moves in pgn.read_games(f):
+      yield Game(moves, tags, **kwargs)
+
+def test_game():
+   moves = ['e4', 'e5', 'Nf3', 'Nc6', 'Bb5', 'a6', 'Ba4', 'Nf6', 'O-O', 'Be7', 'Re1', 'b5', 'Bb3', 'd6', 'c3', 'O-O',
+            'h3', 'Nb8', 'd4', 'Nbd7', 'c4', 'c6', 'cxb5', 'axb5', 'Nc3', 'Bb7', 'Bg5', 'b4']
+   g = Game(moves, interval=10, cache_size=2)
+   expected = pgn.replay(moves[:25])
+
+   if g.board(25).encode() != expected.encode() or g.board(25).history != expected.history or g.replayed != 25:
+      raise Exception('FAIL')
+
+   # From the snapshot at ply 20, then from the board cached at ply 25, then straight from the cache
+   if g.board(23).encode() != pgn.replay(moves[:23]).encode() or g.replayed != 28:
+      raise Exception('FAIL')
+
+   if g.board(27).hash_key() != pgn.replay(moves[:27]).hash_key() or g.replayed != 30:
+      raise Exception('FAIL')
+
+   if g.board(27).fullmove_number != 14 or g.hits != 2:
+      raise Exception('FAIL')
+
+   # The board at ply 25 has been evicted, and is rebuilt from the board cached at ply 23.
+   if g.board(25).fullmove_number != 13 or g.replayed != 32 or sorted(g.snapshots) != [0, 10, 20]:
+      raise Exception('FAIL')
+
+   b = g.board(27).copy()
+   b.movePGN('b4')
+
+   if g.board(27).get('b4') != None or b.get('b4') == None:
+      raise Exception('FAIL')
+
+def main():
+   test_game()
+
+if __name__ == '__main__':
+   main()
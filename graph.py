@@ -0,0 +1,282 @@
+import struct
+
+import board
+import pgn
+
+"""
+Piece interaction graphs.  Each piece is a node named by Piece.nodename(), and there's an edge from every piece to
+every piece on a square it covers, an attack if the two are of different colors and a defense if they're of the same
+color.  An InteractionGraph keeps the edges of a board up to date as moves are made on it, and the edges that come and
+go with each ply can be streamed to a sink as a CSV file or as compact binary records.
+"""
+
+ATTACK = 'a'
+DEFEND = 'd'
+
+"""
+An InteractionGraph follows the pieces on a board.  Call update() after moves are made on the board to bring the edges
+up to date.  Only the edges of the pieces that moved or were taken or put, and of the pieces covering the squares that
+changed, are worked out again, so a slider is only looked at when a square on one of its rays changes.
+"""
+class InteractionGraph(object):
+   def __init__(self, b):
+      self.board = b
+      # The board's pieces as of the last update, to find the squares that changed
+      self.squares = [None] * 64
+      # The squares each piece covers, the pieces covering each square, and the pieces each piece covers
+      self.cover = {}
+      self.coverers = [set() for i in range(64)]
+      self.targets = {}
+      self.update()
+
+   """
+   Return the edges as a sorted list of (source nodename, target nodename, kind) tuples, where the kind is ATTACK or
+   DEFEND.
+   """
+   def edges(self):
+      return sorted(_edge(piece, target) for piece, targets in self.targets.iteritems() for target in targets)
+
+   """
+   Bring the edges up to date with the board, and return the edges that were added and removed, each as a sorted list
+   as edges() returns.
+   """
+   def update(self):
+      pieces = self.board.pieces
+      changed = [i for i in range(64) if pieces[i] is not self.squares[i]]
+      affected = set()
+
+      for i in changed:
+         affected.update(self.coverers[i])
+
+         if self.squares[i] != None:
+            affected.add(self.squares[i])
+
+         if pieces[i] != None:
+            affected.add(pieces[i])
+
+      added = []
+      removed = []
+
+      for piece in affected:
+         for i in self.cover.pop(piece, ()):
+            self.coverers[i].discard(piece)
+
+         old = self.targets.pop(piece, set())
+         new = set()
+
+         # A piece that was taken has no square, and one that moved away has an empty square or another piece on it.
+         if piece.rank != None and pieces[piece.file * 8 + piece.rank] is piece:
+            cover = piece.cover_indices()
+            self.cover[piece] = cover
+
+            for i in cover:
+               self.coverers[i].add(piece)
+
+               if pieces[i] != None:
+                  new.add(pieces[i])
+
+            self.targets[piece] = new
+
+         added += [_edge(piece, target) for target in new - old]
+         removed += [_edge(piece, target) for target in old - new]
+
+      self.squares = list(pieces)
+      added.sort()
+      removed.sort()
+
+      return (added, removed)
+
+# Return the edge tuple from a piece to a piece it covers.
+def _edge(piece, target):
+   return (piece.nodename(), target.nodename(), ATTACK if piece.color != target.color else DEFEND)
+
+"""
+Replay a game given as a list of SAN moves, starting with the initial position or the position of the given FEN, and
+yield a tuple of (ply, added, removed) for every position, where added and removed are lists of edges as
+InteractionGraph.update() returns them.  Ply 0 is the starting position, all of whose edges are added.  A game with an
+unplayable move is replayed up to that move, and a game with a FEN that can't be read yields nothing.
+"""
+def game_diffs(moves, fen=None):
+   try:
+      b = pgn.initial_board(fen)
+   except ValueError:
+      return
+
+   graph = InteractionGraph(b)
+
+   yield (0, graph.edges(), [])
+
+   for ply, move in enumerate(moves):
+      try:
+         b.movePGN(move)
+      except ValueError:
+         return
+
+      added, removed = graph.update()
+
+      yield (ply + 1, added, removed)
+
+"""
+Write the edge diffs of every position of the given games, as (tags, moves) tuples, to a sink.  Games are numbered by
+their place in the sequence, and games with a FEN that can't be read are skipped.  Return the number of games written.
+"""
+def export(games, sink):
+   count = 0
+
+   for number, (tags, moves) in enumerate(games):
+      written = False
+
+      for ply, added, removed in game_diffs(moves, tags.get('FEN')):
+         sink.write(number, ply, added, removed)
+         written = True
+
+      count += written
+
+   return count
+
+"""
+A CSVSink writes edge diffs to a file-like object as lines of game number, ply, + or -, source, target, and kind, as
+in "0,1,+,wP4,bP3,a".
+"""
+class CSVSink(object):
+   def __init__(self, f):
+      self.file = f
+
+   def write(self, number, ply, added, removed):
+      for sign, edges in (('-', removed), ('+', added)):
+         for src, dest, kind in edges:
+            self.file.write('%d,%d,%s,%s,%s,%s\n' % (number, ply, sign, src, dest, kind))
+
+"""
+A BinarySink writes edge diffs to a file-like object as 9-byte big-endian records of a 32-bit game number, a 16-bit
+ply, a byte of flags, and a byte for each of the source and target pieces.  Flag bit 0 is set for added edges and bit 1
+for attacks.  A piece byte holds the color in bit 7, the index of the piece's letter in PIECE_LETTERS in bits 4 to 6,
+and its id in bits 0 to 3.  read_binary() reads the records back.
+"""
+class BinarySink(object):
+   def __init__(self, f):
+      self.file = f
+
+   def write(self, number, ply, added, removed):
+      records = []
+
+      for flag, edges in ((0, removed), (1, added)):
+         for src, dest, kind in edges:
+            records.append(_record.pack(number, ply, flag | (2 if kind == ATTACK else 0), _node_code(src),
+                                        _node_code(dest)))
+
+      self.file.write(''.join(records))
+
+PIECE_LETTERS = 'PNBRQK'
+
+_record = struct.Struct('>IHBBB')
+
+# Return the byte a BinarySink writes for a nodename.
+def _node_code(name):
+   id = int(name[2:])
+
+   if id > 15:
+      raise ValueError('Piece id is too large: %s' % name)
+
+   return (128 if name[0] == board.Board.BLACK[0] else 0) | (PIECE_LETTERS.index(name[1]) << 4) | id
+
+# Return the nodename for a byte a BinarySink wrote.
+def _node_name(code):
+   color = board.Board.BLACK if code & 128 else board.Board.WHITE
+
+   return color[0] + PIECE_LETTERS[(code >> 4) & 7] + str(code & 15)
+
+"""
+Read the records a BinarySink wrote to a file-like object, yielding a tuple of (game number, ply, + or -, source,
+target, kind) for each, as the CSV lines have them.
+"""
+def read_binary(f):
+   while True:
+      data = f.read(_record.size)
+
+      if len(data) < _record.size:
+         return
+
+      number, ply, flags, src, dest = _record.unpack(data)
+
+      yield (number, ply, '+' if flags & 1 else '-', _node_name(src), _node_name(dest),
+             ATTACK if flags & 2 else DEFEND)
+
+# Return the edges of a board worked out from scratch, to check the incremental updates against.
+def _full_edges(b):
+   edges = []
+
+   for piece in b.pieces:
+      if piece != None:
+         edges += [_edge(piece, b.pieces[i]) for i in piece.cover_indices() if b.pieces[i] != None]
+
+   return sorted(edges)
+
+def test_update():
+   moves = ['e4', 'd5', 'exd5', 'Qxd5', 'Nc3', 'Qa5', 'd4', 'c6', 'Nf3', 'Bg4', 'Bf4', 'e6', 'h3', 'Bxf3', 'Qxf3',
+            'Bb4', 'Be2', 'Nd7', 'a3', 'O-O-O', 'axb4', 'Qxa1+', 'Kd2', 'Qxh1', 'Qxc6+', 'bxc6', 'Ba6#']
+   b = pgn.initial_board()
+   graph = InteractionGraph(b)
+   edges = set(graph.edges())
+
+   if graph.edges() != _full_edges(b) or ('wN1', 'wP4', DEFEND) not in edges or len(edges) != 40:
+      raise Exception('FAIL')
+
+   for move in moves:
+      b.movePGN(move)
+      added, removed = graph.update()
+
+      if set(added) & edges or set(removed) - edges:
+         raise Exception('FAIL')
+
+      edges = (edges - set(removed)) | set(added)
+
+      if sorted(edges) != graph.edges() or graph.edges() != _full_edges(b):
+         raise Exception('FAIL')
+
+   # Nothing changes without a move, and en passant and promotion both change the pieces.
+   if graph.update() != ([], []):
+      raise Exception('FAIL')
+
+   b = board.Board.from_fen('4k3/1P6/8/3pP3/8/8/8/4K3 w - d6 0 1')
+   graph = InteractionGraph(b)
+
+   for move in ['exd6', 'Kd7', 'b8=N+']:
+      b.movePGN(move)
+      added, removed = graph.update()
+
+      if graph.edges() != _full_edges(b):
+         raise Exception('FAIL')
+
+   if ('wN0', 'bK0', ATTACK) not in added or ('wP1', 'bK0', ATTACK) in graph.edges():
+      raise Exception('FAIL')
+
+def test_sinks():
+   import StringIO
+
+   games = [({}, ['e4', 'e5', 'Nf3']), ({'FEN': 'bad'}, ['e4']),
+            ({'FEN': '4k3/8/8/8/8/8/8/R3K3 w - - 0 1'}, ['Ra8+', 'Kd7'])]
+   text = StringIO.StringIO()
+   data = StringIO.StringIO()
+
+   if export(games, CSVSink(text)) != 2 or export(games, BinarySink(data)) != 2:
+      raise Exception('FAIL')
+
+   lines = text.getvalue().splitlines()
+   data.seek(0)
+   records = list(read_binary(data))
+
+   if [','.join(str(field) for field in r) for r in records] != lines or \
+      len(data.getvalue()) != len(lines) * _record.size:
+      raise Exception('FAIL')
+
+   if '2,1,+,wR0,bK0,a' not in lines or '2,2,-,wR0,bK0,a' not in lines or '2,0,+,wR0,wK0,d' not in lines or \
+      [line for line in lines if line.startswith('1,')]:
+      raise Exception('FAIL')
+
+def main():
+   test_update()
+   test_sinks()
+
+if __name__ == '__main__':
+   main()
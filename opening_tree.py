@@ -0,0 +1,390 @@
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+
+import board
+import pgn
+
+"""
+Opening statistics aggregated from game archives.  An OpeningTreeBuilder replays games and counts, for every position
+and every move played from it, how many games passed through and how they ended.  Positions are keyed by
+Board.hash_key() rather than by encode() strings, and the counts are held in a dict of bounded size that is spilled to
+disk as a sorted run whenever it fills up.  The runs are merged into a single sorted file that an OpeningTree
+searches through a memory map, so neither building nor querying needs to hold the whole tree in memory.
+"""
+
+# Each record is a position key, a move code (0 for the position itself), and the counts of games, white wins, draws,
+# and black wins.  Records are big-endian so that ordering the packed bytes orders them by key and then by move.
+_record = struct.Struct('>QHIIII')
+_prefix = struct.Struct('>QH')
+
+"""
+Read the records in a run file in order, as tuples of ((key, code), counts).
+"""
+def _read_run(path, chunk=4096):
+   with open(path, 'rb') as f:
+      while True:
+         data = f.read(_record.size * chunk)
+
+         if not data:
+            break
+
+         for i in range(0, len(data), _record.size):
+            r = _record.unpack_from(data, i)
+            yield ((r[0], r[1]), list(r[2:]))
+
+"""
+Write sorted records to a file, adding together the counts of neighboring records with the same key and move.
+"""
+def _write_run(path, records):
+   with open(path, 'wb') as f:
+      last = None
+      total = None
+
+      for item, counts in records:
+         if item == last:
+            for i in range(4):
+               total[i] += counts[i]
+         else:
+            if last != None:
+               f.write(_record.pack(last[0], last[1], *total))
+
+            last = item
+            total = list(counts)
+
+      if last != None:
+         f.write(_record.pack(last[0], last[1], *total))
+
+"""
+The OpeningTreeBuilder accumulates opening statistics.  At most run_size distinct (position, move) entries are kept
+in memory at a time, and at most fan_in run files are merged at once.  Only the first max_ply moves of each game are
+counted, or all of them if max_ply is None.
+"""
+class OpeningTreeBuilder(object):
+   def __init__(self, max_ply=None, run_size=500000, fan_in=64, tmpdir=None):
+      self.max_ply = max_ply
+      self.run_size = run_size
+      self.fan_in = fan_in
+      self.tmpdir = tmpdir
+      self.counts = {}
+      self.runs = []
+      self.games = 0
+      self.errors = 0
+      self.last_move = None
+
+   """
+   Count the positions and moves of every game in a file-like object of PGN text.  The games are counted batch_size
+   at a time with add_games().
+   """
+   def add_pgn(self, f, batch_size=10000):
+      batch = []
+
+      for game in pgn.read_games(f):
+         batch.append(game)
+
+         if len(batch) == batch_size:
+            self.add_games(batch)
+            batch = []
+
+      self.add_games(batch)
+
+   """
+   Count the positions and moves of many games, given as (tags, moves) tuples, just as add_game() would count each of
+   them.  The games are replayed together with replay_games() in the pgn module, so the openings they share are only
+   played once.
+   """
+   def add_games(self, games):
+      games = list(games)
+      outcomes = [pgn.outcomes.get(tags.get('Result')) for tags, moves in games]
+      starts = {}
+      # The (key, code) pairs already counted for each game, by game number
+      counted = {}
+
+      if self.max_ply != None:
+         games = [(tags, moves[:self.max_ply]) for tags, moves in games]
+
+      def listener(number, b, ply, move):
+         src, dest = self.last_move
+         promotion = board.Board.parse_move(move)[4]
+         seen = counted.setdefault(number, set())
+
+         # The history ends with the key of the position the move was made from.
+         self._count(b.history[-1], board.Board.move_code(src, dest, promotion), outcomes[number], seen)
+         self._count(b.hash_key(), 0, outcomes[number], seen)
+
+      for number, b, error in pgn.replay_games(games, listener, self._listen):
+         seen = counted.pop(number, set())
+
+         if b == None:
+            self.errors += 1
+            continue
+
+         fen = games[number][0].get('FEN')
+
+         if fen not in starts:
+            starts[fen] = pgn.initial_board(fen).hash_key()
+
+         self.games += 1
+         self._count(starts[fen], 0, outcomes[number], seen)
+
+         if error != None:
+            self.errors += 1
+
+   """
+   Count the positions and moves of one game given as a list of SAN moves.  The result is the text of the game's
+   Result tag, and the game starts from the given FEN, if any.  A game with an unplayable move is counted up to that
+   move.
+   """
+   def add_game(self, moves, result=None, fen=None):
+      outcome = pgn.outcomes.get(result)
+
+      try:
+         b = pgn.initial_board(fen)
+      except ValueError:
+         self.errors += 1
+         return
+
+      b.add_move_listener(self._listen)
+      key = b.hash_key()
+      seen = set()
+      self.games += 1
+      self._count(key, 0, outcome, seen)
+
+      for ply, move in enumerate(moves):
+         if self.max_ply != None and ply >= self.max_ply:
+            break
+
+         try:
+            b.movePGN(move)
+         except ValueError:
+            self.errors += 1
+            break
+
+         # When castling the king moves last, so the move is recorded as the king's move.
+         src, dest = self.last_move
+         promotion = board.Board.parse_move(move)[4]
+
+         self._count(key, board.Board.move_code(src, dest, promotion), outcome, seen)
+         key = b.hash_key()
+         self._count(key, 0, outcome, seen)
+
+   """
+   Spill whatever is still in memory, merge all of the runs into a single file at the given path, and return an
+   OpeningTree for it.
+   """
+   def finish(self, path):
+      self._spill()
+
+      # Merge in rounds so that we never have more than fan_in files open at once.
+      while len(self.runs) > self.fan_in:
+         group = self.runs[:self.fan_in]
+         self.runs = self.runs[self.fan_in:] + [self._merge(group)]
+
+      _write_run(path, heapq.merge(*[_read_run(run) for run in self.runs]))
+
+      for run in self.runs:
+         os.remove(run)
+
+      self.runs = []
+
+      return OpeningTree(path)
+
+   def _listen(self, piece, src, dest):
+      self.last_move = (board.Board._arg_to_rf(src), board.Board._arg_to_rf(dest))
+
+   # Count a game for a position or a move from it, unless the game was already counted for it, as when a position is
+   # repeated.  seen holds the (key, code) pairs the game has been counted for.
+   def _count(self, key, code, outcome, seen):
+      if (key, code) in seen:
+         return
+
+      seen.add((key, code))
+      counts = self.counts.get((key, code))
+
+      if counts == None:
+         if len(self.counts) >= self.run_size:
+            self._spill()
+
+         counts = self.counts[(key, code)] = [0, 0, 0, 0]
+
+      counts[0] += 1
+
+      if outcome != None:
+         counts[outcome] += 1
+
+   def _spill(self):
+      if self.counts:
+         fd, path = tempfile.mkstemp(suffix='.run', dir=self.tmpdir)
+         os.close(fd)
+         _write_run(path, sorted(self.counts.iteritems()))
+         self.runs.append(path)
+         self.counts = {}
+
+   def _merge(self, runs):
+      fd, path = tempfile.mkstemp(suffix='.run', dir=self.tmpdir)
+      os.close(fd)
+      _write_run(path, heapq.merge(*[_read_run(run) for run in runs]))
+
+      for run in runs:
+         os.remove(run)
+
+      return path
+
+"""
+An OpeningTree answers queries against a file written by OpeningTreeBuilder.finish().  Positions are given either as
+a Board or as a key from Board.hash_key().  Counts are returned as tuples of (games, white, draws, black).
+"""
+class OpeningTree(object):
+   def __init__(self, path):
+      self.file = open(path, 'rb')
+      size = os.fstat(self.file.fileno()).st_size
+      self.size = size / _record.size
+      self.data = ''
+
+      if size:
+         self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+   """
+   Return the counts for the given position, or None if it was never reached.
+   """
+   def stats(self, position):
+      key = self._key(position)
+      i = self._find(key, 0)
+
+      if i < self.size and _prefix.unpack_from(self.data, i * _record.size) == (key, 0):
+         return _record.unpack_from(self.data, i * _record.size)[2:]
+
+      return None
+
+   """
+   Return the moves played from the given position as a list of (move, counts) tuples, most played first.  Each move
+   is a tuple of (src, dest, promotion) as returned by Board.move_from_code().
+   """
+   def moves(self, position):
+      key = self._key(position)
+      ret = []
+      i = self._find(key, 1)
+
+      while i < self.size:
+         r = _record.unpack_from(self.data, i * _record.size)
+
+         if r[0] != key:
+            break
+
+         ret.append((board.Board.move_from_code(r[1]), r[2:]))
+         i += 1
+
+      ret.sort(key=lambda m: -m[1][0])
+
+      return ret
+
+   def close(self):
+      if self.data:
+         self.data.close()
+
+      self.file.close()
+
+   def _key(self, position):
+      if isinstance(position, board.Board):
+         return position.hash_key()
+
+      return position
+
+   # Binary search for the first record at or after the given key and move.
+   def _find(self, key, code):
+      target = _prefix.pack(key, code)
+      lo = 0
+      hi = self.size
+
+      while lo < hi:
+         mid = (lo + hi) / 2
+         start = mid * _record.size
+
+         if self.data[start:start + _prefix.size] < target:
+            lo = mid + 1
+         else:
+            hi = mid
+
+      return lo
+
+def test_build_and_query():
+   games = [(['e4', 'e5', 'Nf3'], '1-0'), (['e4', 'c5'], '0-1'), (['d4', 'd5'], '1/2-1/2'), (['e4', 'e5'], '1-0')]
+   builder = OpeningTreeBuilder(run_size=3, fan_in=2)
+
+   for moves, result in games:
+      builder.add_game(moves, result)
+
+   fd, path = tempfile.mkstemp(suffix='.tree')
+   os.close(fd)
+
+   try:
+      tree = builder.finish(path)
+      b = board.Board()
+      b.initialize()
+
+      if tree.stats(b) != (4, 2, 1, 1):
+         raise Exception('FAIL')
+
+      moves = tree.moves(b)
+
+      if len(moves) != 2 or moves[0] != (((1, 4), (3, 4), None), (3, 2, 0, 1)):
+         raise Exception('FAIL')
+
+      b.movePGN('e4')
+      b.movePGN('e5')
+
+      if tree.stats(b) != (2, 2, 0, 0) or tree.stats(12345) != None:
+         raise Exception('FAIL')
+
+      tree.close()
+
+      # Replaying the games together gives the same tree as replaying them one by one, up to a bad move.
+      games.append((['e4', 'e5', 'Ke3'], '0-1'))
+      single = OpeningTreeBuilder(max_ply=3)
+      shared = OpeningTreeBuilder(max_ply=3)
+
+      for moves, result in games:
+         single.add_game(moves, result)
+
+      shared.add_games([({'Result': result}, moves) for moves, result in games])
+      single.finish(path).close()
+      shared.finish(path + '.shared').close()
+
+      with open(path, 'rb') as f, open(path + '.shared', 'rb') as g:
+         if f.read() != g.read() or (shared.games, shared.errors, single.games, single.errors) != (5, 1, 5, 1):
+            raise Exception('FAIL')
+
+      # A game that goes back to a position counts once for it, and once for each move played from it.
+      repeated = ['Nf3', 'Nf6', 'Ng1', 'Ng8', 'Nf3', 'Nf6', 'Ng1', 'Ng8']
+      single = OpeningTreeBuilder()
+      shared = OpeningTreeBuilder()
+      single.add_game(repeated, '1-0')
+      shared.add_games([({'Result': '1-0'}, repeated)])
+
+      for builder, name in ((single, path), (shared, path + '.shared')):
+         tree = builder.finish(name)
+         b = board.Board()
+         b.initialize()
+
+         if tree.stats(b) != (1, 1, 0, 0) or tree.moves(b) != [(((0, 6), (2, 5), None), (1, 1, 0, 0))]:
+            raise Exception('FAIL')
+
+         b.movePGN('Nf3')
+
+         if tree.stats(b) != (1, 1, 0, 0) or builder.games != 1:
+            raise Exception('FAIL')
+
+         tree.close()
+   finally:
+      os.remove(path)
+
+      if os.path.exists(path + '.shared'):
+         os.remove(path + '.shared')
+
+def main():
+   test_build_and_query()
+
+if __name__ == '__main__':
+   main()
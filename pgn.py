@@ -0,0 +1,460 @@
+import Queue
+import bz2
+import collections
+import re
+import threading
+import zlib
+
+import board
+
+"""
+Helpers for reading games out of PGN text and replaying them on a Board.  PGN files can be compressed with gzip, bzip2,
+or Zstandard, and read_chunks() decompresses them in a background thread while the caller works on the text already
+read.
+"""
+
+_tag_pattern = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+_token_pattern = re.compile(r'\{[^}]*\}|;[^\n]*|[()]|\$\d+|\d+\.(?:\.\.)?|[^\s{}();]+')
+_results = set(['1-0', '0-1', '1/2-1/2', '*'])
+
+# Map a Result tag to an index into a (games, white, draws, black) count tuple
+outcomes = {'1-0': 1, '1/2-1/2': 2, '0-1': 3}
+
+"""
+Read the games in a file-like object of PGN text.  Each game is yielded as a tuple of (tags, moves), where tags is a
+dict of the tag pairs and moves is the list of SAN moves with move numbers, comments, variations, and NAGs removed.
+"""
+def read_games(f):
+   tags = {}
+   movetext = []
+   depth = 0
+
+   for line in f:
+      stripped = line.strip()
+
+      # A tag line outside of a comment starts a new game if we've already seen moves.
+      if depth == 0 and stripped.startswith('['):
+         if movetext:
+            yield (tags, parse_movetext('\n'.join(movetext)))
+            tags = {}
+            movetext = []
+
+         m = _tag_pattern.match(stripped)
+
+         if m:
+            tags[m.group(1)] = m.group(2).replace('\\"', '"').replace('\\\\', '\\')
+      # Lines starting with % are escaped
+      elif depth == 0 and stripped.startswith('%'):
+         pass
+      elif stripped:
+         movetext.append(stripped)
+         depth = max(0, depth + stripped.count('{') - stripped.count('}'))
+
+         # A result ends the game's movetext, even if the next game has no tags.
+         if depth == 0 and stripped.split()[-1] in _results:
+            yield (tags, parse_movetext('\n'.join(movetext)))
+            tags = {}
+            movetext = []
+
+   if tags or movetext:
+      yield (tags, parse_movetext('\n'.join(movetext)))
+
+"""
+Yield the text of a PGN file in chunks of roughly chunk_size characters that each hold whole games, so that they can
+be handed to worker processes and read with read_games(chunk.splitlines()).  Files whose names end in .gz, .bz2, or
+.zst are decompressed, including those made of several concatenated streams, as parallel compressors write them;
+.zst files need the zstandard package.  The file is read and decompressed in a background thread that stays up to
+queue_size chunks ahead.  Chunks are split before a tag line that follows a blank line, so a comment holding such a
+line may be split across chunks.
+"""
+def read_chunks(path, chunk_size=1 << 20, queue_size=8):
+   queue = Queue.Queue(queue_size)
+   stop = threading.Event()
+
+   def produce():
+      try:
+         for chunk in _game_chunks(_read_blocks(path, chunk_size), chunk_size):
+            queue.put(chunk)
+
+            if stop.is_set():
+               return
+
+         queue.put(None)
+      except Exception, e:
+         queue.put(e)
+
+   thread = threading.Thread(target=produce)
+   thread.daemon = True
+   thread.start()
+
+   try:
+      while True:
+         chunk = queue.get()
+
+         if chunk == None:
+            break
+         elif isinstance(chunk, Exception):
+            raise chunk
+
+         yield chunk
+   finally:
+      # Let the thread finish its last put if the caller stopped early.
+      stop.set()
+
+      while not queue.empty():
+         queue.get_nowait()
+
+"""
+Read the games in a PGN file, compressed or not, as read_games() does, with the file decompressed in a background
+thread as read_chunks() does.
+"""
+def read_archive(path, chunk_size=1 << 20):
+   for chunk in read_chunks(path, chunk_size):
+      for game in read_games(chunk.splitlines()):
+         yield game
+
+# Yield the decompressed contents of the file at the given path in blocks.
+def _read_blocks(path, size):
+   with open(path, 'rb') as f:
+      if path.endswith('.gz'):
+         blocks = _inflate(f, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS), size)
+      elif path.endswith('.bz2'):
+         blocks = _inflate(f, bz2.BZ2Decompressor, size)
+      elif path.endswith('.zst'):
+         import zstandard
+
+         reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+         blocks = iter(lambda: reader.read(size), '')
+      else:
+         blocks = iter(lambda: f.read(size), '')
+
+      for block in blocks:
+         yield block
+
+# Decompress a file of one or more concatenated streams, starting a new decompressor whenever one reaches the end of
+# its stream.
+def _inflate(f, decompressor, size):
+   d = decompressor()
+
+   for data in iter(lambda: f.read(size), ''):
+      while data:
+         try:
+            block = d.decompress(data)
+         except EOFError:
+            # A bz2 decompressor that has already reached the end of its stream
+            d = decompressor()
+            continue
+
+         data = d.unused_data
+
+         if data:
+            d = decompressor()
+
+         yield block
+
+# Regroup blocks of PGN text into chunks of whole games of at least chunk_size characters, except for the last.
+def _game_chunks(blocks, chunk_size):
+   pending = ''
+
+   for block in blocks:
+      pending += block
+
+      while len(pending) >= chunk_size:
+         i = _game_start(pending, chunk_size)
+
+         if i < 0:
+            break
+
+         yield pending[:i]
+         pending = pending[i:]
+
+   if pending.strip():
+      yield pending
+
+# Return the index of the first game in some PGN text that starts at or after the given index, or -1 if there's none.
+# A game starts with a tag line after a blank line.
+def _game_start(text, start):
+   i = text.find('\n[', start - 1)
+
+   while i >= 0:
+      line = text.rfind('\n', 0, i)
+
+      if line >= 0 and not text[line + 1:i].strip():
+         return i + 1
+
+      i = text.find('\n[', i + 1)
+
+   return -1
+
+"""
+Extract the main line SAN moves from PGN movetext.
+"""
+def parse_movetext(text):
+   moves = []
+   depth = 0
+
+   for token in _token_pattern.findall(text):
+      if token == '(':
+         depth += 1
+      elif token == ')':
+         depth = max(0, depth - 1)
+      elif depth > 0 or token[0] in '{;$':
+         continue
+      # Some files write castling with zeroes
+      elif token.startswith('0-0'):
+         moves.append(token.rstrip('!?').replace('0', 'O'))
+      # Skip move numbers and results
+      elif token[0] not in '0123456789*':
+         moves.append(token.rstrip('!?'))
+
+   return moves
+
+"""
+Return a board set up for the start of a game, from the given FEN, such as the value of a game's FEN tag, or in the
+initial position if there's none.
+"""
+def initial_board(fen=None):
+   if fen:
+      return board.Board.from_fen(fen)
+
+   b = board.Board()
+   b.initialize()
+
+   return b
+
+"""
+Replay a list of SAN moves.  The moves are played on the given board, or on a newly initialized one if no board is
+given.  If a listener is given, it is called as listener(board, ply, move) after every move.  The board is returned.
+"""
+def replay(moves, listener=None, b=None):
+   if b == None:
+      b = initial_board()
+
+   for ply, move in enumerate(moves):
+      b.movePGN(move)
+
+      if listener:
+         listener(b, ply + 1, move)
+
+   return b
+
+# A node of the move trie built by replay_games(), holding the numbers of the games that reach it and of those that end
+# there, and the nodes after each move played from it.
+class _Node(object):
+   __slots__ = ('games', 'ends', 'children')
+
+   def __init__(self):
+      self.games = []
+      self.ends = []
+      self.children = collections.OrderedDict()
+
+"""
+Replay many games, given as (tags, moves) tuples, sharing the work on the moves they have in common.  The games are
+put into a trie of their moves, one for each FEN tag they start from, and the trie is walked depth first, so each
+distinct sequence of moves from the start is played only once, and a board is copied only where games branch.
+
+A tuple of (game number, board, error) is yielded as each game ends, in the order of the walk, with games numbered
+from 0 in the order given.  The board is in the game's final position, and must not be changed or kept once the next
+tuple is asked for; use Board.copy() to keep it.  If a move can't be played, error is the ValueError raised by
+movePGN() and the board is as that left it, as it would be after replay().  If the FEN tag is bad, the board is None.
+
+If a listener is given, it's called as listener(game number, board, ply, move) after every move of every game, just
+as replay() would call it for each game on its own, though calls for different games are interleaved.  If a callback
+is given, it's added as the move listener of every board.
+"""
+def replay_games(games, listener=None, callback=None):
+   roots = collections.OrderedDict()
+
+   for number, (tags, moves) in enumerate(games):
+      node = roots.setdefault(tags.get('FEN'), _Node())
+      node.games.append(number)
+
+      for move in moves:
+         child = node.children.get(move)
+
+         if child == None:
+            child = node.children[move] = _Node()
+
+         node = child
+         node.games.append(number)
+
+      node.ends.append(number)
+
+   for fen, root in roots.iteritems():
+      try:
+         b = initial_board(fen)
+      except ValueError, e:
+         for number in root.games:
+            yield (number, None, e)
+
+         continue
+
+      b.add_move_listener(callback)
+      stack = [(b, 0, None, root)]
+
+      while stack:
+         b, ply, move, node = stack.pop()
+
+         if move != None:
+            try:
+               b.movePGN(move)
+            except ValueError, e:
+               for number in node.games:
+                  yield (number, b, e)
+
+               continue
+
+            if listener:
+               for number in node.games:
+                  listener(number, b, ply, move)
+
+         for number in node.ends:
+            yield (number, b, None)
+
+         # The first move played from here goes on with this board, and the rest start from copies of it.
+         children = node.children.items()
+
+         for i in range(len(children) - 1, -1, -1):
+            child = b
+
+            if i > 0:
+               child = b.copy()
+               child.add_move_listener(callback)
+
+            stack.append((child, ply + 1, children[i][0], children[i][1]))
+
+def test_read_games():
+   import StringIO
+
+   text = '[Event "Test"]\n[Result "1-0"]\n\n1. e4 {best by test\n[sic]} e5 2.Nf3 (2. f4 exf4) Nc6!? $1 3. Bb5 a6\n' + \
+      '4. 0-0 1-0\n\n[Event "Second"]\n\n1. d4 d5 *\n'
+   games = list(read_games(StringIO.StringIO(text)))
+
+   if len(games) != 2 or games[0][0]['Result'] != '1-0' or \
+      games[0][1] != ['e4', 'e5', 'Nf3', 'Nc6', 'Bb5', 'a6', 'O-O'] or games[1][1] != ['d4', 'd5']:
+      raise Exception('FAIL')
+
+   replay(games[0][1])
+
+   # A Chess960 game set up from its FEN tag, where castling swaps the king and rook
+   text = '[Variant "Chess960"]\n[SetUp "1"]\n[FEN "bqnbrkrn/pppppppp/8/8/8/8/PPPPPPPP/BQNBRKRN w GEge - 0 1"]\n\n' + \
+      '1. O-O O-O *\n'
+   tags, moves = list(read_games(StringIO.StringIO(text)))[0]
+   b = replay(moves, b=initial_board(tags.get('FEN')))
+
+   if b.to_fen() != 'bqnbrrkn/pppppppp/8/8/8/8/PPPPPPPP/BQNBRRKN w - - 2 2':
+      raise Exception('FAIL')
+
+def test_replay_games():
+   games = [({}, ['e4', 'e5', 'Nf3', 'Nc6']), ({}, ['e4', 'e5', 'Nf3', 'Nf6']), ({}, ['e4', 'e5']),
+            ({}, ['d4', 'Nf6', 'c4']), ({}, ['e4', 'e5', 'Nf3', 'Qd6']), ({'FEN': 'bad'}, ['e4']),
+            ({'FEN': '4k3/8/8/8/8/8/8/4K2R w K - 0 1'}, ['O-O', 'Kd7'])]
+   events = []
+   moves = []
+   ends = {}
+
+   def listener(number, b, ply, move):
+      events.append((number, ply, move, b.hash_key()))
+
+   for number, b, error in replay_games(games, listener, lambda piece, src, dest: moves.append(dest)):
+      ends[number] = (b.to_fen() if b != None else None, error != None)
+
+   # Each game gets the same events as when replayed on its own.
+   for number, (tags, game) in enumerate(games):
+      expected = []
+
+      try:
+         replay(game, lambda b, ply, move: expected.append((number, ply, move, b.hash_key())),
+            initial_board(tags.get('FEN')))
+      except ValueError:
+         pass
+
+      if [e for e in events if e[0] == number] != expected:
+         raise Exception('FAIL')
+
+   if ends[1][0] != replay(games[1][1]).to_fen() or ends[2][0] != replay(games[2][1]).to_fen() or ends[1][1]:
+      raise Exception('FAIL')
+
+   if not ends[4][1] or ends[5] != (None, True) or ends[6] != ('8/3k4/8/8/8/8/8/5RK1 w - - 2 2', False):
+      raise Exception('FAIL')
+
+   # The shared moves are played once: 1. e4 e5 2. Nf3 and the two playable replies, 1. d4 Nf6 2. c4, and the last
+   # game, where castling moves two pieces.
+   if len(moves) != 11:
+      raise Exception('FAIL')
+
+   # Games that branch are played on copies of the board, whose pieces have to be the pieces of a replay on its own.
+   prefix = ['Nc3', 'e5', 'Ne4', 'd5', 'Ng5', 'd4', 'Nh3', 'c5']
+   games = [({}, prefix + [move]) for move in ['Nf3', 'a3', 'b3', 'Nf4', 'e3']]
+   named = []
+   last = [None]
+   trie = {}
+
+   def named_listener(number, b, ply, move):
+      # The pieces are only reported for the first game through a move.
+      if named:
+         last[0] = list(named)
+         del named[:]
+
+      trie.setdefault(number, []).append(last[0])
+
+   for number, b, error in replay_games(games, named_listener, lambda piece, src, dest: named.append(piece.nodename())):
+      pass
+
+   for number, (tags, game) in enumerate(games):
+      b = initial_board()
+      solo = []
+      b.add_move_listener(lambda piece, src, dest: solo.append([piece.nodename()]))
+
+      for move in game:
+         b.movePGN(move)
+
+      if trie[number] != solo:
+         raise Exception('FAIL')
+
+def test_read_chunks():
+   import gzip
+   import os
+   import shutil
+   import tempfile
+
+   tmp = tempfile.mkdtemp()
+   text = ''.join('[Event "Game %d"]\n\n1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 1/2-1/2\n\n' % i for i in range(50))
+
+   try:
+      # Two streams, as a parallel compressor would write them
+      for name, compress in (('games.pgn', lambda t: t), ('games.pgn.gz', None),
+                             ('games.pgn.bz2', lambda t: bz2.compress(t[:1000]) + bz2.compress(t[1000:]))):
+         path = os.path.join(tmp, name)
+
+         if compress == None:
+            for part in (text[:1000], text[1000:]):
+               with gzip.open(path, 'ab') as f:
+                  f.write(part)
+         else:
+            with open(path, 'wb') as f:
+               f.write(compress(text))
+
+         chunks = list(read_chunks(path, chunk_size=256, queue_size=2))
+
+         if ''.join(chunks) != text or [c for c in chunks if not c.startswith('[Event')] or len(chunks) < 10:
+            raise Exception('FAIL')
+
+         games = list(read_archive(path, chunk_size=256))
+
+         if len(games) != 50 or games[49][0]['Event'] != 'Game 49' or games[49][1][-1] != 'a6':
+            raise Exception('FAIL')
+
+      # Stopping early lets the reading thread finish.
+      for chunk in read_chunks(path, chunk_size=64, queue_size=1):
+         break
+   finally:
+      shutil.rmtree(tmp)
+
+def main():
+   test_read_games()
+   test_replay_games()
+   test_read_chunks()
+
+if __name__ == '__main__':
+   main()
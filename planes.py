@@ -0,0 +1,222 @@
+import multiprocessing
+import struct
+
+import numpy
+
+import board
+import pgn
+
+"""
+Export positions as feature planes for training neural networks.  Each position becomes an 18x8x8 array of bytes,
+indexed by plane, rank, and file:
+
+    0-5    white pawns, knights, bishops, rooks, queens, and king
+    6-11   black pawns, knights, bishops, rooks, queens, and king
+    12     all ones when white is to play
+    13-16  all ones for each castling right, in the order of Board.WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE,
+           and BLACK_QUEENSIDE
+    17     the en passant target square
+
+Positions are first collected with Board.pack_into() in a preallocated buffer, and a full buffer is expanded into
+planes with a handful of array operations, so no Python objects are made per position beyond what replaying takes.
+A PlaneWriter writes the planes to a .npy file that numpy.load() can open with mmap_mode='r'.
+"""
+
+PLANES = 18
+
+_piece_codes = numpy.arange(1, 13, dtype=numpy.uint8).reshape(1, 12, 1, 1)
+
+# The header is written before the number of positions is known, so it's always padded to the same size and filled in
+# when the file is closed.
+_header_size = 128
+
+"""
+Return the .npy header for a file of the given number of positions.
+"""
+def _header(count):
+   header = "{'descr': '|u1', 'fortran_order': False, 'shape': (%d, %d, 8, 8), }" % (count, PLANES)
+   header += ' ' * (_header_size - 11 - len(header)) + '\n'
+
+   return '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+
+"""
+Expand an array of packed positions, shaped (positions, Board.PACKED_SIZE), into planes.  The planes are written to
+out if it's given, which must be a uint8 array shaped (positions, PLANES, 8, 8), and otherwise to a new array.  The
+array of planes is returned.
+"""
+def expand(packed, out=None):
+   n = len(packed)
+
+   # Arrays compare elementwise, so this can't be == None.
+   if out is None:
+      out = numpy.empty((n, PLANES, 8, 8), dtype=numpy.uint8)
+
+   # Squares are packed two to a byte in Board.pieces order, which runs up each file in turn.
+   codes = numpy.empty((n, 64), dtype=numpy.uint8)
+   codes[:, 0::2] = packed[:, :32] & 15
+   codes[:, 1::2] = packed[:, :32] >> 4
+   codes = codes.reshape(n, 8, 8).transpose(0, 2, 1)
+
+   out[:, :12] = codes[:, numpy.newaxis] == _piece_codes
+   flags = packed[:, 32]
+   out[:, 12] = (flags & 1 == 0)[:, numpy.newaxis, numpy.newaxis]
+
+   for bit in range(4):
+      out[:, 13 + bit] = ((flags >> (bit + 1)) & 1)[:, numpy.newaxis, numpy.newaxis]
+
+   out[:, 17] = 0
+   targets = packed[:, 33]
+   rows = numpy.nonzero(targets != 0xFF)[0]
+   out[rows, 17, targets[rows] >> 3, targets[rows] & 7] = 1
+
+   return out
+
+"""
+A PlaneWriter writes the planes of the positions added to it to a .npy file at the given path, expanding and
+writing them batch_size positions at a time.  The file isn't valid until the writer is closed.
+"""
+class PlaneWriter(object):
+   def __init__(self, path, batch_size=4096):
+      self.file = open(path, 'wb')
+      self.file.write(_header(0))
+      self.batch_size = batch_size
+      self.buffer = bytearray(batch_size * board.Board.PACKED_SIZE)
+      self.packed = numpy.frombuffer(self.buffer, dtype=numpy.uint8).reshape(batch_size, board.Board.PACKED_SIZE)
+      self.planes = numpy.empty((batch_size, PLANES, 8, 8), dtype=numpy.uint8)
+      self.pending = 0
+      self.count = 0
+
+   """
+   Add the current position of a board.
+   """
+   def add(self, b):
+      b.pack_into(self.buffer, self.pending * board.Board.PACKED_SIZE)
+      self.pending += 1
+
+      if self.pending == self.batch_size:
+         self.flush()
+
+   """
+   Add a string of positions packed back to back, as returned by Board.pack().
+   """
+   def add_packed(self, data):
+      size = board.Board.PACKED_SIZE
+      start = 0
+
+      while start < len(data):
+         n = min(self.batch_size - self.pending, (len(data) - start) / size)
+         self.buffer[self.pending * size:(self.pending + n) * size] = data[start:start + n * size]
+         self.pending += n
+         start += n * size
+
+         if self.pending == self.batch_size:
+            self.flush()
+
+   """
+   Expand and write the positions added since the last flush.
+   """
+   def flush(self):
+      if self.pending:
+         expand(self.packed[:self.pending], self.planes[:self.pending]).tofile(self.file)
+         self.count += self.pending
+         self.pending = 0
+
+   def close(self):
+      self.flush()
+      self.file.seek(0)
+      self.file.write(_header(self.count))
+      self.file.close()
+
+"""
+Replay a game given as a tuple of (FEN, moves) and return all of its positions packed back to back, starting with the
+initial position, or the FEN's if there is one.  A game with an unplayable move is replayed up to that move.
+"""
+def _pack_game(game):
+   fen, moves = game
+
+   try:
+      b = pgn.initial_board(fen)
+   except ValueError:
+      return ''
+
+   data = bytearray((len(moves) + 1) * board.Board.PACKED_SIZE)
+   b.pack_into(data)
+
+   for ply, move in enumerate(moves):
+      try:
+         b.movePGN(move)
+      except ValueError:
+         return str(data[:(ply + 1) * board.Board.PACKED_SIZE])
+
+      b.pack_into(data, (ply + 1) * board.Board.PACKED_SIZE)
+
+   return str(data)
+
+# Return the positions of all the games in a chunk of PGN text packed back to back, as _pack_game() does.
+def _pack_chunk(chunk):
+   return ''.join(_pack_game((tags.get('FEN'), moves)) for tags, moves in pgn.read_games(chunk.splitlines()))
+
+"""
+Write the planes of every position of every game in the given PGN files, which may be compressed, to a .npy file.
+The files are decompressed in a background thread and handed in chunks of about chunk_size characters to the given
+number of worker processes, by default one per CPU, to be replayed.  Return the number of positions written.
+"""
+def export(paths, out_path, workers=None, batch_size=4096, chunk_size=1 << 18):
+   pool = multiprocessing.Pool(workers)
+   writer = PlaneWriter(out_path, batch_size)
+
+   def chunks():
+      for path in paths:
+         for chunk in pgn.read_chunks(path, chunk_size):
+            yield chunk
+
+   try:
+      for data in pool.imap(_pack_chunk, chunks()):
+         writer.add_packed(data)
+   finally:
+      pool.close()
+      pool.join()
+      writer.close()
+
+   return writer.count
+
+def test_export():
+   import os
+   import shutil
+   import tempfile
+
+   tmp = tempfile.mkdtemp()
+
+   try:
+      path = os.path.join(tmp, 'games.pgn')
+
+      with open(path, 'w') as f:
+         f.write('1. e4 d5 2. e5 f5 *\n\n1. d4 *\n')
+
+      out = os.path.join(tmp, 'planes.npy')
+
+      if export([path], out, workers=2, batch_size=3) != 7:
+         raise Exception('FAIL')
+
+      planes = numpy.load(out, mmap_mode='r')
+
+      if planes.shape != (7, PLANES, 8, 8) or planes[0, :12].sum() != 32 or planes[0, 12:17].sum() != 5 * 64:
+         raise Exception('FAIL')
+
+      # After 2...f5 the white king is on e1, white is to play, and f6 can be taken en passant.
+      if planes[4, 5, 0, 4] != 1 or not planes[4, 12].all() or planes[4, 17].sum() != 1 or planes[4, 17, 5, 5] != 1:
+         raise Exception('FAIL')
+
+      b = board.Board()
+      b.initialize()
+
+      if (expand(numpy.frombuffer(b.pack(), dtype=numpy.uint8).reshape(1, -1)) != planes[:1]).any():
+         raise Exception('FAIL')
+   finally:
+      shutil.rmtree(tmp)
+
+def main():
+   test_export()
+
+if __name__ == '__main__':
+   main()
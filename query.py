@@ -0,0 +1,304 @@
+import operator
+
+import board
+import pgn
+
+"""
+Select games by their tags and by what happens in them.  Filters are built from Tag filters, which only look at the
+tag pairs, and Move and Position filters, which are true once some move or position of the game passes their test.
+They're combined with &, |, and ~:
+
+    wanted = (query.Tag('ECO', '==', 'B90') & query.Tag('WhiteElo', '>', 2600)) | \\
+       (query.Castled(board.Board.WHITE, 'O-O-O') & query.Promoted('N'))
+
+    for tags, moves in query.select_pgn(f, wanted):
+        ...
+
+A game is only replayed if its tags don't already decide the filter, and the replay stops as soon as the filter is
+decided either way.  Each filter answers True, False, or None while the outcome still depends on moves to come.
+"""
+
+_operators = {'==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt,
+              '>=': operator.ge}
+
+"""
+Filter is the base class of all filters.
+"""
+class Filter(object):
+   def __and__(self, other):
+      return All(self, other)
+
+   def __or__(self, other):
+      return Any(self, other)
+
+   def __invert__(self):
+      return Not(self)
+
+   """
+   Return whether the game with the given tags passes the filter, or None if that isn't known yet.  Final is whether
+   the whole game has been seen.
+   """
+   def value(self, tags, final):
+      return None
+
+   """
+   Return whether the filter has to see the moves of a game.
+   """
+   def needs_moves(self):
+      return False
+
+   """
+   Forget everything seen of the previous game.
+   """
+   def reset(self):
+      pass
+
+   """
+   Look at a move just made.  The board is the position after the move, ply counts the moves made so far, move is the
+   SAN text, and piece, src, and dest are the last piece moved and its (rank, file) squares, as given to a Board move
+   listener.
+   """
+   def update(self, b, ply, move, piece, src, dest):
+      pass
+
+"""
+A Tag filter compares a tag's value using one of ==, !=, <, <=, >, or >=.  If the value compared against is a
+number, the tag is compared as a number, and a game whose tag isn't a number doesn't pass.  A game without the tag
+doesn't pass either.
+"""
+class Tag(Filter):
+   def __init__(self, name, op, value):
+      if op not in _operators:
+         raise ValueError('Bad operator: %s' % op)
+
+      self.name = name
+      self.op = _operators[op]
+      self.compare = value
+
+   def value(self, tags, final):
+      tag = tags.get(self.name)
+
+      if tag == None:
+         return False
+
+      if isinstance(self.compare, (int, long, float)):
+         try:
+            tag = float(tag)
+         except ValueError:
+            return False
+
+      return self.op(tag, self.compare)
+
+"""
+A Move filter passes once test(board, ply, move, piece, src, dest) is true for some move of the game, with the
+arguments described for Filter.update().
+"""
+class Move(Filter):
+   def __init__(self, test):
+      self.test = test
+      self.seen = False
+
+   def value(self, tags, final):
+      if self.seen:
+         return True
+      elif final:
+         return False
+
+      return None
+
+   def needs_moves(self):
+      return True
+
+   def reset(self):
+      self.seen = False
+
+   def update(self, b, ply, move, piece, src, dest):
+      if not self.seen and self.test(b, ply, move, piece, src, dest):
+         self.seen = True
+
+"""
+A Position filter passes once test(board) is true for some position reached in the game.  The initial position is not
+tested.
+"""
+class Position(Move):
+   def __init__(self, test):
+      super(Position, self).__init__(lambda b, ply, move, piece, src, dest: test(b))
+
+"""
+A Castled filter passes once the given color, or either color if None, castles on the given side, 'O-O' or 'O-O-O',
+or on either side if None.
+"""
+class Castled(Move):
+   def __init__(self, color=None, side=None):
+      def test(b, ply, move, piece, src, dest):
+         return move.startswith('O-O') and (color == None or piece.color == color) and \
+            (side == None or move.rstrip('+#') == side)
+
+      super(Castled, self).__init__(test)
+
+"""
+A Promoted filter passes once a pawn of the given color, or of either color if None, promotes to the piece with the
+given letter, or to any piece if None.
+"""
+class Promoted(Move):
+   def __init__(self, name=None, color=None):
+      def test(b, ply, move, piece, src, dest):
+         return '=' in move and (name == None or move[move.index('=') + 1] == name) and \
+            (color == None or piece.color == color)
+
+      super(Promoted, self).__init__(test)
+
+"""
+An All filter passes if all of its filters do.
+"""
+class All(Filter):
+   def __init__(self, *filters):
+      self.filters = filters
+
+   def value(self, tags, final):
+      ret = True
+
+      for f in self.filters:
+         v = f.value(tags, final)
+
+         if v == False:
+            return False
+         elif v == None:
+            ret = None
+
+      return ret
+
+   def needs_moves(self):
+      return any(f.needs_moves() for f in self.filters)
+
+   def reset(self):
+      for f in self.filters:
+         f.reset()
+
+   def update(self, b, ply, move, piece, src, dest):
+      for f in self.filters:
+         f.update(b, ply, move, piece, src, dest)
+
+"""
+An Any filter passes if any of its filters does.
+"""
+class Any(All):
+   def value(self, tags, final):
+      ret = False
+
+      for f in self.filters:
+         v = f.value(tags, final)
+
+         if v == True:
+            return True
+         elif v == None:
+            ret = None
+
+      return ret
+
+"""
+A Not filter passes if its filter doesn't.
+"""
+class Not(All):
+   def __init__(self, filter):
+      super(Not, self).__init__(filter)
+
+   def value(self, tags, final):
+      v = self.filters[0].value(tags, final)
+
+      if v == None:
+         return None
+
+      return not v
+
+"""
+Return whether a game given by its tags and list of SAN moves passes a filter.  Games with a FEN tag start from that
+position, and a game whose FEN can't be read doesn't pass a filter that needs its moves.  A game with an unplayable
+move is judged on the moves before it.
+"""
+def matches(filter, tags, moves):
+   filter.reset()
+   result = filter.value(tags, False)
+
+   if result != None or not filter.needs_moves():
+      return bool(result)
+
+   last = []
+
+   try:
+      b = pgn.initial_board(tags.get('FEN'))
+   except ValueError:
+      return False
+
+   b.add_move_listener(lambda piece, src, dest: last.__setitem__(slice(None), [piece, src, dest]))
+
+   for ply, move in enumerate(moves):
+      try:
+         b.movePGN(move)
+      except ValueError:
+         break
+
+      filter.update(b, ply + 1, move, last[0], last[1], last[2])
+      result = filter.value(tags, False)
+
+      if result != None:
+         return result
+
+   return filter.value(tags, True)
+
+"""
+Yield the (tags, moves) tuples of the games that pass a filter.
+"""
+def select(games, filter):
+   for tags, moves in games:
+      if matches(filter, tags, moves):
+         yield (tags, moves)
+
+"""
+Yield the (tags, moves) tuples of the games in a file-like object of PGN text that pass a filter.
+"""
+def select_pgn(f, filter):
+   return select(pgn.read_games(f), filter)
+
+def test_select():
+   games = [({'ECO': 'B90', 'WhiteElo': '2700'}, ['e4', 'c5']),
+            ({'ECO': 'B90', 'WhiteElo': '2500'}, ['e4', 'c5']),
+            ({'ECO': 'C20'}, ['d4', 'd5', 'Nc3', 'Nc6', 'Bf4', 'Bf5', 'Qd2', 'Qd7', 'O-O-O', 'O-O-O']),
+            ({'ECO': 'C20'}, ['e4', 'Nf6', 'e5', 'Nd5', 'c4', 'Nb6', 'c5', 'Nd5', 'Bc4', 'Nb6', 'Nf3', 'Nxc4', 'O-O']),
+            ({'ECO': 'C20', 'FEN': 'bad'}, ['O-O'])]
+
+   def eco(filter):
+      return [tags.get('ECO') + str(moves[-1]) for tags, moves in select(games, filter)]
+
+   if eco(Tag('ECO', '==', 'B90') & Tag('WhiteElo', '>', 2600)) != ['B90c5']:
+      raise Exception('FAIL')
+
+   if eco(Castled(board.Board.WHITE, 'O-O-O')) != ['C20O-O-O'] or eco(Castled(side='O-O')) != ['C20O-O']:
+      raise Exception('FAIL')
+
+   # Stops as soon as the first knight is taken, without replaying the rest of the game
+   seen = []
+
+   def captured(b, ply, move, piece, src, dest):
+      seen.append(ply)
+      return 'x' in move
+
+   if eco(Move(captured)) != ['C20O-O'] or max(seen) != 12:
+      raise Exception('FAIL')
+
+   if eco(~Move(captured) & Tag('ECO', '==', 'C20')) != ['C20O-O-O']:
+      raise Exception('FAIL')
+
+   if eco(Position(lambda b: b.get('c4') != None and b.fullmove_number == 3) | Tag('WhiteElo', '<', 2600)) != \
+      ['B90c5', 'C20O-O']:
+      raise Exception('FAIL')
+
+   # The game with a bad FEN only passes a filter on its tags.
+   if eco(Tag('ECO', '==', 'C20')) != ['C20O-O-O', 'C20O-O', 'C20O-O']:
+      raise Exception('FAIL')
+
+def main():
+   test_select()
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,186 @@
+import time
+
+import board
+
+"""
+Alpha-beta search over the moves from Board.legal_moves(), scoring the positions at the horizon with
+Board.evaluate().  search() deepens one ply at a time until it reaches the given depth or runs out of time, and
+returns the result of the deepest search it finished.
+"""
+
+# Score of being mated at the root, less one for each ply it takes
+MATE = 100000
+
+class _Timeout(Exception):
+   pass
+
+"""
+Search a board and return a tuple of (score, best move, depth), where the score is from the point of view of the side
+to play and depth is the number of plies searched.  The search stops after depth plies or once time_limit seconds have
+passed, whichever comes first.  If no search finishes in time, the position's static score is returned with the
+first legal move and a depth of 0.  The board is left as it was.
+"""
+def search(b, depth=None, time_limit=None):
+   if depth == None and time_limit == None:
+      raise ValueError('A search needs a depth or a time limit')
+
+   deadline = None
+
+   if time_limit != None:
+      deadline = time.time() + time_limit
+
+   moves = b.legal_moves()
+
+   if not moves:
+      return (_terminal(b, 0), None, 0)
+
+   best = (b.evaluate()[b.to_play], moves[0], 0)
+   d = 1
+
+   while depth == None or d <= depth:
+      try:
+         score, move = _root(b, moves, d, deadline)
+      except _Timeout:
+         break
+
+      best = (score, move, d)
+
+      # Search the best move first next time
+      moves.remove(move)
+      moves.insert(0, move)
+
+      # Deeper searches can't find a faster mate.
+      if abs(score) > MATE - d - 1:
+         break
+
+      d += 1
+
+   return best
+
+def _root(b, moves, depth, deadline):
+   alpha = -MATE - 1
+   best = None
+
+   for move in moves:
+      child = b.copy()
+      child.movePGN(move)
+      score = -_negamax(child, depth - 1, -MATE - 1, -alpha, 1, deadline)
+
+      if best == None or score > alpha:
+         alpha = score
+         best = move
+
+   return (alpha, best)
+
+def _negamax(b, depth, alpha, beta, ply, deadline):
+   if deadline != None and time.time() > deadline:
+      raise _Timeout()
+
+   if b.is_draw_claimable():
+      return 0
+
+   moves = b.legal_moves()
+
+   if not moves:
+      return _terminal(b, ply)
+
+   if depth == 0:
+      return b.evaluate()[b.to_play]
+
+   gains = dict((m, b.see_move(m)) for m in moves if 'x' in m)
+   moves.sort(key=lambda m: _order(m, gains.get(m, 0)))
+
+   # A capture that loses material looks good at the horizon, where the recapture isn't seen, so it's only searched
+   # one ply from the horizon if it checks or nothing else is left.
+   if depth == 1:
+      moves = [m for m in moves if gains.get(m, 0) >= 0 or m[-1] == '+'] or moves
+
+   for move in moves:
+      child = b.copy()
+      child.movePGN(move)
+      score = -_negamax(child, depth - 1, -beta, -alpha, ply + 1, deadline)
+
+      if score >= beta:
+         return score
+
+      if score > alpha:
+         alpha = score
+
+   return alpha
+
+"""
+Return the sort key of a move, given the material it wins by static exchange evaluation.  Captures that win material
+come first, most valuable first, since they're the most likely to cut the search off, then checks and even trades,
+then quiet moves, and last captures that lose material.
+"""
+def _order(move, gain):
+   if gain > 0:
+      return (0, -gain)
+   elif move[-1] == '+' or (gain == 0 and 'x' in move):
+      return (1, 0)
+   elif gain == 0:
+      return (2, 0)
+
+   return (3, -gain)
+
+"""
+Score a position with no legal moves: mate if the side to play is in check, and otherwise stalemate.
+"""
+def _terminal(b, ply):
+   king = b.get_king(b.to_play)
+   other = board.Board.BLACK if b.to_play == board.Board.WHITE else board.Board.WHITE
+
+   if king != None and b._attacked_by(king.file * 8 + king.rank, other):
+      return -MATE + ply
+
+   return 0
+
+def test_search():
+   # White mates in one with Ra8
+   b = board.Board()
+   board.King(b, 0, 6, board.Board.WHITE)
+   board.Rook(b, 0, 0, board.Board.WHITE)
+   board.King(b, 7, 6, board.Board.BLACK)
+   board.Pawn(b, 6, 5, board.Board.BLACK)
+   board.Pawn(b, 6, 6, board.Board.BLACK)
+   board.Pawn(b, 6, 7, board.Board.BLACK)
+
+   if search(b, depth=3) != (MATE - 1, 'Ra8+', 1):
+      raise Exception('FAIL')
+
+   # Black wins the undefended queen
+   b = board.Board()
+   b.initialize()
+
+   for move in ['e4', 'e5', 'Qh5', 'Nc6', 'Qxf7+']:
+      b.movePGN(move)
+
+   key = b.hash_key()
+   score, move, depth = search(b, depth=2)
+
+   if move != 'Kxf7' or depth != 2 or b.hash_key() != key:
+      raise Exception('FAIL')
+
+   score, move, depth = search(b, time_limit=0)
+
+   if depth != 0 or move not in b.legal_moves():
+      raise Exception('FAIL')
+
+   # Checks and even trades come first, and captures that lose the queen last.
+   b = board.Board()
+   b.initialize()
+
+   for move in ['e4', 'd5', 'Nc3', 'e6', 'Qh5', 'Nf6']:
+      b.movePGN(move)
+
+   moves = b.legal_moves()
+   moves.sort(key=lambda m: _order(m, b.see_move(m) if 'x' in m else 0))
+
+   if sorted(moves[-2:]) != ['Qxd5', 'Qxh7'] or sorted(moves[:3]) != ['Bb5+', 'Qxf7+', 'exd5']:
+      raise Exception('FAIL')
+
+def main():
+   test_search()
+
+if __name__ == '__main__':
+   main()
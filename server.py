@@ -0,0 +1,322 @@
+import SocketServer
+import collections
+import json
+import multiprocessing
+import threading
+
+import analysis
+import board
+import pgn
+import search
+
+"""
+A local server that scores positions for other processes.  Clients connect over a Unix socket or localhost TCP and
+send one JSON request per line, naming a position by a FEN, by the SAN moves that reach it from the initial position
+or from a given FEN, or by its encode() string:
+
+    {"fen": "8/8/8/4k3/8/8/4K3/4R3 w - - 0 1", "depth": 3}
+    {"moves": ["e4", "e5", "Nf3"], "depth": 2}
+    {"encoding": "RPxxxxpr...", "to_play": "black"}
+
+Without a depth or time_limit the position is scored with Board.evaluate(), and otherwise it is searched.  Each
+request gets one JSON line back with the score from white's point of view, or an error:
+
+    {"score": 0.4, "best": "Nc6", "depth": 2, "cached": false}
+    {"error": "Move is not possible: Nf4"}
+
+Each connection is served by its own thread, and the scoring runs in a pool of worker processes.  Requests for a
+position that's already being scored wait for that result instead of scoring it again, and recent results are served
+from a bounded cache.
+"""
+
+"""
+Score a position, given as a board state made by analysis._state(), from white's point of view.  Return a tuple of
+(score, best move, depth), where the best move is None and the depth is 0 when the position is only evaluated.
+"""
+def _score(state, depth, time_limit):
+   b = analysis._board(state)
+
+   if depth == None and time_limit == None:
+      return (b.evaluate()[board.Board.WHITE], None, 0)
+
+   score, best, reached = search.search(b, depth, time_limit)
+
+   if b.to_play != board.Board.WHITE:
+      score = -score
+
+   return (score, best, reached)
+
+"""
+A PositionService scores positions in a pool of worker processes, by default one per CPU, and keeps the results for
+the most recent cache_size distinct queries.  It's safe to call from many threads at once.
+"""
+class PositionService(object):
+   def __init__(self, workers=None, cache_size=10000):
+      self.pool = multiprocessing.Pool(workers)
+      self.cache_size = cache_size
+      self.cache = collections.OrderedDict()
+      self.pending = {}
+      self.lock = threading.Lock()
+      self.hits = 0
+      self.misses = 0
+      self.coalesced = 0
+
+   """
+   Score a board as _score() does, with the given depth and time limit.  The board must not change until the call
+   returns.
+   """
+   def query(self, b, depth=None, time_limit=None):
+      return self._query(b, depth, time_limit)[0]
+
+   """
+   Answer a request given as a dict in the format described above, returning the response dict.
+   """
+   def handle(self, request):
+      try:
+         b = _request_board(request)
+         result, cached = self._query(b, _request_limit(request, 'depth', (int, long)),
+                                      _request_limit(request, 'time_limit', (int, long, float)))
+      except ValueError, e:
+         return {'error': str(e)}
+
+      return {'score': result[0], 'best': result[1], 'depth': result[2], 'cached': cached}
+
+   def close(self):
+      self.pool.close()
+      self.pool.join()
+
+   # Return the result of a query and whether it came from the cache.  The search also depends on the halfmove clock and
+   # on the positions since the last capture or pawn move, which it finds repetitions among, so those are in the key.
+   def _query(self, b, depth, time_limit):
+      recent = tuple(b.history[max(len(b.history) - b.halfmove_clock, 0):])
+      key = (b.hash_key(), b.halfmove_clock, recent, depth, time_limit)
+
+      with self.lock:
+         result = self.cache.pop(key, None)
+
+         if result != None:
+            self.hits += 1
+            self.cache[key] = result
+            return (result, True)
+
+         pending = self.pending.get(key)
+         owner = pending == None
+
+         if owner:
+            self.misses += 1
+            pending = self.pending[key] = _Pending()
+         else:
+            self.coalesced += 1
+
+      # Only the first thread to ask waits on the pool, because a pool result wakes up just one waiting thread.
+      if owner:
+         try:
+            pending.result = self.pool.apply(_score, (analysis._state(b), depth, time_limit))
+         except Exception, e:
+            pending.error = e
+
+         with self.lock:
+            if pending.error == None:
+               self.cache[key] = pending.result
+
+               if len(self.cache) > self.cache_size:
+                  self.cache.popitem(last=False)
+
+            del self.pending[key]
+
+         pending.done.set()
+      else:
+         pending.done.wait()
+
+      if pending.error != None:
+         raise pending.error
+
+      return (pending.result, False)
+
+# A query being scored, which other threads asking for the same position wait on
+class _Pending(object):
+   def __init__(self):
+      self.done = threading.Event()
+      self.result = None
+      self.error = None
+
+"""
+Set up the board a request names.
+"""
+def _request_board(request):
+   if 'moves' in request or 'fen' in request:
+      fen = request.get('fen')
+      moves = request.get('moves', [])
+
+      if fen != None and not isinstance(fen, basestring):
+         raise ValueError('Bad FEN: %s' % json.dumps(fen))
+
+      if not isinstance(moves, list) or [move for move in moves if not isinstance(move, basestring)]:
+         raise ValueError('Bad moves: %s' % json.dumps(moves))
+
+      b = pgn.initial_board(fen)
+
+      for move in moves:
+         b.movePGN(move)
+   elif 'encoding' in request:
+      if not isinstance(request['encoding'], basestring) or len(request['encoding']) != 64:
+         raise ValueError('Bad encoding: %s' % json.dumps(request['encoding']))
+
+      b = board.Board.decode(request['encoding'])
+
+      if request.get('to_play', board.Board.WHITE) not in (board.Board.WHITE, board.Board.BLACK):
+         raise ValueError('Bad side to play: %s' % request['to_play'])
+
+      b.set_to_play(request.get('to_play', board.Board.WHITE))
+   else:
+      raise ValueError('Request has no position')
+
+   if b.get_king(board.Board.WHITE) == None or b.get_king(board.Board.BLACK) == None:
+      raise ValueError('Position is missing a king')
+
+   return b
+
+"""
+Return the named limit of a request, the depth or the time limit, or None if it isn't given.  A limit must be a
+positive number of one of the given types.
+"""
+def _request_limit(request, name, types):
+   value = request.get(name)
+
+   if value != None and (isinstance(value, bool) or not isinstance(value, types) or value <= 0):
+      raise ValueError('Bad %s: %s' % (name, json.dumps(value)))
+
+   return value
+
+class _Handler(SocketServer.StreamRequestHandler):
+   def handle(self):
+      # Iterating over the file would read ahead and wait for more requests before answering this one.
+      for line in iter(self.rfile.readline, ''):
+         if not line.strip():
+            continue
+
+         try:
+            request = json.loads(line)
+
+            if not isinstance(request, dict):
+               raise ValueError('Request is not an object')
+         except ValueError, e:
+            response = {'error': str(e)}
+         else:
+            # Whatever goes wrong with one request, the connection goes on to the next.
+            try:
+               response = self.server.service.handle(request)
+            except Exception, e:
+               response = {'error': 'Request failed: %s' % e}
+
+         self.wfile.write(json.dumps(response) + '\n')
+         self.wfile.flush()
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+   daemon_threads = True
+   allow_reuse_address = True
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+   daemon_threads = True
+
+"""
+Create a server for a PositionService.  The address is either the path of a Unix socket or a (host, port) tuple.
+Call serve_forever() on the returned server to run it, and shutdown() from another thread to stop it.
+"""
+def make_server(address, service):
+   if isinstance(address, tuple):
+      server = _TCPServer(address, _Handler)
+   else:
+      server = _UnixServer(address, _Handler)
+
+   server.service = service
+
+   return server
+
+def test_service():
+   import os
+   import shutil
+   import socket
+   import tempfile
+
+   tmp = tempfile.mkdtemp()
+   service = PositionService(workers=1, cache_size=2)
+
+   try:
+      # Identical queries that arrive together are scored once.
+      b = board.Board()
+      b.initialize()
+      results = []
+      threads = [threading.Thread(target=lambda: results.append(service.query(b, depth=2))) for i in range(4)]
+
+      for t in threads:
+         t.start()
+
+      for t in threads:
+         t.join()
+
+      if len(set(results)) != 1 or service.misses != 1 or service.hits + service.coalesced != 3:
+         raise Exception('FAIL')
+
+      # Requests of the wrong shape get errors, and limits have to be positive numbers.
+      for request in [{'moves': 5}, {'moves': ['e4', 5]}, {'fen': 5}, {'encoding': 5}, {'moves': [], 'depth': '2'},
+                      {'moves': [], 'depth': 0}, {'moves': [], 'depth': True}, {'moves': [], 'time_limit': -1}]:
+         if 'error' not in service.handle(request):
+            raise Exception('FAIL')
+
+      path = os.path.join(tmp, 'socket')
+      server = make_server(path, service)
+      # The handler threads are joined before the test returns, so none is left to be killed at exit.
+      server.daemon_threads = False
+      running = set(threading.enumerate())
+      thread = threading.Thread(target=server.serve_forever)
+      thread.start()
+      client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      f = client.makefile('r+')
+
+      try:
+         client.connect(path)
+         requests = [{'moves': ['e4', 'e5', 'Qh5', 'Nc6', 'Bc4', 'Nf6'], 'depth': 1},
+                     {'encoding': b.encode(), 'to_play': 'white', 'depth': 2}, {'moves': ['Nf4']}, 'e4',
+                     {'fen': 5}]
+
+         for request in requests:
+            f.write(json.dumps(request) + '\n')
+
+         f.flush()
+         responses = [json.loads(f.readline()) for request in requests]
+      finally:
+         # The file holds the socket open too, and the handler only stops when both are closed.
+         f.close()
+         client.close()
+         server.shutdown()
+         thread.join()
+         server.server_close()
+
+         for t in set(threading.enumerate()) - running:
+            t.join()
+
+      if responses[0]['best'] != 'Qxf7+' or responses[0]['score'] != search.MATE - 1 or responses[0]['cached']:
+         raise Exception('FAIL')
+
+      if responses[1]['score'] != results[0][0] or not responses[1]['cached']:
+         raise Exception('FAIL')
+
+      if 'error' not in responses[2] or 'error' not in responses[3] or 'error' not in responses[4]:
+         raise Exception('FAIL')
+
+      # A rook up is a draw once the fifty-move rule can be claimed, and the halfmove clock keeps the two apart.
+      fresh = service.handle({'fen': '4k3/8/8/8/8/8/8/R3K3 w - - 0 60', 'depth': 1})
+      stale = service.handle({'fen': '4k3/8/8/8/8/8/8/R3K3 w - - 99 60', 'depth': 1})
+
+      if fresh['score'] <= 0 or stale['score'] != 0 or stale['cached']:
+         raise Exception('FAIL')
+   finally:
+      service.close()
+      shutil.rmtree(tmp)
+
+def main():
+   test_service()
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,409 @@
+import json
+import os
+import socket
+import time
+
+import pgn
+
+"""
+Sharded jobs over PGN files too big for one machine, coordinated through a directory that every host can see.  split()
+cuts a PGN file into byte ranges that begin and end on game boundaries and writes them to a manifest in the job
+directory.  Any number of workers, on any number of hosts, then run work() on the job directory.  A worker claims a
+shard by creating its lease file, which only one worker can do, replays the shard's games with a task function, and
+writes the task's output for the shard.  A worker touches its lease while it works, and a lease that hasn't been
+touched for lease_time seconds is taken to belong to a crashed worker and is claimed again.  Once every shard has its
+output, merge() puts the outputs together in the order of the file.
+
+The job directory holds manifest.json, a lease-NNNNN file for each shard being worked on, and an output-NNNNN file for
+each shard that's done.  Outputs are written to a temporary file and renamed into place, so a shard's output is never
+seen half written, and a shard worked twice, as when a worker was only slow and not crashed, gets the same output.
+Lease times are compared against file modification times, so the hosts' clocks should agree to well within lease_time.
+"""
+
+MANIFEST = 'manifest.json'
+
+# How much of a file to read at a time while looking for a game boundary
+_window = 1 << 16
+
+# Return the offset of the first game in a file that starts at or after the given offset, or the size of the file if
+# there's none.
+def _next_game(f, offset, size):
+   if offset <= 0:
+      return 0
+
+   # Start a character early, so that a game starting right at the offset is found after its newline.
+   f.seek(offset - 1)
+   text = ''
+
+   while True:
+      block = f.read(_window)
+      text += block
+      i = pgn._game_start(text, 1)
+
+      if i >= 0:
+         return offset - 1 + i
+      elif not block:
+         return size
+
+      # The rest of the text can only matter for the blank line before a tag line.
+      keep = max(text.rfind('\n', 0, len(text) - 1), 0)
+      offset += keep
+      text = text[keep:]
+
+"""
+Split the PGN file at the given path into shards of about shard_size bytes, each holding whole games, and write the
+manifest of a job over them to job_dir, which is created if it doesn't exist.  The file can't be compressed, since the
+shards are byte ranges of it.  Return the list of (start, end) byte ranges.
+"""
+def split(path, job_dir, shard_size=1 << 26):
+   if path.endswith(('.gz', '.bz2', '.zst')):
+      raise ValueError('Shards need an uncompressed file: %s' % path)
+
+   size = os.path.getsize(path)
+   starts = [0]
+
+   with open(path, 'rb') as f:
+      while True:
+         start = _next_game(f, max(starts[-1] + shard_size, starts[-1] + 1), size)
+
+         if start >= size:
+            break
+
+         starts.append(start)
+
+   shards = [[start, end] for start, end in zip(starts, starts[1:] + [size]) if end > start]
+
+   if not os.path.isdir(job_dir):
+      os.makedirs(job_dir)
+
+   _write_atomically(os.path.join(job_dir, MANIFEST),
+                     json.dumps({'path': os.path.abspath(path), 'size': size, 'shards': shards}))
+
+   return [tuple(s) for s in shards]
+
+"""
+Read the manifest of a job directory, returning a dict with the path of the PGN file, its size, and the list of
+shards as [start, end] byte ranges.
+"""
+def read_manifest(job_dir):
+   with open(os.path.join(job_dir, MANIFEST)) as f:
+      return json.load(f)
+
+# Write data to a file by renaming a temporary file into place.
+def _write_atomically(path, data):
+   temp = '%s.%s-%d.tmp' % (path, socket.gethostname(), os.getpid())
+
+   with open(temp, 'wb') as f:
+      f.write(data)
+
+   os.rename(temp, path)
+
+def _lease_path(job_dir, shard):
+   return os.path.join(job_dir, 'lease-%05d' % shard)
+
+def _output_path(job_dir, shard):
+   return os.path.join(job_dir, 'output-%05d' % shard)
+
+# Raised when a worker finds that the lease on the shard it's working on was claimed by another worker
+class _LeaseLost(Exception):
+   pass
+
+"""
+A Lease is a worker's claim on a shard, held as a file in the job directory that holds the worker's id.
+"""
+class Lease(object):
+   def __init__(self, path, worker_id, lease_time):
+      self.path = path
+      self.worker_id = worker_id
+      self.lease_time = lease_time
+      self.renewed = time.time()
+
+   """
+   Claim the lease file at the given path for a worker, and return the Lease, or None if another worker holds it.  A
+   lease that hasn't been renewed for lease_time seconds is broken and claimed.
+   """
+   @staticmethod
+   def claim(path, worker_id, lease_time):
+      for attempt in range(2):
+         try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+         except OSError:
+            pass
+         else:
+            os.write(fd, worker_id)
+            os.close(fd)
+            return Lease(path, worker_id, lease_time)
+
+         try:
+            expired = time.time() - os.path.getmtime(path) > lease_time
+         except OSError:
+            # The holder finished or gave it up in the meantime.
+            continue
+
+         if not expired:
+            return None
+
+         # Only one of the workers that find the lease expired can move it out of the way.
+         stale = '%s.%s.stale' % (path, worker_id)
+
+         try:
+            os.rename(path, stale)
+         except OSError:
+            return None
+
+         # Another worker may have broken the lease and claimed it afresh since it was found expired, in which case
+         # the fresh lease goes back.
+         if time.time() - os.path.getmtime(stale) <= lease_time:
+            try:
+               os.link(stale, path)
+            except OSError:
+               pass
+
+            os.remove(stale)
+            return None
+
+         os.remove(stale)
+
+      return None
+
+   """
+   Touch the lease file if a quarter of the lease time has passed since it was last touched.  _LeaseLost is raised if
+   another worker has claimed the lease.
+   """
+   def renew(self):
+      now = time.time()
+
+      if now - self.renewed < self.lease_time / 4.0:
+         return
+
+      try:
+         with open(self.path) as f:
+            holder = f.read()
+
+         if holder != self.worker_id:
+            raise _LeaseLost(self.path)
+
+         os.utime(self.path, None)
+      except (IOError, OSError):
+         raise _LeaseLost(self.path)
+
+      self.renewed = now
+
+   def release(self):
+      try:
+         with open(self.path) as f:
+            holder = f.read()
+
+         if holder == self.worker_id:
+            os.remove(self.path)
+      except (IOError, OSError):
+         pass
+
+"""
+A task that replays every game with Board.movePGN() and gives a tab-separated line for each: the FEN of the position
+the game ends in, the number of plies played, and the error that stopped the game, if any.
+"""
+def replay_task(games):
+   lines = []
+
+   for tags, moves in games:
+      b = None
+      error = ''
+      ply = 0
+
+      try:
+         b = pgn.initial_board(tags.get('FEN'))
+
+         for move in moves:
+            b.movePGN(move)
+            ply += 1
+
+         fen = b.to_fen()
+      except ValueError, e:
+         fen = b.to_fen() if b != None else ''
+         error = str(e)
+
+      lines.append('%s\t%d\t%s\n' % (fen, ply, error))
+
+   return ''.join(lines)
+
+"""
+Work on a job in job_dir until every shard is done, and return the number of shards this worker did.  The task is
+called with an iterator over the (tags, moves) tuples of a shard's games and returns a string, which is written as the
+shard's output.  The worker's id defaults to the host name and process id.  When every unfinished shard is leased to
+another worker, the worker checks back every poll seconds, in case one of them crashes.
+"""
+def work(job_dir, task=replay_task, worker_id=None, lease_time=60.0, poll=1.0):
+   if worker_id == None:
+      worker_id = '%s-%d' % (socket.gethostname(), os.getpid())
+
+   manifest = read_manifest(job_dir)
+   done = 0
+
+   while True:
+      remaining = [i for i in range(len(manifest['shards'])) if not os.path.exists(_output_path(job_dir, i))]
+
+      if not remaining:
+         return done
+
+      claimed = False
+
+      for shard in remaining:
+         lease = Lease.claim(_lease_path(job_dir, shard), worker_id, lease_time)
+
+         if lease == None:
+            continue
+
+         claimed = True
+
+         try:
+            # The shard may have been finished by the worker whose lease was broken.
+            if not os.path.exists(_output_path(job_dir, shard)):
+               _write_atomically(_output_path(job_dir, shard), task(_shard_games(manifest, shard, lease)))
+               done += 1
+         except _LeaseLost:
+            pass
+         finally:
+            lease.release()
+
+      if not claimed:
+         time.sleep(poll)
+
+# Yield the games of a shard, renewing the worker's lease on it between games.
+def _shard_games(manifest, shard, lease):
+   start, end = manifest['shards'][shard]
+
+   with open(manifest['path'], 'rb') as f:
+      f.seek(start)
+      text = f.read(end - start)
+
+   for game in pgn.read_games(text.splitlines()):
+      lease.renew()
+      yield game
+
+"""
+Write the outputs of the shards of a finished job to out_path, in the order of the shards.  Return the number of
+shards.  A ValueError is raised if any shard isn't done.
+"""
+def merge(job_dir, out_path):
+   shards = len(read_manifest(job_dir)['shards'])
+   missing = [i for i in range(shards) if not os.path.exists(_output_path(job_dir, i))]
+
+   if missing:
+      raise ValueError('Shards are not done: %s' % ', '.join(str(i) for i in missing))
+
+   with open(out_path, 'wb') as out:
+      for i in range(shards):
+         with open(_output_path(job_dir, i), 'rb') as f:
+            while True:
+               block = f.read(_window)
+
+               if not block:
+                  break
+
+               out.write(block)
+
+   return shards
+
+def test_split():
+   import shutil
+   import tempfile
+
+   tmp = tempfile.mkdtemp()
+
+   try:
+      path = os.path.join(tmp, 'games.pgn')
+      games = ['[Event "%d"]\n\n1. e4 {[not a tag]\n\n[nor this]} e5 2. Nf3 *\n\n' % i for i in range(20)]
+      text = ''.join(games)
+
+      with open(path, 'wb') as f:
+         f.write(text)
+
+      shards = split(path, os.path.join(tmp, 'job'), shard_size=100)
+
+      if shards[0][0] != 0 or shards[-1][1] != len(text) or len(shards) < 5:
+         raise Exception('FAIL')
+
+      for start, end in shards:
+         if not text[start:end].startswith('[Event') or len(list(pgn.read_games(text[start:end].splitlines()))) < 1:
+            raise Exception('FAIL')
+
+      if sum(len(list(pgn.read_games(text[s:e].splitlines()))) for s, e in shards) != 20:
+         raise Exception('FAIL')
+
+      if read_manifest(os.path.join(tmp, 'job'))['shards'] != [list(s) for s in shards]:
+         raise Exception('FAIL')
+   finally:
+      shutil.rmtree(tmp)
+
+def test_work():
+   import multiprocessing
+   import shutil
+   import tempfile
+
+   tmp = tempfile.mkdtemp()
+
+   try:
+      path = os.path.join(tmp, 'games.pgn')
+
+      with open(path, 'wb') as f:
+         for i in range(30):
+            f.write('[Event "%d"]\n\n1. e4 e5 2. Nf3 Nc6 *\n\n[Event "bad"]\n\n1. e4 e4 *\n\n' % i)
+
+      job = os.path.join(tmp, 'job')
+      shards = split(path, job, shard_size=200)
+
+      # A crashed worker left a lease behind on the first shard long ago.
+      with open(_lease_path(job, 0), 'w') as f:
+         f.write('crashed')
+
+      os.utime(_lease_path(job, 0), (time.time() - 100, time.time() - 100))
+
+      # A live worker holds the last shard, so nobody else takes it until it's done.
+      live = Lease.claim(_lease_path(job, len(shards) - 1), 'live', 60)
+
+      if Lease.claim(_lease_path(job, len(shards) - 1), 'other', 60) != None:
+         raise Exception('FAIL')
+
+      _write_atomically(_output_path(job, len(shards) - 1), replay_task(_shard_games(read_manifest(job),
+                                                                                   len(shards) - 1, live)))
+      live.release()
+
+      workers = [multiprocessing.Process(target=work, args=(job, replay_task, 'worker%d' % i, 10, 0.01))
+                 for i in range(3)]
+
+      for p in workers:
+         p.start()
+
+      for p in workers:
+         p.join()
+
+      out = os.path.join(tmp, 'out.tsv')
+
+      if merge(job, out) != len(shards) or [name for name in os.listdir(job) if name.startswith('lease')]:
+         raise Exception('FAIL')
+
+      with open(out) as f:
+         lines = f.read().splitlines()
+
+      if len(lines) != 60 or lines[0] != 'r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3\t4\t' or \
+         lines[1] != 'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1\t1\tMove is not possible: e4':
+         raise Exception('FAIL')
+
+      os.remove(_output_path(job, 0))
+
+      try:
+         merge(job, out)
+      except ValueError:
+         pass
+      else:
+         raise Exception('FAIL')
+   finally:
+      shutil.rmtree(tmp)
+
+def main():
+   test_split()
+   test_work()
+
+if __name__ == '__main__':
+   main()
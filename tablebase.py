@@ -0,0 +1,463 @@
+import array
+import collections
+import itertools
+import mmap
+import os
+
+import board
+
+"""
+Endgame tablebases for pawnless positions with few pieces.  generate() builds the table for a material signature such
+as "KRvK" or "KQvKR" by retrograde analysis and writes it to a file, and a Tablebase probes the files through memory
+maps, keeping recently touched blocks in memory.
+
+A table holds one byte for every placement of its pieces with each side to play, indexed by
+side * 64 ** n + square of the first piece * 64 ** (n - 1) + ... + square of the last piece, where squares are numbered
+as in Board.pieces and the pieces are ordered as in the signature: the white king, the other white pieces, the black
+king, and the other black pieces.  A byte of 0 is a draw, 255 is an illegal placement, and anything else is one more
+than the number of plies to mate, so that an odd number of plies is a win for the side to play and an even number is a
+loss.
+
+Tables only exist for one color arrangement of each material balance, with the stronger side as white.  Positions with
+the colors the other way around are flipped before they're looked up.  Generating a table generates the tables its
+captures lead to first.  Three-piece tables take seconds to generate, but four-piece tables take a long time in Python.
+"""
+
+DRAW = 0
+ILLEGAL = 255
+
+_order = 'KQRBN'
+_header = 'PTB1'
+_knights, _kings, _rooks, _bishops, _queens, _pawns = board._attack_tables(board.Board.WHITE, board.Board.BLACK)
+_rays = {'Q': _queens, 'R': _rooks, 'B': _bishops}
+
+"""
+Parse a signature into a list of (kind, color) tuples in table order.
+"""
+def _parse(signature):
+   white, black = signature.upper().split('V')
+
+   return [(k, board.Board.WHITE) for k in white] + [(k, board.Board.BLACK) for k in black]
+
+"""
+Return the canonical signature for the given pieces, given as (kind, color) tuples, and whether the colors have to be
+flipped to match it.
+"""
+def _signature(pieces):
+   white = sorted([k for k, c in pieces if c == board.Board.WHITE], key=_order.index)
+   black = sorted([k for k, c in pieces if c == board.Board.BLACK], key=_order.index)
+
+   def strength(side):
+      return (len(side), [-_order.index(k) for k in side])
+
+   if strength(black) > strength(white):
+      return (''.join(black) + 'v' + ''.join(white), True)
+
+   return (''.join(white) + 'v' + ''.join(black), False)
+
+"""
+Return the canonical form of a signature, e.g. "KRvK" for "KvKR".
+"""
+def canonical(signature):
+   return _signature(_parse(signature))[0]
+
+"""
+Return the squares a piece of the given kind on the given square moves to or attacks, where occupied[i] is true for
+the occupied squares.  Sliding pieces stop at the first occupied square, which is included.
+"""
+def _targets(kind, square, occupied):
+   if kind == 'N':
+      return _knights[square]
+   elif kind == 'K':
+      return _kings[square]
+
+   ret = []
+
+   for ray in _rays[kind][square]:
+      for t in ray:
+         ret.append(t)
+
+         if occupied[t]:
+            break
+
+   return ret
+
+"""
+Return whether any of the given slots attacks the given square.
+"""
+def _attacked(square, slots, kinds, squares, occupied):
+   for j in slots:
+      if square in _targets(kinds[j], squares[j], occupied):
+         return True
+
+   return False
+
+"""
+Return the path of the table file for a signature.
+"""
+def table_path(directory, signature):
+   return os.path.join(directory, canonical(signature) + '.tb')
+
+"""
+A Tablebase probes the table files in a directory.  Files are opened when first needed, and the most recently used
+cache_blocks blocks of block_size bytes are kept in memory.
+"""
+class Tablebase(object):
+   def __init__(self, directory, cache_blocks=1024, block_size=4096, max_pieces=4):
+      self.directory = directory
+      self.cache_blocks = cache_blocks
+      self.block_size = block_size
+      self.max_pieces = max_pieces
+      self.tables = {}
+      self.blocks = collections.OrderedDict()
+      self.hits = 0
+      self.misses = 0
+
+   """
+   Probe the table for a board.  Return None if the position isn't covered by an available table.  Otherwise return a
+   tuple of (result, plies), where result is 1 if the side to play wins, 0 for a draw, and -1 if the side to play
+   loses, and plies is the number of plies to mate.
+   """
+   def probe(self, b):
+      count = 2
+
+      for name in 'QRBN':
+         count += len(b.by_piece[name][board.Board.WHITE]) + len(b.by_piece[name][board.Board.BLACK])
+
+      if count > self.max_pieces or b.by_piece['P'][board.Board.WHITE] or b.by_piece['P'][board.Board.BLACK] or \
+         b.castling_rights():
+         return None
+
+      pieces = [(p.name, p.color, p.file * 8 + p.rank) for p in b.pieces if p != None]
+      value = self.lookup(pieces, b.to_play == board.Board.WHITE)
+
+      if value == None or value == ILLEGAL:
+         return None
+
+      return result(value)
+
+   """
+   Look up the value of a placement, given as a list of (kind, color, square) tuples, with the given side to play.
+   Return None if there's no table for it.
+   """
+   def lookup(self, pieces, white_to_play):
+      if len(pieces) == 2:
+         return DRAW
+
+      signature, flip = _signature([(k, c) for k, c, s in pieces])
+      table = self._table(signature)
+
+      if table == None:
+         return None
+
+      if flip:
+         other = {board.Board.WHITE: board.Board.BLACK, board.Board.BLACK: board.Board.WHITE}
+         pieces = [(k, other[c], (s & ~7) | (7 - (s & 7))) for k, c, s in pieces]
+         white_to_play = not white_to_play
+
+      # Sort the pieces into table order
+      pieces = sorted(pieces, key=lambda p: (p[1] != board.Board.WHITE, _order.index(p[0])))
+      index = 0 if white_to_play else 1
+
+      for k, c, s in pieces:
+         index = index * 64 + s
+
+      return self._read(signature, table, index)
+
+   def close(self):
+      for f, data in self.tables.values():
+         if data != None:
+            data.close()
+            f.close()
+
+      self.tables = {}
+      self.blocks.clear()
+
+   def _table(self, signature):
+      if signature not in self.tables:
+         path = table_path(self.directory, signature)
+
+         if not os.path.exists(path):
+            self.tables[signature] = (None, None)
+         else:
+            f = open(path, 'rb')
+            self.tables[signature] = (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+      return self.tables[signature][1]
+
+   def _read(self, signature, table, index):
+      offset = len(_header) + index
+      key = (signature, offset / self.block_size)
+      block = self.blocks.pop(key, None)
+
+      if block == None:
+         self.misses += 1
+         start = key[1] * self.block_size
+         block = table[start:start + self.block_size]
+
+         if len(self.blocks) >= self.cache_blocks:
+            self.blocks.popitem(last=False)
+      else:
+         self.hits += 1
+
+      self.blocks[key] = block
+
+      return ord(block[offset % self.block_size])
+
+"""
+Translate a table value into a tuple of (result, plies) as returned by Tablebase.probe().
+"""
+def result(value):
+   if value == DRAW:
+      return (0, 0)
+
+   plies = value - 1
+
+   return (1 if plies % 2 else -1, plies)
+
+"""
+Generate the table for a signature, and any tables its captures lead to, in the given directory.  Return the path of
+the table.  Existing tables are not regenerated.
+"""
+def generate(signature, directory):
+   signature = canonical(signature)
+   path = table_path(directory, signature)
+
+   if os.path.exists(path):
+      return path
+
+   pieces = _parse(signature)
+   n = len(pieces)
+
+   if n > 2 and [k for k, c in pieces if k == 'P']:
+      raise ValueError('Tables with pawns are not supported: %s' % signature)
+
+   # Generate the tables reached by captures first
+   for i in range(n):
+      if pieces[i][0] != 'K' and n > 3:
+         generate(_signature(pieces[:i] + pieces[i + 1:])[0], directory)
+
+   tablebase = Tablebase(directory)
+   kinds = [k for k, c in pieces]
+   colors = [c for k, c in pieces]
+   sides = [[j for j in range(n) if colors[j] == board.Board.WHITE], [j for j in range(n) if colors[j] != board.Board.WHITE]]
+   kings = [kinds.index('K'), n - 1 - kinds[::-1].index('K')]
+   size = 64 ** n
+   values = bytearray(2 * size)
+   counts = bytearray(2 * size)
+   mated = []
+   # Values from the tables reached by captures are resolved in order along with everything else.  The ply buckets
+   # hold the positions with a capture into a lost position, and those with a capture into a won position.
+   lost_children = collections.defaultdict(lambda: array.array('L'))
+   won_children = collections.defaultdict(lambda: array.array('L'))
+
+   for idx, squares in enumerate(itertools.product(range(64), repeat=n)):
+      occupied = [0] * 64
+
+      for j in range(n):
+         occupied[squares[j]] = j + 1
+
+      if len(set(squares)) < n or squares[kings[1]] in _kings[squares[kings[0]]]:
+         values[idx] = values[size + idx] = ILLEGAL
+         continue
+
+      for side in (0, 1):
+         index = side * size + idx
+         mine = sides[side]
+         theirs = sides[1 - side]
+
+         # The side that just moved can't have left its king in check.
+         if _attacked(squares[kings[1 - side]], mine, kinds, squares, occupied):
+            values[index] = ILLEGAL
+            continue
+
+         legal = 0
+
+         for j in mine:
+            start = squares[j]
+
+            for t in list(_targets(kinds[j], start, occupied)):
+               captured = occupied[t] - 1
+
+               if captured >= 0 and colors[captured] == colors[j]:
+                  continue
+
+               moved = list(squares)
+               moved[j] = t
+               occupied[start] = 0
+               occupied[t] = j + 1
+               exposed = _attacked(moved[kings[side]], [k for k in theirs if k != captured], kinds, moved, occupied)
+               occupied[start] = j + 1
+               occupied[t] = captured + 1
+
+               if exposed:
+                  continue
+
+               legal += 1
+
+               if captured >= 0:
+                  child = [(kinds[k], colors[k], moved[k]) for k in range(n) if k != captured]
+                  value = tablebase.lookup(child, side == 1)
+
+                  if value != DRAW:
+                     plies = value - 1
+
+                     if plies % 2:
+                        won_children[plies].append(index)
+                     else:
+                        lost_children[plies].append(index)
+
+         counts[index] = legal
+
+         if legal == 0 and _attacked(squares[kings[side]], theirs, kinds, squares, occupied):
+            mated.append(index)
+
+   tablebase.close()
+
+   # Work outward from mate one ply at a time.  A position with a move into a lost position is won, and a position
+   # where every move leads into a won position is lost.
+   current = mated
+
+   for index in mated:
+      values[index] = 1
+
+   plies = 0
+
+   while current or [p for p in lost_children.keys() + won_children.keys() if p >= plies]:
+      lost = list(lost_children.pop(plies, []))
+      won = list(won_children.pop(plies, []))
+
+      for index in current:
+         if (values[index] - 1) % 2:
+            won.extend(_predecessors(index, n, size, kinds, sides))
+         else:
+            lost.extend(_predecessors(index, n, size, kinds, sides))
+
+      current = []
+
+      for index in lost:
+         if values[index] == DRAW:
+            values[index] = plies + 2
+            current.append(index)
+
+      for index in won:
+         if values[index] == DRAW and counts[index]:
+            counts[index] -= 1
+
+            if counts[index] == 0:
+               values[index] = plies + 2
+               current.append(index)
+
+      plies += 1
+
+   if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+   with open(path + '.tmp', 'wb') as f:
+      f.write(_header)
+      f.write(values)
+
+   os.rename(path + '.tmp', path)
+
+   return path
+
+"""
+Return the indexes of the positions from which the side to play before the given position could have reached it.
+"""
+def _predecessors(index, n, size, kinds, sides):
+   side = index / size
+   idx = index % size
+   squares = []
+
+   for i in range(n):
+      idx, s = divmod(idx, 64)
+      squares.insert(0, s)
+
+   occupied = [0] * 64
+
+   for j in range(n):
+      occupied[squares[j]] = j + 1
+
+   ret = []
+   base = (1 - side) * size
+
+   for j in sides[1 - side]:
+      weight = 64 ** (n - 1 - j)
+
+      for t in _targets(kinds[j], squares[j], occupied):
+         if not occupied[t]:
+            ret.append(base + index % size + (t - squares[j]) * weight)
+
+   return ret
+
+def test_krk():
+   import shutil
+   import tempfile
+
+   tmp = tempfile.mkdtemp()
+
+   try:
+      generate('KvKR', tmp)
+      tablebase = Tablebase(tmp)
+
+      # Black to play is mated
+      b = board.Board()
+      board.King(b, 7, 0, board.Board.BLACK)
+      board.King(b, 5, 1, board.Board.WHITE)
+      board.Rook(b, 7, 7, board.Board.WHITE)
+      b.set_to_play(board.Board.BLACK)
+
+      if tablebase.probe(b) != (-1, 0):
+         raise Exception('FAIL')
+
+      # White to play mates in one
+      b = board.Board()
+      board.King(b, 7, 0, board.Board.BLACK)
+      board.King(b, 5, 1, board.Board.WHITE)
+      board.Rook(b, 0, 7, board.Board.WHITE)
+
+      if tablebase.probe(b) != (1, 1):
+         raise Exception('FAIL')
+
+      # With the colors swapped the position is flipped onto the same table
+      b = board.Board()
+      board.King(b, 0, 0, board.Board.WHITE)
+      board.King(b, 2, 1, board.Board.BLACK)
+      board.Rook(b, 7, 7, board.Board.BLACK)
+      b.set_to_play(board.Board.BLACK)
+
+      if tablebase.probe(b) != (1, 1):
+         raise Exception('FAIL')
+
+      board.Board.tablebase = tablebase
+
+      try:
+         if b.evaluate()[board.Board.WHITE] != -999:
+            raise Exception('FAIL')
+      finally:
+         board.Board.tablebase = None
+
+      # A lone rook can be taken, and with white to play the longest mate is 16 moves.
+      b = board.Board()
+      board.King(b, 0, 0, board.Board.WHITE)
+      board.King(b, 7, 7, board.Board.BLACK)
+      board.Rook(b, 1, 1, board.Board.BLACK)
+
+      if tablebase.probe(b) != (0, 0):
+         raise Exception('FAIL')
+
+      with open(table_path(tmp, 'KRvK'), 'rb') as f:
+         values = bytearray(f.read()[len(_header):])
+
+      if max(v for v in values[:len(values) / 2] if v != ILLEGAL) != 32 or list(values).count(1) != 216:
+         raise Exception('FAIL')
+
+      tablebase.close()
+   finally:
+      shutil.rmtree(tmp)
+
+def main():
+   test_krk()
+
+if __name__ == '__main__':
+   main()
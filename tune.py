@@ -0,0 +1,273 @@
+import json
+import multiprocessing
+
+import numpy
+
+import board
+import pgn
+
+"""
+Tune the weights of Board.evaluate() against the results of games.  The features of every position of every game are
+extracted once with Board.features() into a matrix, with a row per position and a column per name in
+Board.EVAL_FEATURES, alongside the result of each position's game from white's point of view, 1 for a win, 0.5 for a
+draw, and 0 for a loss.  The weights are then fit to the results the way Texel's tuning method does, by minimizing the
+mean squared difference between the results and a logistic function of the scores, with the whole matrix at once:
+
+    features, results = tune.extract(['games.pgn.gz'])
+    weights = tune.fit(features, results)
+    tune.save_weights('weights.json', weights)
+
+A later tune.load_weights('weights.json') puts the weights in Board.EVAL_WEIGHTS for evaluate() to use.
+"""
+
+# The result of a game from white's point of view, by the index of its outcome in pgn.outcomes
+_results = {1: 1.0, 2: 0.5, 3: 0.0}
+
+"""
+Replay a game given as a tuple of (FEN, moves) and return the features of its positions from ply min_ply on,
+as a list of lists.  A game with an unplayable move is replayed up to that move.
+"""
+def _game_features(game, min_ply=0):
+   fen, moves = game
+   rows = []
+
+   try:
+      b = pgn.initial_board(fen)
+   except ValueError:
+      return rows
+
+   if min_ply == 0:
+      rows.append(b.features())
+
+   for ply, move in enumerate(moves):
+      try:
+         b.movePGN(move)
+      except ValueError:
+         break
+
+      if ply + 1 >= min_ply:
+         rows.append(b.features())
+
+   return rows
+
+# Return the features and results of the positions of the games with a result in a chunk of PGN text, as strings of
+# float32s for the parent to join.
+def _chunk_features(task):
+   chunk, min_ply = task
+   rows = []
+   results = []
+
+   for tags, moves in pgn.read_games(chunk.splitlines()):
+      result = _results.get(pgn.outcomes.get(tags.get('Result')))
+
+      if result != None:
+         game = _game_features((tags.get('FEN'), moves), min_ply)
+         rows += game
+         results += [result] * len(game)
+
+   features = numpy.array(rows, dtype=numpy.float32).reshape(-1, len(board.Board.EVAL_FEATURES))
+
+   return (features.tostring(), numpy.array(results, dtype=numpy.float32).tostring())
+
+"""
+Extract the features of every position from ply min_ply on of every game with a result in the given PGN files, which
+may be compressed.  The files are decompressed in a background thread and handed in chunks of about chunk_size
+characters to the given number of worker processes, by default one per CPU, to be replayed.  Return a tuple of a
+float32 array of features shaped (positions, len(Board.EVAL_FEATURES)) and a float32 array of results.
+"""
+def extract(paths, workers=None, min_ply=0, chunk_size=1 << 18):
+   pool = multiprocessing.Pool(workers)
+   features = []
+   results = []
+
+   def tasks():
+      for path in paths:
+         for chunk in pgn.read_chunks(path, chunk_size):
+            yield (chunk, min_ply)
+
+   try:
+      for rows, scores in pool.imap(_chunk_features, tasks()):
+         features.append(rows)
+         results.append(scores)
+   finally:
+      pool.close()
+      pool.join()
+
+   features = numpy.fromstring(''.join(features), dtype=numpy.float32)
+
+   return (features.reshape(-1, len(board.Board.EVAL_FEATURES)),
+           numpy.fromstring(''.join(results), dtype=numpy.float32))
+
+"""
+Return weights given as a dict by feature name as an array in the order of Board.EVAL_FEATURES, with the weights of
+Board.EVAL_WEIGHTS for any that are missing.  Weights that are already in order are copied into a new array.
+"""
+def weight_vector(weights=None):
+   if weights is not None and not isinstance(weights, dict):
+      return numpy.array(weights, dtype=numpy.float64)
+
+   weights = dict(board.Board.EVAL_WEIGHTS, **(weights or {}))
+
+   return numpy.array([weights[name] for name in board.Board.EVAL_FEATURES], dtype=numpy.float64)
+
+"""
+Return the expected result of each position, from white's point of view, for the given features and weights, which
+are either a dict by feature name or an array from weight_vector().  The scale stretches the scores before they're
+squashed into the range of 0 to 1.
+"""
+def predict(features, weights, scale):
+   if isinstance(weights, dict):
+      weights = weight_vector(weights)
+
+   return 1.0 / (1.0 + numpy.exp(-scale * numpy.dot(features, weights)))
+
+"""
+Return the mean squared difference between the results and the results predict() expects.
+"""
+def error(features, results, weights, scale):
+   return float(numpy.mean((predict(features, weights, scale) - results) ** 2))
+
+"""
+Return the scale that gives the given weights the least error, found by a golden section search on a log scale between
+low and high.
+"""
+def fit_scale(features, results, weights=None, low=0.01, high=10.0, iterations=40):
+   weights = weight_vector(weights)
+   golden = (5 ** 0.5 - 1) / 2
+   a = numpy.log(low)
+   b = numpy.log(high)
+
+   for i in range(iterations):
+      c = b - golden * (b - a)
+      d = a + golden * (b - a)
+
+      if error(features, results, weights, numpy.exp(c)) < error(features, results, weights, numpy.exp(d)):
+         b = d
+      else:
+         a = c
+
+   return float(numpy.exp((a + b) / 2))
+
+"""
+Fit the weights to the results, starting with the given weights, by default those of Board.EVAL_WEIGHTS, and return
+them as a dict by feature name.  The scale is fit to the starting weights with fit_scale() unless it's given, and then
+held fixed, so the weights keep the units of the starting ones.  The features named in fixed keep their starting
+weights.  The fit is a gradient descent over the whole matrix, with each step divided by the mean square of its
+feature so that counts of different sizes, like material and mobility, move at the same pace.
+"""
+def fit(features, results, weights=None, scale=None, fixed=('K',), iterations=2000, rate=1.0):
+   features = numpy.asarray(features, dtype=numpy.float64)
+   results = numpy.asarray(results, dtype=numpy.float64)
+   w = weight_vector(weights)
+
+   if scale == None:
+      scale = fit_scale(features, results, w)
+
+   free = numpy.array([name not in fixed for name in board.Board.EVAL_FEATURES])
+   step = rate / (scale * scale * (features ** 2).mean(axis=0) + 1e-9)
+   step[~free] = 0
+
+   for i in range(iterations):
+      p = predict(features, w, scale)
+      gradient = numpy.dot((p - results) * p * (1 - p), features) * (2 * scale / len(results))
+      w -= step * gradient
+
+   return dict(zip(board.Board.EVAL_FEATURES, (float(x) for x in w)))
+
+"""
+Write weights, given as a dict by feature name, to a JSON file.
+"""
+def save_weights(path, weights):
+   with open(path, 'w') as f:
+      json.dump(weights, f, indent=1, sort_keys=True)
+
+"""
+Read weights written by save_weights() and put them in Board.EVAL_WEIGHTS for evaluate() to use.  Weights the file
+doesn't have keep their current values.  Return the new weights.
+"""
+def load_weights(path):
+   with open(path) as f:
+      weights = json.load(f)
+
+   unknown = [name for name in weights if name not in board.Board.EVAL_FEATURES]
+
+   if unknown:
+      raise ValueError('Unknown evaluation features: %s' % ', '.join(sorted(unknown)))
+
+   board.Board.EVAL_WEIGHTS = dict(board.Board.EVAL_WEIGHTS, **weights)
+
+   return board.Board.EVAL_WEIGHTS
+
+def test_extract():
+   import os
+   import shutil
+   import tempfile
+
+   tmp = tempfile.mkdtemp()
+
+   try:
+      path = os.path.join(tmp, 'games.pgn')
+
+      with open(path, 'w') as f:
+         f.write('[Result "1-0"]\n\n1. e4 d5 2. exd5 *\n\n[Result "*"]\n\n1. d4 *\n\n'
+                 '[Result "1/2-1/2"]\n\n1. d4 *\n')
+
+      features, results = extract([path], workers=2, chunk_size=16)
+
+      if features.shape != (6, len(board.Board.EVAL_FEATURES)) or list(results) != [1, 1, 1, 1, 0.5, 0.5]:
+         raise Exception('FAIL')
+
+      # After 2. exd5 white is a pawn up.
+      b = board.Board()
+      b.initialize()
+
+      if list(features[0]) != b.features() or features[3][board.Board.EVAL_FEATURES.index('P')] != 1:
+         raise Exception('FAIL')
+
+      if extract([path], workers=1, min_ply=2)[0].shape != (2, len(board.Board.EVAL_FEATURES)):
+         raise Exception('FAIL')
+   finally:
+      shutil.rmtree(tmp)
+
+def test_fit():
+   import os
+   import tempfile
+
+   # Made-up positions where white wins exactly when it has more knights, whatever the pawns say
+   rng = numpy.random.RandomState(1)
+   features = numpy.zeros((2000, len(board.Board.EVAL_FEATURES)), dtype=numpy.float32)
+   features[:, board.Board.EVAL_FEATURES.index('N')] = rng.randint(-2, 3, 2000)
+   features[:, board.Board.EVAL_FEATURES.index('P')] = rng.randint(-3, 4, 2000)
+   results = numpy.where(features[:, 4] > 0, 1.0, numpy.where(features[:, 4] < 0, 0.0, 0.5))
+   start = {'N': 1, 'P': 1}
+   weights = fit(features, results, start, scale=1.0, iterations=500)
+
+   if weights['N'] <= 3 * abs(weights['P']) or weights['K'] != board.Board.EVAL_WEIGHTS['K']:
+      raise Exception('FAIL')
+
+   if error(features, results, weights, 1.0) >= error(features, results, start, 1.0):
+      raise Exception('FAIL')
+
+   if not 0.01 < fit_scale(features, results, weights) < 10:
+      raise Exception('FAIL')
+
+   fd, path = tempfile.mkstemp(suffix='.json')
+   os.close(fd)
+   saved = board.Board.EVAL_WEIGHTS
+
+   try:
+      b = board.Board.from_fen('4k3/8/8/8/8/8/8/1N2K3 w - - 0 1')
+      save_weights(path, {'N': 2.5, 'mobility': 0})
+
+      if load_weights(path)['N'] != 2.5 or b.evaluate()[board.Board.WHITE] != 2.5:
+         raise Exception('FAIL')
+   finally:
+      board.Board.EVAL_WEIGHTS = saved
+      os.remove(path)
+
+def main():
+   test_extract()
+   test_fit()
+
+if __name__ == '__main__':
+   main()
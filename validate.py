@@ -0,0 +1,417 @@
+import multiprocessing
+import re
+
+import board
+import pgn
+
+"""
+Differential testing of move replay.  Every game is replayed twice, once with Board.movePGN(), which resolves SAN
+through the piece reach() and pin logic, and once with a small reference implementation in this module that shares no
+code with Board and picks each move out of a brute force list of legal moves.  After every ply the two positions, the
+side to play, the castling rights, the en passant square, and the number of legal moves, which checks
+Board.legal_moves(), are compared, and the first difference in each game is reported:
+
+    for path, number, tags, divergence in validate.validate(['archive.pgn'], workers=8):
+        print path, number, divergence
+
+The reference implementation only knows standard castling, so games set up from a Chess960 FEN are reported as
+diverging at the start.
+"""
+
+_san_pattern = re.compile(r'^([NBRQK])?([a-h])?([1-8])?(x)?([a-h][1-8])(?:=?([NBRQ]))?[+#]?$')
+_castle_pattern = re.compile(r'^(O-O(?:-O)?)[+#]?$')
+
+_knight_steps = [(1, 2), (2, 1), (-1, 2), (-2, 1), (1, -2), (2, -1), (-1, -2), (-2, -1)]
+_king_steps = [(f, r) for f in [-1, 0, 1] for r in [-1, 0, 1] if f != 0 or r != 0]
+_rook_steps = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+_bishop_steps = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+# The steps each kind of piece attacks along, and whether it slides
+_steps = {'N': (_knight_steps, False), 'K': (_king_steps, False), 'R': (_rook_steps, True),
+          'B': (_bishop_steps, True), 'Q': (_rook_steps + _bishop_steps, True)}
+
+# The castling right lost when a piece moves from or to each corner, by square number
+_corner_rights = {0: 'Q', 56: 'K', 7: 'q', 63: 'k'}
+
+# Return the square reached by stepping df files and dr ranks from square i, or None if it's off the board.
+def _step(i, df, dr):
+   file = i / 8 + df
+   rank = i % 8 + dr
+
+   if file >= 0 and file <= 7 and rank >= 0 and rank <= 7:
+      return file * 8 + rank
+
+   return None
+
+"""
+The reference implementation's position: a list of 64 letters indexed like Board.pieces, with 'x' for an empty
+square, the side to play, the castling rights as a string of KQkq letters, and the en passant square or None.  It's
+written for clarity over speed, and every move makes a new position rather than changing this one.
+"""
+class _Reference(object):
+   def __init__(self, fen):
+      fields = fen.split()
+
+      if len(fields) < 4:
+         raise ValueError('Bad FEN: %s' % fen)
+
+      placement, color, castling, en_passant = fields[:4]
+      rows = placement.split('/')
+
+      if len(rows) != 8:
+         raise ValueError('Bad FEN: %s' % fen)
+
+      self.squares = ['x'] * 64
+
+      for row, text in enumerate(rows):
+         file = 0
+
+         for c in text:
+            if c.isdigit():
+               file += int(c)
+            elif file < 8:
+               self.squares[file * 8 + 7 - row] = c
+               file += 1
+
+      if castling.strip('KQkq-'):
+         raise ValueError('Unsupported castling rights: %s' % castling)
+
+      self.white = color == 'w'
+      self.castling = castling.replace('-', '')
+      self.en_passant = None
+
+      if en_passant != '-':
+         self.en_passant = (ord(en_passant[0]) - 97) * 8 + int(en_passant[1]) - 1
+
+   def _own(self, i, white):
+      return self.squares[i] != 'x' and self.squares[i].isupper() == white
+
+   # Return the squares the piece on square i attacks.
+   def _targets(self, i):
+      c = self.squares[i]
+      kind = c.upper()
+
+      if kind == 'P':
+         dr = 1 if c.isupper() else -1
+         steps, slides = ([(-1, dr), (1, dr)], False)
+      else:
+         steps, slides = _steps[kind]
+
+      ret = []
+
+      for df, dr in steps:
+         j = _step(i, df, dr)
+
+         while j != None:
+            ret.append(j)
+
+            if not slides or self.squares[j] != 'x':
+               break
+
+            j = _step(j, df, dr)
+
+      return ret
+
+   def _attacked(self, i, white):
+      return any(self._own(j, white) and i in self._targets(j) for j in range(64))
+
+   """
+   Return the legal moves as (src, dest, promotion) tuples, with castling given as the king's move.
+   """
+   def moves(self):
+      ret = []
+      last = 7 if self.white else 0
+
+      for i in range(64):
+         if not self._own(i, self.white):
+            continue
+
+         dests = []
+
+         if self.squares[i].upper() == 'P':
+            dr = 1 if self.white else -1
+            j = _step(i, 0, dr)
+
+            if j != None and self.squares[j] == 'x':
+               dests.append(j)
+
+               if i % 8 == (1 if self.white else 6) and self.squares[_step(j, 0, dr)] == 'x':
+                  dests.append(_step(j, 0, dr))
+
+            for j in self._targets(i):
+               if self._own(j, not self.white) or j == self.en_passant:
+                  dests.append(j)
+         else:
+            dests = [j for j in self._targets(i) if not self._own(j, self.white)]
+
+         for j in dests:
+            if self.squares[j].upper() == 'K':
+               continue
+
+            if self.squares[i].upper() == 'P' and j % 8 == last:
+               ret.extend([(i, j, p) for p in 'QRBN'])
+            else:
+               ret.append((i, j, None))
+
+      ret.extend(self._castles())
+
+      return [m for m in ret if not self.play(m)._in_check(self.white)]
+
+   def _castles(self):
+      ret = []
+      rank = 0 if self.white else 7
+      king = 32 + rank
+
+      for right, rook, between, path, dest in (('K', 7, [5, 6], [4, 5, 6], 6), ('Q', 0, [1, 2, 3], [4, 3, 2], 2)):
+         if not self.white:
+            right = right.lower()
+
+         if right not in self.castling or self.squares[king] != ('K' if self.white else 'k') or \
+            self.squares[rook * 8 + rank] != ('R' if self.white else 'r'):
+            continue
+
+         if [f for f in between if self.squares[f * 8 + rank] != 'x']:
+            continue
+
+         if not [f for f in path if self._attacked(f * 8 + rank, not self.white)]:
+            ret.append((king, dest * 8 + rank, None))
+
+      return ret
+
+   def _in_check(self, white):
+      kings = [i for i in range(64) if self.squares[i] == ('K' if white else 'k')]
+
+      return bool(kings) and self._attacked(kings[0], not white)
+
+   """
+   Return the position after a move given as a (src, dest, promotion) tuple.
+   """
+   def play(self, move):
+      src, dest, promotion = move
+      ret = _Reference.__new__(_Reference)
+      ret.squares = list(self.squares)
+      ret.white = not self.white
+      ret.castling = self.castling
+      ret.en_passant = None
+      c = self.squares[src]
+      ret.squares[src] = 'x'
+      ret.squares[dest] = c
+
+      if c.upper() == 'P':
+         if dest == self.en_passant:
+            ret.squares[dest / 8 * 8 + src % 8] = 'x'
+         elif abs(dest % 8 - src % 8) == 2:
+            ret.en_passant = (src + dest) / 2
+
+         if promotion:
+            ret.squares[dest] = promotion if self.white else promotion.lower()
+      elif c.upper() == 'K':
+         ret.castling = ret.castling.replace('K' if self.white else 'k', '').replace('Q' if self.white else 'q', '')
+
+         # Castling, which moves the rook to the other side of the king
+         if abs(dest / 8 - src / 8) == 2:
+            rook, rook_dest = (dest + 8, dest - 8) if dest > src else (dest - 16, dest + 8)
+            ret.squares[rook_dest] = ret.squares[rook]
+            ret.squares[rook] = 'x'
+
+      for i in (src, dest):
+         if i in _corner_rights:
+            ret.castling = ret.castling.replace(_corner_rights[i], '')
+
+      return ret
+
+   """
+   Return the position after a move given in SAN.  A ValueError is raised unless exactly one legal move matches.
+   """
+   def play_san(self, san):
+      m = _castle_pattern.match(san)
+
+      if m:
+         rank = 0 if self.white else 7
+         dest = (2 if m.group(1) == 'O-O-O' else 6) * 8 + rank
+         found = [mv for mv in self.moves() if mv[0] == 32 + rank and mv[1] == dest and \
+                  self.squares[mv[0]].upper() == 'K']
+      else:
+         m = _san_pattern.match(san)
+
+         if not m:
+            raise ValueError('Bad move definition: %s' % san)
+
+         kind, file, rank, capture, square, promotion = m.groups()
+         dest = (ord(square[0]) - 97) * 8 + int(square[1]) - 1
+         found = []
+
+         for mv in self.moves():
+            if mv[1] != dest or mv[2] != promotion or self.squares[mv[0]].upper() != (kind or 'P'):
+               continue
+
+            if (file and ord(file) - 97 != mv[0] / 8) or (rank and int(rank) - 1 != mv[0] % 8):
+               continue
+
+            # A pawn captures exactly when it changes files.
+            if not kind and bool(capture) != (mv[0] / 8 != dest / 8):
+               continue
+
+            found.append(mv)
+
+         if capture and self.squares[dest] == 'x' and not (not kind and dest == self.en_passant):
+            found = []
+
+      if len(found) != 1:
+         raise ValueError('%s is not possible' % san if not found else '%s is ambiguous' % san)
+
+      return self.play(found[0])
+
+   """
+   Return the placement, side to play, castling, and en passant fields of a FEN, and the number of legal moves.
+   """
+   def describe(self):
+      rows = []
+
+      for rank in range(7, -1, -1):
+         row = ''.join(self.squares[file * 8 + rank] for file in range(8))
+         rows.append(re.sub('x+', lambda m: str(len(m.group(0))), row))
+
+      castling = ''.join(c for c in 'KQkq' if c in self.castling) or '-'
+      en_passant = board.Board.SQUARE_NAMES[self.en_passant] if self.en_passant != None else '-'
+
+      return '%s %s %s %s, %d legal moves' % ('/'.join(rows), 'w' if self.white else 'b', castling, en_passant,
+         len(self.moves()))
+
+# Describe a Board as _Reference.describe() does.
+def _describe(b):
+   return '%s, %d legal moves' % (' '.join(b.to_fen().split()[:4]), len(b.legal_moves()))
+
+"""
+Replay a game given as a list of SAN moves on a Board and on the reference implementation, starting from the given
+FEN or the initial position, and return its first divergence, or None if there's none.  A divergence is a tuple of
+(ply, move, board, reference), where ply is the number of moves played, move is the last of them, and board and
+reference describe the two positions as in _Reference.describe(), or give the error that one of them raised for the
+move.  A move that both reject ends the game without a divergence.
+"""
+def check_game(moves, fen=None):
+   try:
+      b = pgn.initial_board(fen)
+   except ValueError, e:
+      return (0, None, 'error: %s' % e, None)
+
+   try:
+      reference = _Reference(fen or board.Board.STARTING_FEN)
+   except ValueError, e:
+      return (0, None, _describe(b), 'error: %s' % e)
+
+   move = None
+
+   for ply in range(len(moves) + 1):
+      expected = reference.describe()
+      found = _describe(b)
+
+      if found != expected:
+         return (ply, move, found, expected)
+
+      if ply == len(moves):
+         break
+
+      move = moves[ply]
+      errors = [None, None]
+
+      try:
+         b.movePGN(move)
+      except ValueError, e:
+         errors[0] = 'error: %s' % e
+
+      try:
+         reference = reference.play_san(move)
+      except ValueError, e:
+         errors[1] = 'error: %s' % e
+
+      if errors[0] and errors[1]:
+         break
+      elif errors[0] or errors[1]:
+         return (ply + 1, move, errors[0] or _describe(b), errors[1] or reference.describe())
+
+   return None
+
+# Check the games in a chunk of PGN text, and return the number of games and a list of (game number in the chunk,
+# tags, divergence) tuples for the ones that diverge.
+def _check_chunk(chunk):
+   games = list(pgn.read_games(chunk.splitlines()))
+   found = []
+
+   for number, (tags, moves) in enumerate(games):
+      divergence = check_game(moves, tags.get('FEN'))
+
+      if divergence != None:
+         found.append((number, tags, divergence))
+
+   return (len(games), found)
+
+"""
+Check every game in the given PGN files, which may be compressed, with check_game().  The files are decompressed in a
+background thread and handed in chunks of about chunk_size characters to the given number of worker processes, by
+default one per CPU.  Yield a tuple of (path, game number, tags, divergence) for each game that diverges, in file
+order, where games are numbered from 0 in each file.
+"""
+def validate(paths, workers=None, chunk_size=1 << 16):
+   pool = multiprocessing.Pool(workers)
+
+   try:
+      for path in paths:
+         start = 0
+
+         for count, found in pool.imap(_check_chunk, pgn.read_chunks(path, chunk_size)):
+            for number, tags, divergence in found:
+               yield (path, start + number, tags, divergence)
+
+            start += count
+   finally:
+      pool.close()
+      pool.join()
+
+def test_check_game():
+   # En passant, castling on both sides, promotion, and a capture of a rook on its corner
+   moves = ['e4', 'd5', 'e5', 'f5', 'exf6', 'Nc6', 'fxg7', 'Be6', 'Nf3', 'Qd7', 'Bb5', 'O-O-O', 'O-O', 'Bh3',
+            'gxh8=Q', 'Bxg2', 'Qxg8', 'Bxf1', 'Kxf1']
+
+   if check_game(moves) != None:
+      raise Exception('FAIL')
+
+   # A pawn that reaches the last rank without promoting
+   moves = moves[:14] + ['gxh8']
+   divergence = check_game(moves)
+
+   if divergence == None or divergence[:2] != (15, 'gxh8') or 'error' not in divergence[3]:
+      raise Exception('FAIL')
+
+   if check_game(['e4', 'e5', 'Ke3']) != None or check_game(['e4'], board.Board.STARTING_FEN) != None:
+      raise Exception('FAIL')
+
+   if check_game([], 'bqnbrkrn/pppppppp/8/8/8/8/PPPPPPPP/BQNBRKRN w GEge - 0 1')[3] == None:
+      raise Exception('FAIL')
+
+def test_validate():
+   import os
+   import shutil
+   import tempfile
+
+   tmp = tempfile.mkdtemp()
+
+   try:
+      path = os.path.join(tmp, 'games.pgn')
+
+      with open(path, 'w') as f:
+         f.write('1. e4 e5 2. Nf3 Nc6 *\n\n1. e4 d5 2. e5 f5 3. exf6 Nc6 4. fxg7 Bd7 5. gxh8 *\n\n1. d4 *\n')
+
+      found = list(validate([path], workers=2, chunk_size=32))
+
+      if [(number, divergence[:2]) for p, number, tags, divergence in found] != [(1, (9, 'gxh8'))]:
+         raise Exception('FAIL')
+   finally:
+      shutil.rmtree(tmp)
+
+def main():
+   test_check_game()
+   test_validate()
+
+if __name__ == '__main__':
+   main()